@@ -8,7 +8,8 @@ __author__ = "Jonas Meisner"
 import numpy as np
 from numba import jit
 from helpFunctions import *
-from math import log
+from checkpoint import rngState, setRngState
+from math import log, sqrt
 from scipy.sparse.linalg import svds
 
 ##### Functions #####
@@ -25,19 +26,63 @@ def logLike_admixInner(likeMatrix, X, S, N, L):
 			temp[2] = likeMatrix[3*ind+2, s]*X[ind, s]*X[ind, s]
 			L[ind] += log(np.sum(temp))
 
-# Estimate log likelihood of ngsAdmix model (outer)
-def logLike_admix(likeMatrix, X, chunks, chunk_N):
-	m, n = likeMatrix.shape
-	m /= 3
-	logLike_inds = np.zeros(m) # Log-likelihood container for each individual
+# Estimate log likelihood of ngsAdmix model (inner, individual-major likelihoods)
+@jit("void(f4[:, :, :], f8[:, :], i8, i8, f8[:])", nopython=True, nogil=True, cache=True)
+def logLike_admixInner_ind(likeInd, X, S, N, L):
+	m, n, _ = likeInd.shape
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = likeInd[ind, s, 0]*(1 - X[ind, s])*(1 - X[ind, s])
+			p1 = likeInd[ind, s, 1]*2*X[ind, s]*(1 - X[ind, s])
+			p2 = likeInd[ind, s, 2]*X[ind, s]*X[ind, s]
+			L[ind] += log(p0 + p1 + p2)
+
+# Estimate log likelihood of ngsAdmix model (inner, PLINK genotype codes)
+@jit("void(u1[:, :], f8[:, :], i8, i8, f8[:], f8)", nopython=True, nogil=True, cache=True)
+def logLike_admixInner_plink(G, X, S, N, L, epsilon):
+	m, n = G.shape
+	table = plinkTable(epsilon)
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[G[ind, s], 0]*(1 - X[ind, s])*(1 - X[ind, s])
+			p1 = table[G[ind, s], 1]*2*X[ind, s]*(1 - X[ind, s])
+			p2 = table[G[ind, s], 2]*X[ind, s]*X[ind, s]
+			L[ind] += log(p0 + p1 + p2)
+
+# Estimate log likelihood of ngsAdmix model (inner, quantized likelihoods)
+@jit(["void(u1[:, :, :], f8[:, :], i8, i8, f8[:], f4[:])", "void(u2[:, :, :], f8[:, :], i8, i8, f8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def logLike_admixInner_quant(Q, X, S, N, L, table):
+	m, n, _ = Q.shape
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[Q[ind, s, 0]]*(1 - X[ind, s])*(1 - X[ind, s])
+			p1 = table[Q[ind, s, 1]]*2*X[ind, s]*(1 - X[ind, s])
+			p2 = table[Q[ind, s, 2]]*X[ind, s]*X[ind, s]
+			L[ind] += log(p0 + p1 + p2)
 
-	# Multithreading
-	threads = [threading.Thread(target=logLike_admixInner, args=(likeMatrix, X, chunk, chunk_N, logLike_inds)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
+# Estimate log likelihood of ngsAdmix model on tile of individuals x sites in blocks of sites
+def logLike_admixTile(kernel, likeMatrix, layout, Q, F, S, N, s0, s1, L, blockSites=4096):
+	likeInds = indSlice(likeMatrix, layout, S, N)
+	for b in xrange(s0, s1, blockSites):
+		bEnd = min(b + blockSites, s1)
+		X = np.dot(Q[S:S+N], F[b:bEnd].T)
+		kernel(siteSlice(likeInds, layout, b, bEnd), X, 0, X.shape[0], L[S:S+X.shape[0]])
 
+# Estimate log likelihood of ngsAdmix model (outer), frequencies Q*F^T are rebuilt in blocks of sites
+def logLike_admix(likeMatrix, Q, F, threads=1, layout="standard", epsilon=0.0):
+	m, n = likeDims(likeMatrix, layout)
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		kernel = lambda Q, X, S, N, L: logLike_admixInner_quant(Q, X, S, N, L, table)
+	elif layout == "plink":
+		kernel = lambda G, X, S, N, L: logLike_admixInner_plink(G, X, S, N, L, epsilon)
+	elif layout == "ind":
+		kernel = logLike_admixInner_ind
+	else:
+		kernel = logLike_admixInner
+
+	# Multithreading - log-likelihood of each individual
+	logLike_inds = reduceTiles(lambda S, N, s0, s1, L: logLike_admixTile(kernel, likeMatrix, layout, Q, F, S, N, s0, s1, L), m, n, threads, (m,))
 	return np.sum(logLike_inds)
 
 # Update factor matrices
@@ -60,42 +105,68 @@ def updateQ(Q, A, QB, alpha):
 			Q[i, k] = min(Q[i, k], 1-(1e-4))
 
 
+# Product X^T*Q of individual allele frequencies (dense or factors) at given sites computed in blocks of sites
+def freqDotQ(X, sites, Q, blockSites=4096):
+	A = np.empty((len(sites), Q.shape[1]))
+	for b in xrange(0, len(sites), blockSites):
+		A[b:b+blockSites] = np.dot(freqBlock(X, sites[b:b+blockSites]).T, Q)
+	return A
+
+# Product X*F of individual allele frequencies (dense or factors) at given sites computed in blocks of sites
+def freqDotF(X, sites, F, blockSites=4096):
+	A = np.zeros((freqDims(X)[0], F.shape[1]))
+	for b in xrange(0, len(sites), blockSites):
+		A += np.dot(freqBlock(X, sites[b:b+blockSites]), F[b:b+blockSites])
+	return A
+
+# Frobenius error between individual allele frequencies and Q*F^T (inner) in blocks of sites
+def frobenius_admixTile(X, Q, F, S, N, s0, s1, V):
+	for b, bEnd, Xb in freqBlocks(X, S, N, s0, s1):
+		frobenius2d_inner(Xb, np.dot(Q[S:S+N], F[b:bEnd].T), 0, Xb.shape[0], V[S:S+Xb.shape[0]])
+
 # Estimate admixture using non-negative matrix factorization
-def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, threads=1):
-	m, n = X.shape # Dimensions of individual allele frequencies
+# Individual allele frequencies (dense or factors) are accessed in shuffled blocks of sites without a full copy
+# Iterations continue from checkpoint state if given and state is passed to checkpoint after each iteration
+def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, threads=1, layout="standard", epsilon=0.0, state=None, checkpoint=None):
+	m, n = freqDims(X) # Dimensions of individual allele frequencies
+	if state is not None:
+		seed = int(state["seed"])
 
-	# Shuffle individual allele frequencies
+	# Shuffle order of sites
 	np.random.seed(seed) # Set random seed
 	shuffleX = np.random.permutation(n)
-	X = X[:, shuffleX]
 
 	# Initiate matrices
-	Q = np.random.rand(m, K)
-	Q /= np.sum(Q, axis=1, keepdims=True)
-	prevQ = np.copy(Q)
-	F = np.dot(np.linalg.inv(np.dot(Q.T, Q)), np.dot(Q.T, X)).T
-
-	# Multithreading
-	chunk_N = int(np.ceil(float(m)/threads))
-	chunks = [i * chunk_N for i in xrange(threads)]
+	if state is not None:
+		Q, F, prevQ = state["Q"], state["F"], state["prevQ"]
+		setRngState(state)
+		iteration, fullStart = int(state["asgIter"]), int(state["fullIter"]) + 1
+		asgEnd = 0 if bool(state["asgDone"]) else iter + 1
+		if bool(state["final"]):
+			fullStart = 11
+	else:
+		Q = np.random.rand(m, K)
+		Q /= np.sum(Q, axis=1, keepdims=True)
+		prevQ = np.copy(Q)
+		F = np.dot(freqDotQ(X, shuffleX, Q), np.linalg.inv(np.dot(Q.T, Q)))
+		iteration, asgEnd, fullStart = 0, iter + 1, 1
 
 	# Batch preparation
 	batch_N = int(np.ceil(float(n)/batch))
 	bIndex = np.arange(0, n, batch_N)
 
 	# ASG-MU
-	for iteration in xrange(1, iter + 1):
+	for iteration in xrange(iteration + 1, asgEnd):
 		perm = np.random.permutation(batch)
 
 		for b in bIndex[perm]:
 			bEnd = min(b + batch_N, n)
-			Xbatch = X[:, b:bEnd]
-			nInner = Xbatch.shape[1]
+			nInner = bEnd - b
 			pF = 2*(1 + (m*nInner + m*K)/(nInner*K + nInner))
 			pQ = 2*(1 + (m*nInner + nInner*K)/(m*K + m))
 
 			# Update F
-			A = np.dot(Xbatch.T, Q)
+			A = freqDotQ(X, shuffleX[b:bEnd], Q)
 			B = np.dot(Q.T, Q)
 			for inner in xrange(pF): # Acceleration updates
 				F_prev = np.copy(F[b:bEnd])
@@ -108,7 +179,7 @@ def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, th
 						break
 			
 			# Update Q
-			A = np.dot(Xbatch, F[b:bEnd])
+			A = freqDotF(X, shuffleX[b:bEnd], F[b:bEnd])
 			B = np.dot(F[b:bEnd].T, F[b:bEnd])
 			for inner in xrange(pQ): # Acceleration updates
 				Q_prev = np.copy(Q)
@@ -122,22 +193,24 @@ def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, th
 						break
 
 		# Measure difference
-		diff = rmse2d_multi(Q, prevQ, chunks, chunk_N)
+		diff = rmse2d_multi(Q, prevQ, threads)
 		print "ASG-MU (" + str(iteration) + "). Q-RMSD=" + str(diff)
 		
 		if diff < tole:
 			print "ASG-MU has converged. Running full iterations."
+			if checkpoint is not None:
+				checkpoint(iteration, False, Q=Q, F=F, prevQ=prevQ, seed=seed, asgIter=iteration, asgDone=True, fullIter=0, **rngState())
 			break
 		prevQ = np.copy(Q)
-
-	del perm
+		if checkpoint is not None:
+			checkpoint(iteration, False, Q=Q, F=F, prevQ=prevQ, seed=seed, asgIter=iteration, asgDone=False, fullIter=0, **rngState())
 
 	# Full iterations
 	pF = 2*(1 + (m*n + m*K)/(n*K + n))
 	pQ = 2*(1 + (m*n + n*K)/(m*K + m))
-	for full_iter in xrange(1, 11):
+	for full_iter in xrange(fullStart, 11):
 		# Update F
-		A = np.dot(X.T, Q)
+		A = freqDotQ(X, shuffleX, Q)
 		B = np.dot(Q.T, Q)
 		for inner in xrange(pF): # Acceleration updates
 			F_prev = np.copy(F)
@@ -150,7 +223,7 @@ def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, th
 					break
 		
 		# Update Q
-		A = np.dot(X, F)
+		A = freqDotF(X, shuffleX, F)
 		B = np.dot(F.T, F)
 		for inner in xrange(pQ): # Acceleration updates
 			Q_prev = np.copy(Q)
@@ -164,25 +237,27 @@ def admixNMF(X, K, likeMatrix, alpha=0, iter=100, tole=5e-5, seed=0, batch=5, th
 					break
 
 		# Measure difference
-		diff = rmse2d_multi(Q, prevQ, chunks, chunk_N)
+		diff = rmse2d_multi(Q, prevQ, threads)
 		print "Full-MU (" + str(full_iter + iteration) + "). Q-RMSD=" + str(diff)
 		
 		if diff < 1e-5:
 			print "Admixture estimation has converged."
+		else:
+			prevQ = np.copy(Q)
+		if checkpoint is not None:
+			checkpoint(iteration + full_iter, (diff < 1e-5) or (full_iter == 10), Q=Q, F=F, prevQ=prevQ, seed=seed, asgIter=iteration, asgDone=True, fullIter=full_iter, **rngState())
+		if diff < 1e-5:
 			break
-		prevQ = np.copy(Q)
 	
-	del A, B, F_prev, Q_prev, prevQ
+	del prevQ
 	
 	# Reshuffle
 	F = F[np.argsort(shuffleX)]
-	X = X[:, np.argsort(shuffleX)]
 	
 	# Frobenius and log-like
-	Xhat = np.dot(Q, F.T)
-	Obj = frobenius2d_multi(X, Xhat, chunks, chunk_N)
+	Obj = sqrt(np.sum(reduceTiles(lambda S, N, s0, s1, V: frobenius_admixTile(X, Q, F, S, N, s0, s1, V), m, n, threads, (m,))))
 	print "Frobenius error: " + str(Obj)
 
-	logLike = logLike_admix(likeMatrix, Xhat, chunks, chunk_N) # Log-likelihood (ngsAdmix model)
+	logLike = logLike_admix(likeMatrix, Q, F, threads, layout, epsilon) # Log-likelihood (ngsAdmix model)
 	print "Log-likelihood: " + str(logLike)
 	return Q, F
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+Binary on-disk cache of parsed genotype likelihoods in the PCAngsd framework.
+Stores the filtered likelihood matrix, population allele frequencies and marker IDs
+in an aligned binary file that is memory-mapped in subsequent runs.
+"""
+
+__author__ = "Jonas Meisner"
+
+# Import libraries
+import numpy as np
+import hashlib
+import os
+from helpFunctions import likeDims
+
+# Cache file layout
+MAGIC = "PCANGSD1"
+ALIGN = 4096
+headerType = np.dtype([("magic", "S8"), ("n", "<i8"), ("m", "<i8"), ("dtype", "S8"), ("layout", "S8"), ("checksum", "S32"), ("key", "S32"), ("offF", "<i8"), ("offPos", "<i8"), ("lenPos", "<i8")])
+
+##### Functions #####
+# Align offset to page boundary
+def alignOffset(offset):
+	return ((offset + ALIGN - 1)//ALIGN)*ALIGN
+
+# MD5 checksum of input file
+def fileChecksum(path, bufsize=1<<24):
+	md5 = hashlib.md5()
+	with open(path, "rb") as fh:
+		buf = fh.read(bufsize)
+		while buf:
+			md5.update(buf)
+			buf = fh.read(bufsize)
+	return md5.hexdigest()
+
+# Cache file path and key from input checksum and filtering parameters
+def cachePath(cacheDir, beagle, n, minMaf, maf_iter, maf_tole, layout="standard"):
+	checksum = fileChecksum(beagle)
+	key = hashlib.md5("|".join(map(str, [checksum, n, minMaf, maf_iter, maf_tole, layout]))).hexdigest()
+	if not os.path.isdir(cacheDir):
+		os.makedirs(cacheDir)
+	tag = hashlib.md5(os.path.abspath(beagle) + "|" + key).hexdigest()[:12] # Separate files for inputs and filtering parameters
+	name = os.path.basename(beagle) + ".n" + str(n) + "." + tag + ".cache"
+	return os.path.join(cacheDir, name), checksum, key
+
+# Read header of cache file
+def readHeader(path):
+	with open(path, "rb") as fh:
+		header = np.fromfile(fh, dtype=headerType, count=1)
+	if header.shape[0] != 1 or header["magic"][0] != MAGIC:
+		return None
+	return header[0]
+
+# Memory-map cached likelihood matrix, return None if missing or stale
+def readCache(path, checksum, key):
+	if not os.path.isfile(path):
+		return None
+	header = readHeader(path)
+	if header is None:
+		print "Cache file is corrupt, rebuilding: " + path
+		return None
+	if (header["checksum"] != checksum) or (header["key"] != key):
+		print "Cache file is stale, rebuilding: " + path
+		return None
+	n, m = int(header["n"]), int(header["m"])
+	if os.path.getsize(path) < header["offPos"] + header["lenPos"]:
+		print "Cache file is truncated, rebuilding: " + path
+		return None
+
+	# Memory-map arrays (copy-on-write to keep arrays writeable for numba)
+	layout = header["layout"]
+	if layout == "site":
+		shape = (m, 3*n)
+	elif (layout == "ind") or (layout == "quant"):
+		shape = (n, m, 3)
+	else:
+		shape = (3*n, m)
+	likeMatrix = np.memmap(path, dtype=header["dtype"], mode="c", offset=ALIGN, shape=shape)
+	f = np.array(np.memmap(path, dtype=np.float64, mode="r", offset=header["offF"], shape=(m,)))
+	with open(path, "rb") as fh:
+		fh.seek(header["offPos"])
+		pos = np.array(fh.read(header["lenPos"]).split("\n"), dtype=object)
+	if m == 0:
+		pos = np.empty(0, dtype=object)
+	return likeMatrix, f, pos, layout
+
+# Write cache file atomically
+def writeCache(path, likeMatrix, f, pos, checksum, key, layout="standard"):
+	n, m = likeDims(likeMatrix, layout)
+	posBytes = "\n".join(map(str, pos))
+	header = np.zeros(1, dtype=headerType)
+	header["magic"] = MAGIC
+	header["n"] = n
+	header["m"] = m
+	header["dtype"] = likeMatrix.dtype.name
+	header["layout"] = layout
+	header["checksum"] = checksum
+	header["key"] = key
+	header["offF"] = alignOffset(ALIGN + likeMatrix.nbytes)
+	header["offPos"] = alignOffset(header["offF"][0] + 8*m)
+	header["lenPos"] = len(posBytes)
+
+	tmpPath = path + ".tmp" + str(os.getpid())
+	with open(tmpPath, "wb") as fh:
+		header.tofile(fh)
+		fh.seek(ALIGN)
+		np.ascontiguousarray(likeMatrix).tofile(fh)
+		fh.seek(header["offF"][0])
+		np.ascontiguousarray(f, dtype=np.float64).tofile(fh)
+		fh.seek(header["offPos"][0])
+		fh.write(posBytes)
+	os.rename(tmpPath, path)
@@ -1,16 +1,20 @@
 """
 Call genotypes from posterior genotype probabilities using estimated individual allele frequencies as prior.
 Can be performed with and without taking inbreeding into account.
+Genotypes are called in blocks of sites and written as SNP-major PLINK files (.bed, .bim, .fam).
 """
 
 __author__ = "Jonas Meisner"
 
 # Import libraries
 import numpy as np
+import pandas as pd
 from numba import jit
-import threading
+from helpFunctions import *
+from reader import idChromPos
 
 ##### Functions #####
+# Called genotypes are counts of the allele of the estimated allele frequency (PLINK A1) and 3 is missing
 # Genotype calling without inbreeding
 @jit("void(f4[:, :], f4[:, :], f8, i8, i8, u1[:, :])", nopython=True, nogil=True, cache=True)
 def gProbGeno(likeMatrix, indF, delta, S, N, G):
@@ -30,7 +34,7 @@ def gProbGeno(likeMatrix, indF, delta, S, N, G):
 		for s in xrange(n):
 			geno = np.argmax(probMatrix[:, s])
 			if probMatrix[geno, s] < delta:
-				G[ind, s] = 9
+				G[ind, s] = 3
 			else:
 				G[ind, s] = geno
 
@@ -46,42 +50,206 @@ def gProbGenoInbreeding(likeMatrix, indF, F, delta, S, N, G):
 		for s in xrange(n):
 			probMatrix[0, s] = likeMatrix[3*ind, s]*((1 - indF[ind, s])*(1 - indF[ind, s]) + indF[ind, s]*(1 - indF[ind, s])*F[ind])
 			probMatrix[1, s] = likeMatrix[3*ind+1, s]*(2*indF[ind, s]*(1 - indF[ind, s])*(1 - F[ind]))
-			probMatrix[2, s] = likeMatrix[3*ind+2, s]*(indF[ind, s]*indF[ind, s] + indF[ind, S]*(1 - indF[ind, S])*F[ind])
+			probMatrix[2, s] = likeMatrix[3*ind+2, s]*(indF[ind, s]*indF[ind, s] + indF[ind, s]*(1 - indF[ind, s])*F[ind])
 		probMatrix /= np.sum(probMatrix, axis=0)
 
 		# Find genotypes with highest probability
 		for s in xrange(n):
 			geno = np.argmax(probMatrix[:, s])
 			if probMatrix[geno, s] < delta:
-				G[ind, s] = 9
+				G[ind, s] = 3
 			else:
 				G[ind, s] = geno
 
+# Genotype calling without inbreeding (individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], f8, i8, i8, u1[:, :])", nopython=True, nogil=True, cache=True)
+def gProbGeno_ind(likeInd, indF, delta, S, N, G):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+	prob = np.empty(3)
 
-##### Genotype calling #####
-def callGeno(likeMatrix, indF, F=None, delta=0.0, threads=1):
-	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
-	chunk_N = int(np.ceil(float(m)/threads))
-	chunks = [i * chunk_N for i in xrange(threads)]
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = likeInd[ind, s, 0]*((1 - indF[ind, s])*(1 - indF[ind, s]))
+			prob[1] = likeInd[ind, s, 1]*(2*indF[ind, s]*(1 - indF[ind, s]))
+			prob[2] = likeInd[ind, s, 2]*(indF[ind, s]*indF[ind, s])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
+
+# Genotype calling with inbreeding (individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], f4[:], f8, i8, i8, u1[:, :])", nopython=True, nogil=True, cache=True)
+def gProbGenoInbreeding_ind(likeInd, indF, F, delta, S, N, G):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+	prob = np.empty(3)
 
-	# Initiate genotype matrix
-	G = np.empty((m, n), dtype=np.uint8)
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = likeInd[ind, s, 0]*((1 - indF[ind, s])*(1 - indF[ind, s]) + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+			prob[1] = likeInd[ind, s, 1]*(2*indF[ind, s]*(1 - indF[ind, s])*(1 - F[ind]))
+			prob[2] = likeInd[ind, s, 2]*(indF[ind, s]*indF[ind, s] + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
 
-	# Call genotypes with highest posterior probabilities
+# Genotype calling without inbreeding (PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], f8, i8, i8, u1[:, :], f8)", nopython=True, nogil=True, cache=True)
+def gProbGeno_plink(G_in, indF, delta, S, N, G, epsilon):
+	m, n = G_in.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+	prob = np.empty(3)
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = table[G_in[ind, s], 0]*((1 - indF[ind, s])*(1 - indF[ind, s]))
+			prob[1] = table[G_in[ind, s], 1]*(2*indF[ind, s]*(1 - indF[ind, s]))
+			prob[2] = table[G_in[ind, s], 2]*(indF[ind, s]*indF[ind, s])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
+
+# Genotype calling with inbreeding (PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], f4[:], f8, i8, i8, u1[:, :], f8)", nopython=True, nogil=True, cache=True)
+def gProbGenoInbreeding_plink(G_in, indF, F, delta, S, N, G, epsilon):
+	m, n = G_in.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+	prob = np.empty(3)
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = table[G_in[ind, s], 0]*((1 - indF[ind, s])*(1 - indF[ind, s]) + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+			prob[1] = table[G_in[ind, s], 1]*(2*indF[ind, s]*(1 - indF[ind, s])*(1 - F[ind]))
+			prob[2] = table[G_in[ind, s], 2]*(indF[ind, s]*indF[ind, s] + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
+
+
+# Genotype calling without inbreeding (quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], f8, i8, i8, u1[:, :], f4[:])", "void(u2[:, :, :], f4[:, :], f8, i8, i8, u1[:, :], f4[:])"], nopython=True, nogil=True, cache=True)
+def gProbGeno_quant(Q, indF, delta, S, N, G, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+	prob = np.empty(3)
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = table[Q[ind, s, 0]]*((1 - indF[ind, s])*(1 - indF[ind, s]))
+			prob[1] = table[Q[ind, s, 1]]*(2*indF[ind, s]*(1 - indF[ind, s]))
+			prob[2] = table[Q[ind, s, 2]]*(indF[ind, s]*indF[ind, s])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
+
+# Genotype calling with inbreeding (quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], f4[:], f8, i8, i8, u1[:, :], f4[:])", "void(u2[:, :, :], f4[:, :], f4[:], f8, i8, i8, u1[:, :], f4[:])"], nopython=True, nogil=True, cache=True)
+def gProbGenoInbreeding_quant(Q, indF, F, delta, S, N, G, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+	prob = np.empty(3)
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			# Estimate posterior probabilities
+			prob[0] = table[Q[ind, s, 0]]*((1 - indF[ind, s])*(1 - indF[ind, s]) + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+			prob[1] = table[Q[ind, s, 1]]*(2*indF[ind, s]*(1 - indF[ind, s])*(1 - F[ind]))
+			prob[2] = table[Q[ind, s, 2]]*(indF[ind, s]*indF[ind, s] + indF[ind, s]*(1 - indF[ind, s])*F[ind])
+
+			# Find genotype with highest probability
+			geno = np.argmax(prob)
+			if prob[geno]/(prob[0] + prob[1] + prob[2]) < delta:
+				G[ind, s] = 3
+			else:
+				G[ind, s] = geno
+
+
+# Encode block of called genotypes (m, nB) as SNP-major PLINK bytes (nB, (m+3)//4)
+@jit("void(u1[:, :], i8, i8, u1[:, :])", nopython=True, nogil=True, cache=True)
+def encodeBed(G, S, N, B):
+	m, n = G.shape
+	codeMap = np.array([3, 2, 0, 1], dtype=np.uint8) # A1 counts to PLINK 2-bit codes
+	for s in xrange(S, min(S+N, n)):
+		for i in xrange(B.shape[1]):
+			B[s, i] = 0
+		for ind in xrange(m):
+			B[s, ind//4] |= codeMap[G[ind, s]] << (2*(ind % 4))
+
+
+##### Genotype calling #####
+# Call genotypes in blocks of sites, yields blocks of sites (b, bEnd, B) of SNP-major PLINK bytes
+# Individual allele frequencies (dense or factors) are processed in blocks of sites
+def callGeno(likeMatrix, indF, F=None, delta=0.0, threads=1, layout="standard", epsilon=0.0, blockMem=64):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		genoKernel = lambda L, X, d, S, N, G: gProbGeno_quant(L, X, d, S, N, G, table)
+		genoInbreedKernel = lambda L, X, F, d, S, N, G: gProbGenoInbreeding_quant(L, X, F, d, S, N, G, table)
+	elif layout == "plink":
+		genoKernel = lambda L, X, d, S, N, G: gProbGeno_plink(L, X, d, S, N, G, epsilon)
+		genoInbreedKernel = lambda L, X, F, d, S, N, G: gProbGenoInbreeding_plink(L, X, F, d, S, N, G, epsilon)
+	elif layout == "ind":
+		genoKernel, genoInbreedKernel = gProbGeno_ind, gProbGenoInbreeding_ind
+	else:
+		genoKernel, genoInbreedKernel = gProbGeno, gProbGenoInbreeding
 	if type(F) != type(None):
-		# Multithreading
-		threads = [threading.Thread(target=gProbGenoInbreeding, args=(likeMatrix, indF, F, delta, chunk, chunk_N, G)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
+		F = np.asarray(F, dtype=np.float32)
+		kernel = lambda L, X, S, N, G: genoInbreedKernel(L, X, F[S:S+N], delta, 0, N, G)
 	else:
-		# Multithreading
-		threads = [threading.Thread(target=gProbGeno, args=(likeMatrix, indF, delta, chunk, chunk_N, G)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
-
-	return G
\ No newline at end of file
+		kernel = lambda L, X, S, N, G: genoKernel(L, X, delta, 0, N, G)
+	blockSites = max(1, min(n, (blockMem<<20)//m))
+	GBuf = np.empty(m*blockSites, dtype=np.uint8) # Reusable buffer of blocks
+
+	for b in xrange(0, n, blockSites):
+		bEnd = min(b + blockSites, n)
+		G = GBuf[:m*(bEnd - b)].reshape(m, bEnd - b)
+		B = np.empty((bEnd - b, (m + 3)//4), dtype=np.uint8)
+
+		# Call genotypes with highest posterior probabilities - Multithreading
+		runTiles(lambda S, N, s0, s1: freqTile(lambda L, X, c, cEnd: kernel(L, X, S, N, G[S:S+N, c-b:cEnd-b]), likeMatrix, layout, indF, S, N, b + s0, b + s1), m, bEnd - b, threads)
+		runTiles(lambda S, N, s0, s1: encodeBed(G[:, s0:s1], 0, s1 - s0, B[s0:s1]), 1, bEnd - b, threads, splitInd=False)
+		yield b, bEnd, B
+
+# PLINK .bim of marker IDs (chromosome_position) and Beagle alleles (allele1, allele2)
+# Allele2 is the allele of the estimated allele frequency (A1), missing alleles are written as 0
+def markerBim(pos, alleles=None):
+	chrom, p = idChromPos(pos)
+	chrom[chrom == ""] = "0"
+	if alleles is None:
+		alleles = np.full((pos.shape[0], 2), "0", dtype=object)
+	return pd.DataFrame({0: chrom, 1: pos, 2: 0, 3: np.maximum(p, 0), 4: alleles[:, 1], 5: alleles[:, 0]}, columns=range(6))
+
+# PLINK .fam of sample names (used as family and individual IDs)
+def sampleFam(names):
+	return pd.DataFrame({0: names, 1: names, 2: 0, 3: 0, 4: 0, 5: -9}, columns=range(6))
+
+# Write blocks of SNP-major PLINK bytes with rows of .bim and .fam as PLINK files (.bed, .bim, .fam), returns number of sites
+def writePlink(blocks, prefix, bim, fam):
+	with open(str(prefix) + ".bed", "wb") as fh:
+		fh.write(bytearray([0x6c, 0x1b, 0x01])) # Magic number and SNP-major mode
+		for b, bEnd, B in blocks:
+			B.tofile(fh)
+	bim.to_csv(str(prefix) + ".bim", sep="\t", header=False, index=False)
+	fam.to_csv(str(prefix) + ".fam", sep="\t", header=False, index=False)
+	return bim.shape[0]
@@ -0,0 +1,97 @@
+"""
+Checkpoints of long runs in the PCAngsd framework.
+State of each stage (population allele frequencies, PCAngsd iterations and admixture) is written
+atomically to its own file, from which an interrupted run is resumed or a new run is warm-started.
+"""
+
+__author__ = "Jonas Meisner"
+
+# Import libraries
+import numpy as np
+import pandas as pd
+import os
+import hashlib
+from reader import indfMagic, indfType
+
+##### Functions #####
+# Checkpoint file of stage for output prefix
+def checkpointPath(prefix, stage):
+	return str(prefix) + "." + stage + ".ckpt.npz"
+
+# Key of checkpoint from input checksums and parameters of stage
+def checkpointKey(*params):
+	return hashlib.md5("|".join(map(str, params))).hexdigest()
+
+# Write checkpoint atomically, entries of None are skipped
+def writeCheckpoint(path, **state):
+	state = dict((key, value) for key, value in state.items() if value is not None)
+	tmpPath = path + ".tmp" + str(os.getpid())
+	with open(tmpPath, "wb") as fh:
+		np.savez(fh, **state)
+	os.rename(tmpPath, path)
+
+# Read checkpoint of data with m individuals and n sites, return None if missing or not matching
+# Checkpoint must have been written with the same key (inputs and parameters of stage)
+def readCheckpoint(path, m, n, key):
+	if not os.path.isfile(path):
+		return None
+	try:
+		with np.load(path) as data:
+			state = dict((key, data[key]) for key in data.files)
+	except Exception:
+		print "Checkpoint file is corrupt, starting from scratch: " + path
+		return None
+	if (int(state["m"]) != m) or (int(state["n"]) != n):
+		print "Checkpoint file does not match input, starting from scratch: " + path
+		return None
+	if ("key" not in state) or (str(state["key"]) != key):
+		print "Checkpoint file was written with other input or parameters, starting from scratch: " + path
+		return None
+	print "Resuming from checkpoint " + path
+	return state
+
+# Function saving state and fixed entries to checkpoint at least every given number of iterations and when final
+# Returns None if checkpointing is disabled
+def checkpointer(path, every, m, n, key, **fixed):
+	if every <= 0:
+		return None
+	lastSaved = [0]
+
+	def save(iteration, final=False, **state):
+		if (iteration - lastSaved[0] >= every) or final:
+			state.update(fixed)
+			writeCheckpoint(path, m=m, n=n, key=key, iteration=iteration, final=final, **state)
+			lastSaved[0] = iteration
+	return save
+
+# State of global random number generator as checkpoint entries
+def rngState():
+	name, keys, pos, hasGauss, cachedGaussian = np.random.get_state()
+	return {"rngKeys": keys, "rngPos": pos, "rngGauss": hasGauss, "rngCached": cachedGaussian}
+
+# Restore global random number generator from checkpoint entries
+def setRngState(state):
+	np.random.set_state(("MT19937", state["rngKeys"], int(state["rngPos"]), int(state["rngGauss"]), float(state["rngCached"])))
+
+# Factors (W, H) of a previous run for warm start (PCAngsd checkpoint or factorized individual allele frequencies)
+# Columns of H are matched to sites by marker IDs stored in checkpoint, sites of new run not in previous run are NaN
+# H is None if marker IDs are not available
+def readWarmStart(path, m, pos):
+	H = None
+	if path.endswith(".npz"):
+		with np.load(path) as data:
+			W = data["W"]
+			if "sites" in data.files:
+				index = pd.Index(data["sites"]).get_indexer(np.asarray(pos, dtype=str))
+				H = np.full((W.shape[1], index.shape[0]), np.nan)
+				H[:, index >= 0] = data["H"][:, index[index >= 0]]
+				print "Warm start from " + str(np.sum(index >= 0)) + " of " + str(index.shape[0]) + " sites of previous run"
+	else:
+		with open(path, "rb") as fh:
+			header = np.fromfile(fh, dtype=indfType, count=1)
+			assert (header.shape[0] == 1) and (header["magic"][0] == indfMagic), "Warm start requires a PCAngsd checkpoint or factorized individual allele frequencies!"
+			header = header[0]
+			fh.seek(8*int(header["n"]), 1)
+			W = np.fromfile(fh, dtype=np.float64, count=int(header["m"])*int(header["e"])).reshape(int(header["m"]), int(header["e"]))
+	assert W.shape[0] == m, "Number of individuals of warm start does not match input! (" + str(W.shape[0]) + ")"
+	return W, H
@@ -9,8 +9,10 @@ __author__ = "Jonas Meisner"
 import numpy as np
 from numba import jit
 from scipy.sparse.linalg import svds, eigsh
-import threading
-from math import sqrt
+from scipy.linalg import get_blas_funcs
+import os
+import time
+from math import sqrt, log
 from helpFunctions import *
 
 ##### Functions #####
@@ -53,7 +55,6 @@ def covFumagalli(likeMatrix, f, S, N, expG, diagC):
 		probMatrix /= np.sum(probMatrix, axis=0)
 
 		# Estimate genotype dosages and diagonal of GRM
-		diagC[ind] = 0.0
 		for s in xrange(n):
 			expG[ind, s] = 0.0
 			temp = 0.0
@@ -61,7 +62,6 @@ def covFumagalli(likeMatrix, f, S, N, expG, diagC):
 				expG[ind, s] += probMatrix[g, s]*g
 				temp += (g - 2*f[s])*(g - 2*f[s])*probMatrix[g, s]
 			diagC[ind] += temp/(2*f[s]*(1 - f[s]))
-		diagC[ind] /= n
 
 # Update posterior expectations of the genotypes (PCAngsd)
 @jit("void(f4[:, :], f4[:, :], i8, i8, f4[:, :])", nopython=True, nogil=True, cache=True)
@@ -101,7 +101,6 @@ def covPCAngsd(likeMatrix, indF, f, S, N, expG, diagC):
 		probMatrix /= np.sum(probMatrix, axis=0)
 
 		# Estimate genotype dosages and diagonal of GRM
-		diagC[ind] = 0.0
 		for s in xrange(n):
 			expG[ind, s] = 0.0
 			temp = 0.0
@@ -109,29 +108,244 @@ def covPCAngsd(likeMatrix, indF, f, S, N, expG, diagC):
 				expG[ind, s] += probMatrix[g, s]*g
 				temp += (g - 2*f[s])*(g - 2*f[s])*probMatrix[g, s]
 			diagC[ind] += temp/(2*f[s]*(1 - f[s]))
-		diagC[ind] /= n
+
+# Update posterior expectations of the genotypes (Fumagalli method, individual-major likelihoods)
+@jit("void(f4[:, :, :], f8[:], i8, i8, f4[:, :])", nopython=True, nogil=True, cache=True)
+def updateFumagalli_ind(likeInd, f, S, N, expG):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = likeInd[ind, s, 0]*(1 - f[s])*(1 - f[s])
+			p1 = likeInd[ind, s, 1]*2*f[s]*(1 - f[s])
+			p2 = likeInd[ind, s, 2]*f[s]*f[s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (Fumagalli method, individual-major likelihoods)
+@jit("void(f4[:, :, :], f8[:], i8, i8, f4[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def covFumagalli_ind(likeInd, f, S, N, expG, diagC):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = likeInd[ind, s, 0]*(1 - f[s])*(1 - f[s])
+			p1 = likeInd[ind, s, 1]*2*f[s]*(1 - f[s])
+			p2 = likeInd[ind, s, 2]*f[s]*f[s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Update posterior expectations of the genotypes (PCAngsd, individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], i8, i8, f4[:, :])", nopython=True, nogil=True, cache=True)
+def updatePCAngsd_ind(likeInd, indF, S, N, expG):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = likeInd[ind, s, 0]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = likeInd[ind, s, 1]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = likeInd[ind, s, 2]*indF[ind, s]*indF[ind, s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (PCAngsd, individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], f8[:], i8, i8, f4[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def covPCAngsd_ind(likeInd, indF, f, S, N, expG, diagC):
+	m, n, _ = likeInd.shape # Dimension of likelihood matrix
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = likeInd[ind, s, 0]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = likeInd[ind, s, 1]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = likeInd[ind, s, 2]*indF[ind, s]*indF[ind, s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Update posterior expectations of the genotypes (Fumagalli method, PLINK genotype codes)
+@jit("void(u1[:, :], f8[:], i8, i8, f4[:, :], f8)", nopython=True, nogil=True, cache=True)
+def updateFumagalli_plink(G, f, S, N, expG, epsilon):
+	m, n = G.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[G[ind, s], 0]*(1 - f[s])*(1 - f[s])
+			p1 = table[G[ind, s], 1]*2*f[s]*(1 - f[s])
+			p2 = table[G[ind, s], 2]*f[s]*f[s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (Fumagalli method, PLINK genotype codes)
+@jit("void(u1[:, :], f8[:], i8, i8, f4[:, :], f8[:], f8)", nopython=True, nogil=True, cache=True)
+def covFumagalli_plink(G, f, S, N, expG, diagC, epsilon):
+	m, n = G.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[G[ind, s], 0]*(1 - f[s])*(1 - f[s])
+			p1 = table[G[ind, s], 1]*2*f[s]*(1 - f[s])
+			p2 = table[G[ind, s], 2]*f[s]*f[s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Update posterior expectations of the genotypes (PCAngsd, PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], i8, i8, f4[:, :], f8)", nopython=True, nogil=True, cache=True)
+def updatePCAngsd_plink(G, indF, S, N, expG, epsilon):
+	m, n = G.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[G[ind, s], 0]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = table[G[ind, s], 1]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = table[G[ind, s], 2]*indF[ind, s]*indF[ind, s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (PCAngsd, PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], f8[:], i8, i8, f4[:, :], f8[:], f8)", nopython=True, nogil=True, cache=True)
+def covPCAngsd_plink(G, indF, f, S, N, expG, diagC, epsilon):
+	m, n = G.shape # Dimension of genotype matrix
+	table = plinkTable(epsilon)
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[G[ind, s], 0]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = table[G[ind, s], 1]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = table[G[ind, s], 2]*indF[ind, s]*indF[ind, s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Update posterior expectations of the genotypes (Fumagalli method, quantized likelihoods)
+@jit(["void(u1[:, :, :], f8[:], i8, i8, f4[:, :], f4[:])", "void(u2[:, :, :], f8[:], i8, i8, f4[:, :], f4[:])"], nopython=True, nogil=True, cache=True)
+def updateFumagalli_quant(Q, f, S, N, expG, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[Q[ind, s, 0]]*(1 - f[s])*(1 - f[s])
+			p1 = table[Q[ind, s, 1]]*2*f[s]*(1 - f[s])
+			p2 = table[Q[ind, s, 2]]*f[s]*f[s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (Fumagalli method, quantized likelihoods)
+@jit(["void(u1[:, :, :], f8[:], i8, i8, f4[:, :], f8[:], f4[:])", "void(u2[:, :, :], f8[:], i8, i8, f4[:, :], f8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def covFumagalli_quant(Q, f, S, N, expG, diagC, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[Q[ind, s, 0]]*(1 - f[s])*(1 - f[s])
+			p1 = table[Q[ind, s, 1]]*2*f[s]*(1 - f[s])
+			p2 = table[Q[ind, s, 2]]*f[s]*f[s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Update posterior expectations of the genotypes (PCAngsd, quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], i8, i8, f4[:, :], f4[:])", "void(u2[:, :, :], f4[:, :], i8, i8, f4[:, :], f4[:])"], nopython=True, nogil=True, cache=True)
+def updatePCAngsd_quant(Q, indF, S, N, expG, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+
+	# Loop over individuals
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[Q[ind, s, 0]]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = table[Q[ind, s, 1]]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = table[Q[ind, s, 2]]*indF[ind, s]*indF[ind, s]
+			expG[ind, s] = (p1 + 2*p2)/(p0 + p1 + p2)
+
+# Estimate posterior expecations of the genotypes and covariance matrix diagonal (PCAngsd, quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], f8[:], i8, i8, f4[:, :], f8[:], f4[:])", "void(u2[:, :, :], f4[:, :], f8[:], i8, i8, f4[:, :], f8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def covPCAngsd_quant(Q, indF, f, S, N, expG, diagC, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+
+	for ind in xrange(S, min(S+N, m)):
+		for s in xrange(n):
+			p0 = table[Q[ind, s, 0]]*(1 - indF[ind, s])*(1 - indF[ind, s])
+			p1 = table[Q[ind, s, 1]]*2*indF[ind, s]*(1 - indF[ind, s])
+			p2 = table[Q[ind, s, 2]]*indF[ind, s]*indF[ind, s]
+			pSum = p0 + p1 + p2
+			expG[ind, s] = (p1 + 2*p2)/pSum
+			temp = (2*f[s])*(2*f[s])*p0 + (1 - 2*f[s])*(1 - 2*f[s])*p1 + (2 - 2*f[s])*(2 - 2*f[s])*p2
+			diagC[ind] += temp/(pSum*2*f[s]*(1 - f[s]))
+
+# Posterior kernels for each likelihood layout, diagonal of covariance matrix is accumulated as sums over sites (PLINK and quantized kernels bound to their likelihood tables)
+def layoutKernels(layout="standard", epsilon=0.0, dtype=np.float32):
+	if layout == "quant":
+		table = quantTable(dtype)
+		return (lambda Q, f, S, N, expG: updateFumagalli_quant(Q, f, S, N, expG, table),
+			lambda Q, f, S, N, expG, diagC: covFumagalli_quant(Q, f, S, N, expG, diagC, table),
+			lambda Q, indF, S, N, expG: updatePCAngsd_quant(Q, indF, S, N, expG, table),
+			lambda Q, indF, f, S, N, expG, diagC: covPCAngsd_quant(Q, indF, f, S, N, expG, diagC, table))
+	elif layout == "plink":
+		return (lambda G, f, S, N, expG: updateFumagalli_plink(G, f, S, N, expG, epsilon),
+			lambda G, f, S, N, expG, diagC: covFumagalli_plink(G, f, S, N, expG, diagC, epsilon),
+			lambda G, indF, S, N, expG: updatePCAngsd_plink(G, indF, S, N, expG, epsilon),
+			lambda G, indF, f, S, N, expG, diagC: covPCAngsd_plink(G, indF, f, S, N, expG, diagC, epsilon))
+	elif layout == "ind":
+		return updateFumagalli_ind, covFumagalli_ind, updatePCAngsd_ind, covPCAngsd_ind
+	return updateFumagalli, covFumagalli, updatePCAngsd, covPCAngsd
 
 # Normalize the posterior expectations of the genotypes
-@jit("void(f4[:, :], f8[:], i8, i8, f8[:, :])", nopython=True, nogil=True, cache=True)
+@jit(["void(f4[:, :], f8[:], i8, i8, f8[:, :])", "void(f4[:, :], f8[:], i8, i8, f4[:, :])"], nopython=True, nogil=True, cache=True)
 def normalizeGeno(expG, f, S, N, X):
 	m, n = expG.shape
 	for ind in xrange(S, min(S+N, m)):
 		for s in xrange(n):
 			X[ind, s] = (expG[ind, s] - 2*f[s])/sqrt(2*f[s]*(1 - f[s]))
 
-# Estimate covariance matrix
-def estimateCov(expG, diagC, f, chunks, chunk_N):
+# Accumulate X*X^T into upper triangle of C using BLAS syrk (C-ordered X is passed transposed to avoid copies)
+def syrkUpdate(C, X):
+	syrk = get_blas_funcs("syrk", (C, X))
+	return syrk(1.0, X.T, beta=1.0, c=C, trans=1, overwrite_c=1)
+
+# Full symmetric matrix from upper triangle
+def symmetrize(C):
+	return np.triu(C) + np.triu(C, 1).T
+
+# Accumulate upper triangle of F-ordered C with normalized genotype dosages of sites s0 to s1 in blocks of sites
+def accumulateCov(C, expG, f, s0, s1, threads=1, blockMem=64):
+	m = expG.shape[0]
+	blockSites = max(1, min(s1 - s0, (blockMem<<20)//(C.dtype.itemsize*m)))
+	Xbuf = np.empty(m*blockSites, dtype=C.dtype) # Reusable buffer of normalized block
+
+	for b in xrange(s0, s1, blockSites):
+		bEnd = min(b + blockSites, s1)
+		X = Xbuf[:m*(bEnd - b)].reshape(m, bEnd - b)
+
+		# Multithreading
+		runTiles(lambda S, N, t0, t1: normalizeGeno(expG[:, b+t0:b+t1], f[b+t0:b+t1], S, N, X[:, t0:t1]), m, bEnd - b, threads)
+		C = syrkUpdate(C, X)
+	return C
+
+# Estimate covariance matrix, normalized genotype dosages are accumulated in blocks of sites
+# Accumulation in float32 (dtype) halves memory and time of the buffer and BLAS update
+# Worker processes accumulate partial covariance matrices of their shards of sites (transposed views) reduced in parent
+def estimateCov(expG, diagC, f, threads=1, dtype=np.float64, blockMem=64):
 	m, n = expG.shape
-	X = np.zeros((m, n))
+	if poolProcs[0] > 1:
+		parts = sharedArray((poolProcs[0], m, m), dtype)
+		procMap(lambda w, tile: accumulateCov(parts[w].T, expG, f, tile[2], tile[3], 1, blockMem), siteShards(m, n, poolProcs[0]), poolProcs[0])
+		C = np.sum(parts, axis=0).T
+	else:
+		C = accumulateCov(np.zeros((m, m), dtype=dtype, order="F"), expG, f, 0, n, threads, blockMem)
 
-	# Multithreading
-	threads = [threading.Thread(target=normalizeGeno, args=(expG, f, chunk, chunk_N, X)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
-	
-	C = np.dot(X, X.T)/n
+	C = symmetrize(C).astype(np.float64)/n
 	np.fill_diagonal(C, diagC)
 	return C
 
@@ -143,148 +357,566 @@ def expGcenter(expG, f, S, N):
 		for s in xrange(n):
 			expG[ind, s] = expG[ind, s] - 2*f[s]
 
-# Add intercept to reconstructed allele frequencies
-@jit("void(f4[:, :], f8[:], i8, i8)", nopython=True, nogil=True, cache=True)
-def addIntercept(indF, f, S, N):
-	m, n = indF.shape
-	for ind in xrange(S, min(S+N, m)):
-		for s in xrange(n):
-			indF[ind, s] += 2*f[s]
-			indF[ind, s] /= 2
-			indF[ind, s] = max(indF[ind, s], 1e-4)
-			indF[ind, s] = min(indF[ind, s], 1-(1e-4))
+# Truncated SVD of rank e using ARPACK (Scipy library)
+def svdArpack(A, e, V0=None):
+	U, s, Vt = svds(A, k=e)
+	return U, s, Vt, None
+
+# Truncated SVD of rank e using blocked randomized range finder with power iterations (multithreaded BLAS)
+# Warm-started from right singular vectors V0 of previous iteration, which are returned for the next
+# Power iterations stop when the top e singular values are stable
+def svdRandomized(A, e, V0=None, oversample=10, power=4, tole=1e-6):
+	m, n = A.shape
+	k = min(e + oversample, m, n)
+	if (V0 is None) or (V0.shape[0] != k):
+		V0 = np.random.RandomState(0).normal(size=(k, n)).astype(np.float32)
+	Q, _ = np.linalg.qr(np.dot(A, V0.T))
+	sPrev = np.zeros(e)
+	for p in xrange(power):
+		W, _ = np.linalg.qr(np.dot(Q.T, A).T)
+		Q, R = np.linalg.qr(np.dot(A, W))
+		sR = np.linalg.svd(R, compute_uv=False)[:e]
+		if np.max(np.abs(sR - sPrev)) < tole*sR[0]:
+			break
+		sPrev = sR
+	B = np.dot(Q.T, A)
+	Ub, s, Vt = np.linalg.svd(B, full_matrices=False)
+	U = np.dot(Q, Ub)
+	return U[:, :e], s[:e], Vt[:e], Vt
 
-# Estimate individual allele frequencies
-def estimateF(expG, f, e, chunks, chunk_N):
+# Available SVD engines for estimation of individual allele frequencies
+svdEngines = {"arpack": svdArpack, "randomized": svdRandomized}
+
+# Estimate rank e factors (W, H) of centered individual allele frequencies, returns state of SVD engine for warm start of next iteration
+def estimateFactors(expG, f, e, threads=1, svd="arpack", V0=None):
 	m, n = expG.shape
 
 	# Multithreading - Centering genotype dosages
-	threads = [threading.Thread(target=expGcenter, args=(expG, f, chunk, chunk_N)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
+	runTiles(lambda S, N, s0, s1: expGcenter(expG[:, s0:s1], f[s0:s1], S, N), m, n, threads)
+
+	# Reduced SVD of rank K
+	V, s, U, V0 = svdEngines[svd](expG, e, V0)
+	return V*s, U, V0
 
-	# Reduced SVD of rank K (Scipy library)
-	V, s, U = svds(expG, k=e)
-	F = np.dot(V*s, U)
+# Reconstruct individual allele frequencies from factors
+def factorsF(W, H, f, threads=1):
+	F = np.dot(W, H).astype(np.float32, copy=False)
+	m, n = F.shape
 
 	# Multithreading - Adding intercept and clipping
-	threads = [threading.Thread(target=addIntercept, args=(F, f, chunk, chunk_N)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
+	runTiles(lambda S, N, s0, s1: addIntercept(F[:, s0:s1], f[s0:s1], S, N), m, n, threads)
 
 	return F
 
+# Estimate individual allele frequencies, returns state of SVD engine for warm start of next iteration
+def estimateF(expG, f, e, threads=1, svd="arpack", V0=None):
+	W, H, V0 = estimateFactors(expG, f, e, threads, svd, V0)
+	return factorsF(W, H, f, threads), V0
+
+# Factors of centered individual allele frequencies from factors (W, H) of a previous run (warm start)
+# Loadings at sites missing in H (NaN or H is None) are least squares projections of centered genotype dosages onto W
+def warmFactors(expG, f, W, H=None, threads=1):
+	m, n = expG.shape
+
+	# Multithreading - Centering genotype dosages
+	runTiles(lambda S, N, s0, s1: expGcenter(expG[:, s0:s1], f[s0:s1], S, N), m, n, threads)
+
+	if H is None:
+		H = np.full((W.shape[1], n), np.nan)
+	missing = np.isnan(H[0])
+	H = np.array(H)
+	if np.any(missing):
+		H[:, missing] = np.linalg.solve(np.dot(W.T, W), np.dot(W.T.astype(np.float32), expG[:, missing]).astype(np.float64))
+	return W, H
+
+# Run posterior kernel on tile with individual allele frequencies (dense or factors) in blocks of sites
+def posteriorTile(kernel, likeMatrix, layout, indf, f, S, N, s0, s1, expG, diagC=None):
+	if diagC is None:
+		freqTile(lambda L, X, b, bEnd: kernel(L, X, 0, X.shape[0], expG[S:S+X.shape[0], b:bEnd]), likeMatrix, layout, indf, S, N, s0, s1)
+	else:
+		freqTile(lambda L, X, b, bEnd: kernel(L, X, f[b:bEnd], 0, X.shape[0], expG[S:S+X.shape[0], b:bEnd], diagC[S:S+X.shape[0]]), likeMatrix, layout, indf, S, N, s0, s1)
+
+# Genotype dosages of blocks of sites (b, bEnd, expG, diagC) recomputed from likelihoods by the kernel of the final pass
+# Individual allele frequencies are dense or factors, population allele frequencies are used if indf is None (Fumagalli)
+# Buffer of genotype dosages is reused between blocks
+def dosageBlocks(likeMatrix, indf, f, layout="standard", epsilon=0.0, threads=1, blockMem=64):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	covFumagalli, covPCAngsd = layoutKernels(layout, epsilon, likeMatrix.dtype)[1::2]
+	blockSites = max(1, min(n, (blockMem<<20)//(12*m)))
+	expGbuf = np.empty(m*blockSites, dtype=np.float32)
+
+	for b in xrange(0, n, blockSites):
+		bEnd = min(b + blockSites, n)
+		expG = expGbuf[:m*(bEnd - b)].reshape(m, bEnd - b)
+
+		# Multithreading
+		if indf is None:
+			diagC = reduceTiles(lambda S, N, s0, s1, diagC: covFumagalli(siteSlice(likeMatrix, layout, b+s0, b+s1), f[b+s0:b+s1], S, N, expG[:, s0:s1], diagC), m, bEnd - b, threads, (m,))
+		else:
+			diagC = reduceTiles(lambda S, N, s0, s1, diagC: freqTile(lambda L, X, c, cEnd: covPCAngsd(L, X, f[c:cEnd], 0, X.shape[0], expG[S:S+X.shape[0], c-b:cEnd-b], diagC[S:S+X.shape[0]]), likeMatrix, layout, indf, S, N, b+s0, b+s1), m, bEnd - b, threads, (m,))
+		yield b, bEnd, expG, diagC
+
+# Estimate covariance matrix from genotype dosages recomputed in blocks of sites
+def streamCov(likeMatrix, indf, f, layout="standard", epsilon=0.0, threads=1, dtype=np.float64):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	C = np.zeros((m, m), dtype=dtype, order="F")
+	diagC = np.zeros(m)
+	for b, bEnd, expG, diagBlock in dosageBlocks(likeMatrix, indf, f, layout, epsilon, threads):
+		diagC += diagBlock
+		C = accumulateCov(C, expG, f[b:bEnd], 0, bEnd - b, threads)
+	C = symmetrize(C).astype(np.float64)/n
+	np.fill_diagonal(C, diagC/n)
+	return C
+
+# RMSD between individual allele frequencies of two sets of factors
+def factorsRMSD(W, H, prevW, prevH, f, threads=1):
+	m, n = W.shape[0], H.shape[1]
+
+	def kernel(S, N, s0, s1, V):
+		for b, bEnd, X in freqBlocks((f, W, H), S, N, s0, s1):
+			rmse2d_inner_float32(X, freqBlock((f, prevW, prevH), slice(b, bEnd), S, X.shape[0]), 0, X.shape[0], V[S:S+X.shape[0]])
+
+	# Multithreading
+	sumA = reduceTiles(kernel, m, n, threads, (m,))
+	return sqrt(np.sum(sumA)/(m*n))
+
+
+# RMSD between individual allele frequencies of linear combinations of factors, sum(c*W*H), without intercept and clipping
+# Computed as ||R*H|| from QR decomposition of stacked loadings to avoid cancellation of nearly equal terms
+def factorsDist(terms, m, n, blockSites=65536):
+	R = np.linalg.qr(np.hstack([c*Wi.astype(np.float64) for c, Wi, Hi in terms]), mode="r")
+	H = np.vstack([Hi for c, Wi, Hi in terms])
+	sumSq = 0.0
+	for b in xrange(0, n, blockSites):
+		sumSq += np.sum(np.dot(R, H[:, b:min(b + blockSites, n)].astype(np.float64))**2)
+	return sqrt(sumSq/(4.0*m*n))
+
+# Single fixed-point update of PCAngsd (posterior genotype dosages and SVD) from factors
+def pcangsdStep(likeMatrix, layout, kernel, W, H, V0, f, e, expG, threads=1, svd="arpack"):
+	m, n = expG.shape
+
+	# Multithreading
+	runShards(lambda S, N, s0, s1: posteriorTile(kernel, likeMatrix, layout, (f, W, H), f, S, N, s0, s1, expG), m, n, threads)
+
+	# Estimate factors of individual allele frequencies
+	return estimateFactors(expG, f, e, threads, svd, V0)
+
+# SQUAREM accelerated PCAngsd iterations on factors (x0 -> x1 -> x2, extrapolation and stabilization step)
+# Extrapolated frequencies are kept as factors of rank 3e and step lengths are safeguarded by residuals
+# Iterations continue from checkpoint state if given and state is passed to checkpoint after each cycle
+# Iterations left after the SQUAREM cycles are plain iterations
+def accelPCAngsd(likeMatrix, layout, kernel, W, H, V0, f, e, M, M_tole, expG, threads=1, svd="arpack", stepFactor=4.0, state=None, checkpoint=None):
+	m, n = expG.shape
+	stepMax = 1.0
+	iteration = 1
+	plainIters = 1.0 # Equivalent number of plain iterations reaching same residuals
+	stepTime = 0.0
+	converged = False
+	if state is not None:
+		iteration = M + 1 if bool(state["final"]) else int(state["iteration"])
+		if "stepMax" in state:
+			stepMax, plainIters, stepTime = float(state["stepMax"]), float(state["plainIters"]), float(state["stepTime"])
+	while iteration + 3 <= M + 1:
+		t0 = time.time()
+		W1, H1, V0 = pcangsdStep(likeMatrix, layout, kernel, W, H, V0, f, e, expG, threads, svd)
+		W2, H2, V0 = pcangsdStep(likeMatrix, layout, kernel, W1, H1, V0, f, e, expG, threads, svd)
+		stepTime += time.time() - t0
+
+		# Step length from residuals r = x1 - x0 and v = x2 - 2*x1 + x0
+		r = factorsDist([(1.0, W1, H1), (-1.0, W, H)], m, n)
+		v = factorsDist([(1.0, W2, H2), (-2.0, W1, H1), (1.0, W, H)], m, n)
+		plainDiff = factorsDist([(1.0, W2, H2), (-1.0, W1, H1)], m, n)
+		alpha = -1.0
+		if v > 0:
+			alpha = max(-stepMax, min(-1.0, -r/v))
+
+		# Extrapolation x0 - 2*alpha*r + alpha^2*v as factors of rank 3e and stabilization step
+		Wa = np.hstack(((1 + alpha)*(1 + alpha)*W, -2*alpha*(1 + alpha)*W1, alpha*alpha*W2))
+		Ha = np.vstack((H, H1, H2))
+		t0 = time.time()
+		W3, H3, V0 = pcangsdStep(likeMatrix, layout, kernel, Wa, Ha, V0, f, e, expG, threads, svd)
+		stepTime += time.time() - t0
+		iteration += 3
+		accelDiff = factorsDist([(1.0, W3, H3), (-1.0, Wa, Ha)], m, n)
+
+		# Safeguard - fall back to x2 if extrapolation increases residual
+		if accelDiff > r:
+			print "Extrapolation rejected (step length=" + str(-alpha) + ")"
+			W, H = W2, H2
+			diff = factorsRMSD(W2, H2, W1, H1, f, threads)
+			stepMax = 1.0
+			plainIters += 2
+		else:
+			W, H = W3, H3
+			diff = factorsRMSD(W3, H3, Wa, Ha, f, threads)
+			if alpha == -stepMax:
+				stepMax *= stepFactor
+
+			# Plain iterations needed for same reduction of residual at observed convergence rate
+			rate = plainDiff/r if r > 0 else 0.0
+			if (0 < rate < 1) and (accelDiff > 0):
+				plainIters += 1 + max(2.0, log(accelDiff/r)/log(rate))
+			else:
+				plainIters += 3
+		print "Individual allele frequencies estimated (" + str(iteration) + "). RMSD=" + str(diff) + ", step length=" + str(-alpha)
+		converged = diff < M_tole
+		if converged:
+			print "Estimation of individual allele frequencies has converged."
+		if checkpoint is not None:
+			checkpoint(iteration, converged, e=e, W=W, H=H, V0=V0, oldDiff=np.nan, stepMax=stepMax, plainIters=plainIters, stepTime=stepTime)
+		if converged:
+			break
+
+	# Plain iterations for remaining E-steps
+	while (not converged) and (iteration <= M):
+		t0 = time.time()
+		W1, H1, V0 = pcangsdStep(likeMatrix, layout, kernel, W, H, V0, f, e, expG, threads, svd)
+		stepTime += time.time() - t0
+		iteration += 1
+		plainIters += 1
+		diff = factorsRMSD(W1, H1, W, H, f, threads)
+		W, H = W1, H1
+		print "Individual allele frequencies estimated (" + str(iteration) + "). RMSD=" + str(diff)
+		converged = diff < M_tole
+		if converged:
+			print "Estimation of individual allele frequencies has converged."
+		if checkpoint is not None:
+			checkpoint(iteration, converged, e=e, W=W, H=H, V0=V0, oldDiff=np.nan, stepMax=stepMax, plainIters=plainIters, stepTime=stepTime)
+
+	# Estimated savings compared to plain iterations
+	if iteration > 1:
+		plain = int(round(plainIters)) - 1 # Initial iteration is not an E-step
+		saved = plain - (iteration - 1)
+		print "Acceleration used " + str(iteration - 1) + " E-steps (estimated " + str(plain) + " without acceleration), saving ~" + str(saved) + " E-steps (~" + str(round(saved*stepTime/(iteration - 1), 1)) + " seconds)"
+	return W, H
+
+
+# Top k eigenpairs of symmetric matrix in descending order (negative eigenvalues set to zero)
+def topEigen(C, k=20):
+	k = max(1, min(k, C.shape[0] - 1))
+	eigVals, eigVecs = eigsh(C, k=k) # Eigendecomposition (Symmetric)
+	sort = np.argsort(eigVals)[::-1] # Sorting vector
+	eigVals = eigVals[sort] # Sorted eigenvalues
+	eigVals[eigVals < 0] = 0
+	return eigVals, eigVecs[:, sort]
+
+# Rank-1 downdate of upper triangle of partial covariance matrix by loading l and its MAP statistic
+# Average squared partial correlation of off-diagonal elements, -1 if any partial variance is not positive
+@jit("f8(f8[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def mapDowndate(P, l):
+	m = P.shape[0]
+	scale = np.empty(m)
+	valid = True
+	for i in xrange(m):
+		d = P[i, i] - l[i]*l[i]
+		if d > 0:
+			scale[i] = 1.0/sqrt(d)
+		else:
+			scale[i] = 0.0
+			valid = False
+	sumPr = 0.0
+	for i in xrange(m):
+		P[i, i] -= l[i]*l[i]
+		for j in xrange(i + 1, m):
+			P[i, j] -= l[i]*l[j]
+			pr = P[i, j]*scale[i]*scale[j]
+			sumPr += pr*pr
+	if not valid:
+		return -1.0
+	return 2*sumPr/(m*(m - 1))
+
+# Velicer's Minimum Average Partial (MAP) Test
+def mapTest(C, eigVals, eigVecs):
+	P = np.array(C, dtype=np.float64) # Partial covariance matrix (upper triangle)
+	loadings = eigVecs*np.sqrt(eigVals)
+	mapStat = np.zeros(eigVals.shape[0])
+
+	# Loop over eigenvalues with rank-1 downdates of partial covariance matrix
+	for eig in xrange(eigVals.shape[0]):
+		mapStat[eig] = mapDowndate(P, np.ascontiguousarray(loadings[:, eig]))
+		if mapStat[eig] < 0:
+			mapStat[eig] = 1
+
+	return max([1, np.argmin(mapStat) + 1]) # Number of principal components retained
+
+# Horn's parallel analysis with the Marchenko-Pastur upper edge as eigenvalue of random data of same dimensions
+def parallelAnalysis(C, eigVals, n):
+	m = C.shape[0]
+	edge = (np.trace(C)/m)*(1 + sqrt(float(m)/n))**2
+	return max([1, np.sum(eigVals > edge)]) # Number of principal components retained
+
+# Number of principal components from covariance matrix by MAP test or parallel analysis
+def selectPCs(C, n, method="map", maxPCs=20):
+	eigVals, eigVecs = topEigen(C, maxPCs)
+	if method == "pa":
+		e = parallelAnalysis(C, eigVals, n)
+		print "Using " + str(e) + " principal components (parallel analysis)"
+	else:
+		e = mapTest(C, eigVals, eigVecs)
+		print "Using " + str(e) + " principal components (MAP test)"
+	return e
+
 
 ##### PCAngsd #####
-def PCAngsd(likeMatrix, EVs, M, f, M_tole=5e-5, threads=1):
-	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
+# Individual allele frequencies are kept and returned as rank e factors (f, W, H) if factored
+# Iterations are accelerated by SQUAREM extrapolation of factors if accel
+# Covariance matrix is accumulated in precision of covDtype
+# Number of principal components is chosen by pcSelect ("map" or "pa") among at most maxPCs if EVs is 0
+# Iterations continue from checkpoint state if given, or start from factors warm = (W, H) of a previous run
+# State is passed to checkpoint(iteration, final, **state) after each iteration
+def PCAngsd(likeMatrix, EVs, M, f, M_tole=5e-5, threads=1, layout="standard", epsilon=0.0, svd="arpack", factored=False, accel=False, covDtype=np.float64, pcSelect="map", maxPCs=20, state=None, warm=None, checkpoint=None):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
 	e = EVs
-	chunk_N = int(np.ceil(float(m)/threads))
-	chunks = [i * chunk_N for i in xrange(threads)]
+	updateFumagalli, covFumagalli, updatePCAngsd, covPCAngsd = layoutKernels(layout, epsilon, likeMatrix.dtype)
 
 	# Initiate matrices
-	expG = np.zeros((m, n), dtype=np.float32)
-	diagC = np.zeros(m)
+	expG = sharedArray((m, n), np.float32)
+	start = 2
+	oldDiff = np.nan
+
+	# Continue from checkpoint
+	if state is not None:
+		e = int(state["e"])
+		print "Using " + str(e) + " principal components (checkpoint at iteration " + str(int(state["iteration"])) + ")"
+		W, H = state["W"], state["H"]
+		V0 = state["V0"] if "V0" in state else None
+		oldDiff = float(state["oldDiff"])
+		start = M + 2 if bool(state["final"]) else int(state["iteration"]) + 1
 
 	# Estimate covariance matrix (Fumagalli) and infer number of PCs
-	if EVs == 0:
+	elif (EVs == 0) and (warm is None):
 		# Multithreading
-		threads = [threading.Thread(target=covFumagalli, args=(likeMatrix, f, chunk, chunk_N, expG, diagC)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
+		diagC = reduceShards(lambda S, N, s0, s1, diagC: covFumagalli(siteSlice(likeMatrix, layout, s0, s1), f[s0:s1], S, N, expG[:, s0:s1], diagC), m, n, threads, (m,))/n
 
 		# Estimate covariance matrix (Fumagalli)
-		C = estimateCov(expG, diagC, f, chunks, chunk_N)
+		C = estimateCov(expG, diagC, f, threads, covDtype)
 		if M == 0:
 			print "Returning with ngsTools covariance matrix!"
 			return C, None, e, expG
 
-		# Velicer's Minimum Average Partial (MAP) Test 
-		eigVals, eigVecs = eigsh(C, k=20) # Eigendecomposition (Symmetric)
-		sort = np.argsort(eigVals)[::-1] # Sorting vector
-		eigVals = eigVals[sort] # Sorted eigenvalues
-		eigVals[eigVals < 0] = 0
-		eigVecs = eigVecs[:, sort] # Sorted eigenvectors
-		loadings = np.dot(eigVecs, np.diagflat(np.sqrt(eigVals)))
-		mapTest = np.zeros(eigVals.shape[0])
-
-		# Loop over m-1 eigenvalues for MAP test
-		for eig in xrange(eigVals.shape[0]):
-			partcov = C - (np.dot(loadings[:, 0:(eig + 1)], loadings[:, 0:(eig + 1)].T))
-			d = np.diag(partcov)
-
-			if (np.sum(np.isnan(d)) > 0) or (np.sum(d == 0) > 0) or (np.sum(d < 0) > 0):
-				mapTest[eig] = 1
-			else:
-				d = np.diagflat(1/np.sqrt(d))
-				pr = np.dot(d, np.dot(partcov, d))
-				mapTest[eig] = (np.sum(pr**2) - m)/(m*(m - 1))
-
-		e = max([1, np.argmin(mapTest) + 1]) # Number of principal components retained
-		print "Using " + str(e) + " principal components (MAP test)"
-		
-		# Release memory
-		del eigVals, eigVecs, loadings, partcov, mapTest
+		# Velicer's Minimum Average Partial (MAP) Test or parallel analysis
+		e = selectPCs(C, n, pcSelect, maxPCs)
 	
+	elif warm is not None:
+		e = warm[0].shape[1]
+		print "Using " + str(e) + " principal components (warm start)"
+
+		# Multithreading
+		runShards(lambda S, N, s0, s1: updateFumagalli(siteSlice(likeMatrix, layout, s0, s1), f[s0:s1], S, N, expG[:, s0:s1]), m, n, threads)
+
 	else:
 		print "Using " + str(e) + " principal components (manually selected)"
 		
 		# Multithreading
-		threads = [threading.Thread(target=updateFumagalli, args=(likeMatrix, f, chunk, chunk_N, expG)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
+		runShards(lambda S, N, s0, s1: updateFumagalli(siteSlice(likeMatrix, layout, s0, s1), f[s0:s1], S, N, expG[:, s0:s1]), m, n, threads)
 
 	# Estimate individual allele frequencies
-	predF = estimateF(expG, f, e, chunks, chunk_N)
-	prevF = np.copy(predF)
-	print "Individual allele frequencies estimated (1)"
+	if state is None:
+		if warm is not None:
+			W, H = warmFactors(expG, f, warm[0], warm[1], threads)
+			V0 = None
+		else:
+			W, H, V0 = estimateFactors(expG, f, e, threads, svd)
+		print "Individual allele frequencies estimated (1)"
+		if checkpoint is not None:
+			checkpoint(1, False, e=e, W=W, H=H, V0=V0, oldDiff=oldDiff)
+	if not (factored or accel):
+		predF = factorsF(W, H, f, threads)
+		prevF = np.copy(predF)
 	
 	# Iterative covariance estimation
-	for iteration in xrange(2, M+2):
-		# Multithreading
-		threads = [threading.Thread(target=updatePCAngsd, args=(likeMatrix, predF, chunk, chunk_N, expG)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
+	if accel:
+		W, H = accelPCAngsd(likeMatrix, layout, updatePCAngsd, W, H, V0, f, e, M, M_tole, expG, threads, svd, state=state, checkpoint=checkpoint)
+	for iteration in xrange(start, 2 if accel else M+2):
+		if factored:
+			# Multithreading
+			runShards(lambda S, N, s0, s1: posteriorTile(updatePCAngsd, likeMatrix, layout, (f, W, H), f, S, N, s0, s1, expG), m, n, threads)
+
+			# Estimate factors of individual allele frequencies
+			prevW, prevH = W, H
+			W, H, V0 = estimateFactors(expG, f, e, threads, svd, V0)
+
+			# Break iterative update if converged
+			diff = factorsRMSD(W, H, prevW, prevH, f, threads)
+		else:
+			# Multithreading
+			runShards(lambda S, N, s0, s1: updatePCAngsd(siteSlice(likeMatrix, layout, s0, s1), predF[:, s0:s1], S, N, expG[:, s0:s1]), m, n, threads)
 
-		# Estimate individual allele frequencies
-		predF = estimateF(expG, f, e, chunks, chunk_N)
+			# Estimate individual allele frequencies
+			W, H, V0 = estimateFactors(expG, f, e, threads, svd, V0)
+			predF = factorsF(W, H, f, threads)
 
-		# Break iterative update if converged
-		diff = rmse2d_multi_float32(predF, prevF, chunks, chunk_N)
+			# Break iterative update if converged
+			diff = rmse2d_multi_float32(predF, prevF, threads)
 		print "Individual allele frequencies estimated (" + str(iteration) + "). RMSD=" + str(diff)
+		converged = False
 		if diff < M_tole:
 			print "Estimation of individual allele frequencies has converged."
-			break
+			converged = True
+
 		# Second convergence criterion
-		if iteration == 2:
+		elif iteration == 2:
 			oldDiff = diff
+		elif abs(diff - oldDiff) <= 5e-6:
+			print "Estimation of individual allele frequencies has converged. Change in RMSD between iterations: " + str(abs(diff - oldDiff))
+			converged = True
 		else:
-			if abs(diff - oldDiff) <= 5e-6:
-				print "Estimation of individual allele frequencies has converged. Change in RMSD between iterations: " + str(abs(diff - oldDiff))
-				break
-			else:
-				oldDiff = diff
+			oldDiff = diff
 
-		prevF = np.copy(predF)
+		if checkpoint is not None:
+			checkpoint(iteration, converged, e=e, W=W, H=H, V0=V0, oldDiff=oldDiff)
+		if converged:
+			break
+
+		if not factored:
+			prevF = np.copy(predF)
 		
 	# Multithreading
-	threads = [threading.Thread(target=covPCAngsd, args=(likeMatrix, predF, f, chunk, chunk_N, expG, diagC)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
+	if factored or accel:
+		diagC = reduceShards(lambda S, N, s0, s1, diagC: posteriorTile(covPCAngsd, likeMatrix, layout, (f, W, H), f, S, N, s0, s1, expG, diagC), m, n, threads, (m,))/n
+		if factored:
+			predF = (f, W, H) # Lazily rebuilt by downstream analyses
+		else:
+			predF = factorsF(W, H, f, threads)
+	else:
+		del prevF
+		diagC = reduceShards(lambda S, N, s0, s1, diagC: covPCAngsd(siteSlice(likeMatrix, layout, s0, s1), predF[:, s0:s1], f[s0:s1], S, N, expG[:, s0:s1], diagC), m, n, threads, (m,))/n
 
 	# Estimate covariance matrix (PCAngsd)
-	C = estimateCov(expG, diagC, f, chunks, chunk_N)
-	return C, predF, e, expG
\ No newline at end of file
+	C = estimateCov(expG, diagC, f, threads, covDtype)
+	return C, predF, e, expG
+
+
+##### PCAngsd (out-of-core) #####
+# Top e eigenvectors of Gram matrix
+def gramVectors(G, e):
+	eigVals, eigVecs = np.linalg.eigh(G)
+	return eigVecs[:, np.argsort(eigVals)[::-1][:e]]
+
+# Projection matrix onto eigenvectors V (rank e reconstruction)
+def gramProjection(V):
+	return np.dot(V, V.T).astype(np.float32)
+
+# Projection matrix onto top e eigenvectors of Gram matrix (rank e reconstruction)
+def projectionGram(G, e):
+	return gramProjection(gramVectors(G, e))
+
+# Reconstruct individual allele frequencies of a block of sites from centered genotype dosages
+def reconstructF(P, Xc, f, threads=1):
+	F = np.dot(P, Xc)
+	m, n = F.shape
+
+	# Multithreading - Adding intercept and clipping
+	runTiles(lambda S, N, s0, s1: addIntercept(F[:, s0:s1], f[s0:s1], S, N), m, n, threads)
+
+	return F
+
+# Normalized genotype dosages of a block of sites
+def normalizeBlock(Xc, f):
+	return Xc/np.sqrt(2*f*(1 - f))
+
+# PCAngsd with memory-mapped likelihood matrix streamed in blocks of sites
+def PCAngsdOOC(likeMatrix, EVs, M, f, M_tole=5e-5, threads=1, tmpDir=".", blockMem=1024, pcSelect="map", maxPCs=20):
+	m, n = likeMatrix.shape # Dimension of likelihood matrix
+	m /= 3 # Number of individuals
+	e = EVs
+	blockSize = max(1, int(blockMem*(1<<20)/(72*m))) # Sites per block within memory budget (MB)
+	print "Out-of-core estimation in blocks of " + str(blockSize) + " sites"
+
+	# Disk-backed centered genotype dosages of current and previous iteration
+	expGdisk = [np.memmap(os.path.join(tmpDir, "expG." + str(i) + ".bin"), dtype=np.float32, mode="w+", shape=(m, n)) for i in xrange(2)]
+	diagC = np.zeros(m)
+	G = np.zeros((m, m)) # Gram matrix of centered genotype dosages
+	C = np.zeros((m, m), order="F")
+
+	# Genotype dosages and covariance matrix (Fumagalli)
+	for b, likeBlock in prefetchBlocks(likeMatrix, blockSize):
+		bEnd = b + likeBlock.shape[1]
+		fBlock = f[b:bEnd]
+		expG = np.empty((m, bEnd - b), dtype=np.float32)
+
+		# Multithreading
+		diagC += reduceTiles(lambda S, N, s0, s1, diagC: covFumagalli(likeBlock[:, s0:s1], fBlock[s0:s1], S, N, expG[:, s0:s1], diagC), m, bEnd - b, threads, (m,))
+		expG -= (2*fBlock).astype(np.float32)
+		G += np.dot(expG, expG.T)
+		if EVs == 0:
+			C = syrkUpdate(C, normalizeBlock(expG, fBlock))
+		expGdisk[0][:, b:bEnd] = expG
+	diagC /= n
+
+	if EVs == 0:
+		C = symmetrize(C)/n
+		np.fill_diagonal(C, diagC)
+		if M == 0:
+			print "Returning with ngsTools covariance matrix!"
+			for b in xrange(0, n, blockSize):
+				bEnd = min(b + blockSize, n)
+				expGdisk[0][:, b:bEnd] += (2*f[b:bEnd]).astype(np.float32)
+			return C, None, e, expGdisk[0]
+
+		# Velicer's Minimum Average Partial (MAP) Test or parallel analysis
+		e = selectPCs(C, n, pcSelect, maxPCs)
+	else:
+		print "Using " + str(e) + " principal components (manually selected)"
+	P = projectionGram(G, e)
+
+	# Iterative estimation, frequencies of iteration k are reconstructed from dosages of iteration k-1
+	for iteration in xrange(1, M+2):
+		curG, prevG = expGdisk[(iteration - 1) % 2], expGdisk[iteration % 2]
+		G = np.zeros((m, m))
+		diagC = np.zeros(m)
+		sumDiff = 0.0
+
+		for b, likeBlock in prefetchBlocks(likeMatrix, blockSize):
+			bEnd = b + likeBlock.shape[1]
+			fBlock = f[b:bEnd]
+			predF = reconstructF(P, curG[:, b:bEnd], fBlock, threads)
+			if iteration > 1:
+				prevF = reconstructF(prevP, prevG[:, b:bEnd], fBlock, threads)
+				sumDiff += np.sum((predF - prevF)**2, dtype=np.float64)
+			expG = np.empty((m, bEnd - b), dtype=np.float32)
+
+			# Multithreading
+			diagC += reduceTiles(lambda S, N, s0, s1, diagC: covPCAngsd(likeBlock[:, s0:s1], predF[:, s0:s1], fBlock[s0:s1], S, N, expG[:, s0:s1], diagC), m, bEnd - b, threads, (m,))
+			expG -= (2*fBlock).astype(np.float32)
+			G += np.dot(expG, expG.T)
+			prevG[:, b:bEnd] = expG
+		diagC /= n
+
+		# Break iterative update if converged
+		if iteration == 1:
+			print "Individual allele frequencies estimated (1)"
+		else:
+			diff = sqrt(sumDiff/(m*n))
+			print "Individual allele frequencies estimated (" + str(iteration) + "). RMSD=" + str(diff)
+			if diff < M_tole:
+				print "Estimation of individual allele frequencies has converged."
+				break
+			# Second convergence criterion
+			if iteration == 2:
+				oldDiff = diff
+			else:
+				if abs(diff - oldDiff) <= 5e-6:
+					print "Estimation of individual allele frequencies has converged. Change in RMSD between iterations: " + str(abs(diff - oldDiff))
+					break
+				else:
+					oldDiff = diff
+
+		if iteration < M+1:
+			prevP = P
+			P = projectionGram(G, e)
+
+	# Individual allele frequencies and covariance matrix (PCAngsd)
+	C = np.zeros((m, m), order="F")
+	indf = np.memmap(os.path.join(tmpDir, "indf.bin"), dtype=np.float32, mode="w+", shape=(m, n))
+	for b in xrange(0, n, blockSize):
+		bEnd = min(b + blockSize, n)
+		fBlock = f[b:bEnd]
+		indf[:, b:bEnd] = reconstructF(P, curG[:, b:bEnd], fBlock, threads)
+		expG = np.array(prevG[:, b:bEnd])
+		C = syrkUpdate(C, normalizeBlock(expG, fBlock))
+		prevG[:, b:bEnd] = expG + (2*fBlock).astype(np.float32)
+	C = symmetrize(C)/n
+	np.fill_diagonal(C, diagC)
+	del curG, expGdisk
+	return C, indf, e, prevG
@@ -4,6 +4,7 @@ and pre-computed allele frequencies (both sample average or individual).
 
 Both the maximum likelihood estimator and simple estimator of the inbreeding coefficients can be computed.
 The estimators can be selected by the model parameter (model=1 for MLE, model=2 for Simple).
+EM updates are accelerated by SQUAREM extrapolation and each individual is iterated until its own convergence.
 """
 
 __author__ = "Jonas Meisner"
@@ -13,97 +14,156 @@ from helpFunctions import *
 
 # Import libraries
 import numpy as np
-
+from numba import jit
+from numpy.lib.stride_tricks import as_strided
+
+##### Functions #####
+# Posterior expectations of a site given genotype likelihoods, allele frequency and inbreeding coefficient
+# MLE (model=1): posterior probability of IBD state
+# Simple (model=2): posterior probability of heterozygote and expected heterozygosity
+@jit("UniTuple(f8, 2)(f8, f8, f8, f8, f8, i8)", nopython=True, nogil=True, cache=True)
+def siteEM(l0, l1, l2, f, Fi, model):
+	if model == 1:
+		w0 = (l0*(1 - f)*(1 - f) + l1*2*f*(1 - f) + l2*f*f)*(1 - Fi)
+		w1 = (l0*(1 - f) + l2*f)*Fi
+		return w1/(w0 + w1), 0.0
+	p0 = l0*((1 - f)*(1 - f) + (1 - f)*f*Fi)
+	p1 = l1*2*(1 - f)*f*(1 - Fi)
+	p2 = l2*(f*f + (1 - f)*f*Fi)
+	return p1/(p0 + p1 + p2), 2*f*(1 - f)
+
+# Single EM sweep of active individuals in tile of likelihoods (3*N, n) and allele frequencies (N, n)
+# Posterior expectations are summed in T (individuals from S)
+@jit("void(f4[:, :], f4[:, :], i8, i8, f8[:], b1[:], f8[:, :])", nopython=True, nogil=True, cache=True)
+def emStep(likeMatrix, indF, S, model, F, active, T):
+	N, n = indF.shape
+	for i in xrange(N):
+		if active[S + i]:
+			t0, t1 = 0.0, 0.0
+			for s in xrange(n):
+				a, b = siteEM(likeMatrix[3*i, s], likeMatrix[3*i + 1, s], likeMatrix[3*i + 2, s], indF[i, s], F[S + i], model)
+				t0 += a
+				t1 += b
+			T[S + i, 0] += t0
+			T[S + i, 1] += t1
+
+# Single EM sweep of active individuals (individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], i8, i8, f8[:], b1[:], f8[:, :])", nopython=True, nogil=True, cache=True)
+def emStep_ind(likeInd, indF, S, model, F, active, T):
+	N, n = indF.shape
+	for i in xrange(N):
+		if active[S + i]:
+			t0, t1 = 0.0, 0.0
+			for s in xrange(n):
+				a, b = siteEM(likeInd[i, s, 0], likeInd[i, s, 1], likeInd[i, s, 2], indF[i, s], F[S + i], model)
+				t0 += a
+				t1 += b
+			T[S + i, 0] += t0
+			T[S + i, 1] += t1
+
+# Single EM sweep of active individuals (PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], i8, i8, f8[:], b1[:], f8[:, :], f8[:, :])", nopython=True, nogil=True, cache=True)
+def emStep_plink(G, indF, S, model, F, active, T, table):
+	N, n = indF.shape
+	for i in xrange(N):
+		if active[S + i]:
+			t0, t1 = 0.0, 0.0
+			for s in xrange(n):
+				a, b = siteEM(table[G[i, s], 0], table[G[i, s], 1], table[G[i, s], 2], indF[i, s], F[S + i], model)
+				t0 += a
+				t1 += b
+			T[S + i, 0] += t0
+			T[S + i, 1] += t1
+
+# Single EM sweep of active individuals (quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], i8, i8, f8[:], b1[:], f8[:, :], f4[:])", "void(u2[:, :, :], f4[:, :], i8, i8, f8[:], b1[:], f8[:, :], f4[:])"], nopython=True, nogil=True, cache=True)
+def emStep_quant(Q, indF, S, model, F, active, T, table):
+	N, n = indF.shape
+	for i in xrange(N):
+		if active[S + i]:
+			t0, t1 = 0.0, 0.0
+			for s in xrange(n):
+				a, b = siteEM(table[Q[i, s, 0]], table[Q[i, s, 1]], table[Q[i, s, 2]], indF[i, s], F[S + i], model)
+				t0 += a
+				t1 += b
+			T[S + i, 0] += t0
+			T[S + i, 1] += t1
 
 # EM algorithm for estimation of inbreeding coefficients
-def inbreedEM(likeMatrix, f, model=1, EM=200, EM_tole=1e-4):
-	m, n = likeMatrix.shape # Dimension of genotype likelihood matrix
-	m /= 3 # Number of individuals
+# Allele frequencies are either population allele frequencies or individual allele frequencies (dense or factors)
+# EM updates are accelerated by SQUAREM extrapolation and individuals are removed from the active set when converged
+def inbreedEM(likeMatrix, f, model=1, EM=200, EM_tole=1e-4, layout="standard", epsilon=0.0, threads=1):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	if (not isinstance(f, tuple)) and (f.ndim == 1):
+		f32 = f.astype(np.float32)
+		f = as_strided(f32, shape=(m, n), strides=(0, f32.strides[0])) # Population allele frequencies shared by all individuals
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		kernel = lambda Q, X, S, F, active, T: emStep_quant(Q, X, S, model, F, active, T, table)
+	elif layout == "plink":
+		table = plinkTable(epsilon)
+		kernel = lambda G, X, S, F, active, T: emStep_plink(G, X, S, model, F, active, T, table)
+	elif layout == "ind":
+		kernel = lambda L, X, S, F, active, T: emStep_ind(L, X, S, model, F, active, T)
+	else:
+		kernel = lambda L, X, S, F, active, T: emStep(L, X, S, model, F, active, T)
 	F = np.random.rand(m) # Random intialization of inbreeding coefficients
-	F_prev = np.copy(F)
-
-	if model == 1: # Maximum likelihood estimator
-		for iteration in xrange(1, EM+1): # EM iterations
-			if f.ndim == 1:
-				# Estimated genotype frequencies given IBD state (Z)
-				fMatrix_z0 = np.vstack(((1-f)**2, 2*f*(1-f), f**2))
-				fMatrix_z1 = np.vstack(((1-f), np.zeros(n, dtype=np.float32), f))
-
-			wLike = np.empty((2,n), dtype=np.float32) # Weighted likelihood by prior
-
-			for ind in xrange(m):
-				if f.ndim == 2:
-					# Estimated genotype frequencies given IBD state (Z)
-					fMatrix_z0 = np.vstack(((1-f[ind])**2, 2*f[ind]*(1-f[ind]), f[ind]**2))
-					fMatrix_z1 = np.vstack(((1-f[ind]), np.zeros(n, dtype=np.float32), f[ind]))
-
-				wLike[0, :] = np.sum(likeMatrix[(3*ind):(3*ind+3)]*fMatrix_z0, axis=0)*(1-F[ind])
-				wLike[1, :] = np.sum(likeMatrix[(3*ind):(3*ind+3)]*fMatrix_z1, axis=0)*F[ind]
-			
-				# Expectation maximation - Update F
-				zProb = wLike/np.sum(wLike, axis=0) # Posterior probabilities
-				F[ind] = np.sum(zProb[1, :])/float(n)
-
-			# Break EM update if converged
-			diff = rmse1d(F, F_prev)
-			print "Inbreeding coefficients computed (" +str(iteration) + "). RMSD=" + str(diff)
-			if diff < EM_tole:
-				print "EM (Inbreeding) converged at iteration: " + str(iteration)
-				break
-
-			if iteration == 1:
-				oldDiff = diff
-			else:
-				# Second convergence criterion
-				if abs(diff - oldDiff) <= 1e-5:
-					print "Estimation of inbreeding coefficients. RMSD between iterations: " + str(abs(diff - oldDiff))
-					break
-				else:
-					oldDiff = diff
-
-			F_prev = np.copy(F)
-
-	elif model == 2: # Secondary model - Simple estimator (Vieira-model)
-		for iteration in xrange(1, EM+1): # EM iterations
-			if f.ndim == 1:
-				# Expected number of heterozygotes
-				expH = np.sum(2*f*(1-f))
-
-			for ind in xrange(m):
-				if f.ndim == 1:
-					# Estimated genotype frequencies given F
-					fMatrix = np.vstack(((1-f)**2 + (1-f)*f*F[ind], 2*(1-f)*f*(1-F[ind]), f**2 + (1-f)*f*F[ind]))
-				
-				else:
-					# Estimated genotype frequencies given F
-					fMatrix = np.vstack(((1-f[ind])**2 + (1-f[ind])*f[ind]*F[ind], 2*(1-f[ind])*f[ind]*(1-F[ind]), f[ind]**2 + (1-f[ind])*f[ind]*F[ind]))
-					
-					# Expected number of heterozygotes
-					expH = np.sum(2*f[ind]*(1-f[ind]))
-
-				wLike = likeMatrix[(3*ind):(3*ind+3)]*fMatrix # Weighted likelihood by prior
-
-				# Expectation maximization - Update F
-				gProb = wLike/np.sum(wLike, axis=0) # Posterior probabilities
-				F[ind] = 1 - np.sum(gProb[1, :])/expH
-
-			# Break EM update if converged
-			diff = rmse1d(F, F_prev)
-			print "Inbreeding coefficients computed (" +str(iteration) + "). RMSD=" + str(diff)
-			if diff < EM_tole:
-				print "EM (Inbreeding) converged at iteration: " + str(iteration)
-				break
-
-			if iteration == 1:
-				oldDiff = diff
-			else:
-				# Second convergence criterion
-				if abs(diff - oldDiff) <= 1e-5:
-					print "Estimation of inbreeding coefficients. RMSD between iterations: " + str(abs(diff - oldDiff))
-					break
-				else:
-					oldDiff = diff
-
-			F_prev = np.copy(F)
-
-	return F
\ No newline at end of file
+	lower = 0.0 if model == 1 else -1.0 # Lower bound of extrapolated inbreeding coefficients
+	active = np.ones(m, dtype=np.bool_)
+	T = np.zeros((m, 2))
+
+	# Tiles of individuals with active individuals
+	def activeTile(Fin, S, N, s0, s1):
+		if np.any(active[S:S+N]):
+			freqTile(lambda L, X, b, bEnd: kernel(L, X, S, Fin, active, T), likeMatrix, layout, f, S, N, s0, s1)
+
+	# Single EM update of active individuals
+	def emUpdate(Fin):
+		T.fill(0.0)
+
+		# Multithreading - tiles of individuals only as each individual is updated over all sites
+		runTiles(lambda S, N, s0, s1: activeTile(Fin, S, N, s0, s1), m, n, threads, splitSites=False)
+
+		# Expectation maximization - Update F
+		Fout = np.copy(Fin)
+		if model == 1:
+			Fout[active] = T[active, 0]/float(n)
+		else:
+			Fout[active] = 1 - T[active, 0]/T[active, 1]
+		return Fout
+
+	iteration = 0
+	while np.any(active) and (iteration + 3 <= EM):
+		# Extrapolation from two EM steps (SQUAREM)
+		F1 = emUpdate(F)
+		F2 = emUpdate(F1)
+		r = F1 - F
+		v = F2 - 2*F1 + F
+		alpha = np.full(m, -1.0)
+		alpha[v != 0] = np.minimum(-1.0, -np.abs(r[v != 0])/np.abs(v[v != 0]))
+		F1 = F - 2*alpha*r + alpha*alpha*v
+		F1 = np.where((F1 < lower) | (F1 > 1.0), F2, F1) # Fall back to EM step
+
+		# Stabilization step
+		F2 = emUpdate(F1)
+		iteration += 3
+
+		# Remove converged individuals from active set
+		diff = rmse1d(F2, F)
+		active &= np.abs(F2 - F) >= EM_tole
+		F = F2
+		print "Inbreeding coefficients computed (" + str(iteration) + "). RMSD=" + str(diff) + ", active individuals=" + str(np.sum(active))
+
+	# Plain EM steps for remaining iterations
+	while np.any(active) and (iteration < EM):
+		F2 = emUpdate(F)
+		iteration += 1
+		diff = rmse1d(F2, F)
+		active &= np.abs(F2 - F) >= EM_tole
+		F = F2
+		print "Inbreeding coefficients computed (" + str(iteration) + "). RMSD=" + str(diff) + ", active individuals=" + str(np.sum(active))
+	if np.any(active):
+		print "EM (Inbreeding) did not converge for " + str(np.sum(active)) + " individuals"
+	else:
+		print "EM (Inbreeding) converged at iteration: " + str(iteration)
+	return F
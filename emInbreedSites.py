@@ -3,6 +3,7 @@ EM algorithm to estimate the per-site inbreeding coefficients for NGS data using
 and pre-computed allele frequencies (both population or individual).
 
 Simple estimator of the per-site inbreeding coefficients. A likelihood ratio test is also performed for each site.
+Each site is iterated until its own convergence and its likelihood ratio test is performed in the following sweep.
 """
 
 __author__ = "Jonas Meisner"
@@ -15,81 +16,142 @@ import numpy as np
 from numba import jit
 from math import log
 
-# Inner update
-@jit("void(f4[:, :], f4[:, :], f8[:])", nopython=True, nogil=True, cache=True)
-def innerEM(likeMatrix, indf, F):
-	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
-	probMatrix = np.zeros((3, n))
-	expG = np.zeros(n) # Container for posterior probability of heterozygosity
-	expH = np.zeros(n) # Container for expected heterozygosity
-
+##### Functions #####
+# Terms of a site given genotype likelihoods, individual allele frequency and per-site inbreeding coefficient
+# EM (lrt=False): posterior probability of heterozygote
+# LRT (lrt=True): log-likelihoods of alternative and null model
+@jit("UniTuple(f8, 2)(f8, f8, f8, f8, f8, b1)", nopython=True, nogil=True, cache=True)
+def siteTerms(l0, l1, l2, f, Fs, lrt):
+	p0 = max(0.0001, l0*((1 - f)*(1 - f) + (1 - f)*f*Fs))
+	p1 = max(0.0001, l1*2*f*(1 - f)*(1 - Fs))
+	p2 = max(0.0001, l2*(f*f + (1 - f)*f*Fs))
+	if not lrt:
+		return p1/(p0 + p1 + p2), 0.0
+	return log(p0 + p1 + p2), log(l0*(1 - f)*(1 - f) + l1*2*f*(1 - f) + l2*f*f)
+
+# Single sweep of block of scheduled sites (likelihoods (3*m, nB), individual allele frequencies (m, nB))
+# Posterior probabilities of heterozygotes are summed in expG for EM sites and log-likelihoods for LRT sites
+@jit("void(f4[:, :], f4[:, :], f8[:], b1[:], f8[:], f8[:], f8[:])", nopython=True, nogil=True, cache=True)
+def sitesStep(likeMatrix, indf, F, lrt, expG, logAlt, logNull):
+	m, n = indf.shape
 	for ind in xrange(m):
-		# Estimate posterior probabilities
 		for s in xrange(n):
-			probMatrix[0, s] = likeMatrix[3*ind, s]*((1 - indf[ind, s])*(1 - indf[ind, s]) + (1 - indf[ind, s])*indf[ind, s]*F[s])
-			probMatrix[1, s] = likeMatrix[3*ind + 1, s]*2*indf[ind, s]*(1 - indf[ind, s])*(1 - F[s])
-			probMatrix[2, s] = likeMatrix[3*ind + 2, s]*(indf[ind, s]*indf[ind, s] + (1 - indf[ind, s])*indf[ind, s]*F[s])
-			expH[s] += 2*indf[ind, s]*(1 - indf[ind, s]) # Expected number of heterozygotes
-
-			for g in xrange(3):
-				probMatrix[g, s] = max(0.0001, probMatrix[g, s])
-		probMatrix /= np.sum(probMatrix, axis=0)
-		expG += probMatrix[1, :] # Sum the posterior of each individual
-
-	for s in xrange(n):
-		F[s] = 1 - (expG[s]/expH[s])
-
-# Loglikelihood estimates
-@jit("void(f4[:, :], f4[:, :], f8[:], f8[:], f8[:])", nopython=True, nogil=True, cache=True)
-def loglike(likeMatrix, indf, F, logAlt, logNull):
-	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
-	likeAlt = np.zeros((3, n))
-	likeNull = np.zeros((3, n))
-
+			a, b = siteTerms(likeMatrix[3*ind, s], likeMatrix[3*ind + 1, s], likeMatrix[3*ind + 2, s], indf[ind, s], F[s], lrt[s])
+			if lrt[s]:
+				logAlt[s] += a
+				logNull[s] += b
+			else:
+				expG[s] += a
+
+# Single sweep of block of scheduled sites (individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], f8[:], b1[:], f8[:], f8[:], f8[:])", nopython=True, nogil=True, cache=True)
+def sitesStep_ind(likeInd, indf, F, lrt, expG, logAlt, logNull):
+	m, n = indf.shape
+	for ind in xrange(m):
+		for s in xrange(n):
+			a, b = siteTerms(likeInd[ind, s, 0], likeInd[ind, s, 1], likeInd[ind, s, 2], indf[ind, s], F[s], lrt[s])
+			if lrt[s]:
+				logAlt[s] += a
+				logNull[s] += b
+			else:
+				expG[s] += a
+
+# Single sweep of block of scheduled sites (PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], f8[:], b1[:], f8[:], f8[:], f8[:], f8[:, :])", nopython=True, nogil=True, cache=True)
+def sitesStep_plink(G, indf, F, lrt, expG, logAlt, logNull, table):
+	m, n = indf.shape
+	for ind in xrange(m):
+		for s in xrange(n):
+			a, b = siteTerms(table[G[ind, s], 0], table[G[ind, s], 1], table[G[ind, s], 2], indf[ind, s], F[s], lrt[s])
+			if lrt[s]:
+				logAlt[s] += a
+				logNull[s] += b
+			else:
+				expG[s] += a
+
+# Single sweep of block of scheduled sites (quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], f8[:], b1[:], f8[:], f8[:], f8[:], f4[:])", "void(u2[:, :, :], f4[:, :], f8[:], b1[:], f8[:], f8[:], f8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def sitesStep_quant(Q, indf, F, lrt, expG, logAlt, logNull, table):
+	m, n = indf.shape
 	for ind in xrange(m):
 		for s in xrange(n):
-			# Alternative model
-			likeAlt[0, s] = likeMatrix[3*ind, s]*((1 - indf[ind, s])*(1 - indf[ind, s]) + (1 - indf[ind, s])*indf[ind, s]*F[s])
-			likeAlt[1, s] = likeMatrix[3*ind + 1, s]*(2*indf[ind, s]*(1 - indf[ind, s])*(1 - F[s]))
-			likeAlt[2, s] = likeMatrix[3*ind + 2, s]*(indf[ind, s]*indf[ind, s] + (1 - indf[ind, s])*indf[ind, s]*F[s])
-
-			for g in xrange(3):
-				likeAlt[g, s] = max(0.0001, likeAlt[g, s])
-			logAlt[s] += np.log(np.sum(likeAlt[:, s]))
-
-			# Null model
-			likeNull[0, s] = likeMatrix[3*ind, s]*(1 - indf[ind, s])*(1 - indf[ind, s])
-			likeNull[1, s] = likeMatrix[3*ind + 1, s]*2*indf[ind, s]*(1 - indf[ind, s])
-			likeNull[2, s] = likeMatrix[3*ind + 2, s]*indf[ind, s]*indf[ind, s]
-			logNull[s] += np.log(np.sum(likeNull[:, s]))
-
-# EM algorithm for estimation of inbreeding coefficients
-def inbreedSitesEM(likeMatrix, indf, EM=200, EM_tole=1e-4):
-	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
-	F = np.ones(n)*0.25 # Initialization of inbreeding coefficients
-	F_prev = np.copy(F)
+			a, b = siteTerms(table[Q[ind, s, 0]], table[Q[ind, s, 1]], table[Q[ind, s, 2]], indf[ind, s], F[s], lrt[s])
+			if lrt[s]:
+				logAlt[s] += a
+				logNull[s] += b
+			else:
+				expG[s] += a
+
+# EM algorithm for estimation of per-site inbreeding coefficients
+# Expected heterozygosity is computed once, converged sites are scheduled for the LRT in the following sweep
+# and removed afterwards. Only scheduled sites are gathered (and reconstructed for factors) in each sweep
+# Sites are split over threads (or worker processes) as updates of each site run over all individuals
+def inbreedSitesEM(likeMatrix, indf, EM=200, EM_tole=1e-4, layout="standard", epsilon=0.0, threads=1, blockSites=4096):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		kernel = lambda Q, X, F, lrt, A, B, C: sitesStep_quant(Q, X, F, lrt, A, B, C, table)
+	elif layout == "plink":
+		table = plinkTable(epsilon)
+		kernel = lambda G, X, F, lrt, A, B, C: sitesStep_plink(G, X, F, lrt, A, B, C, table)
+	elif layout == "ind":
+		kernel = sitesStep_ind
+	else:
+		kernel = sitesStep
+
+	# Expected number of heterozygotes
+	expH = sharedArray(n)
+	def hetTile(S, N, s0, s1):
+		for b, bEnd, X in freqBlocks(indf, 0, m, s0, s1, blockSites):
+			expH[b:bEnd] = np.sum(2*X*(1 - X), axis=0, dtype=np.float64)
+	runShards(hetTile, m, n, threads, splitInd=False)
+
+	# Sweep over scheduled sites (sorted index array) with LRT flags
+	def sweep(sites, lrt):
+		nS = sites.shape[0]
+		expG, logAlt, logNull = sharedArray(nS), sharedArray(nS), sharedArray(nS)
+		def sweepTile(S, N, a0, a1):
+			for b in xrange(a0, a1, blockSites):
+				s = sites[b:min(b + blockSites, a1)]
+				bEnd = b + s.shape[0]
+				if s[-1] - s[0] + 1 == s.shape[0]: # Contiguous sites as views
+					L, X = siteSlice(likeMatrix, layout, s[0], s[-1] + 1), freqBlock(indf, slice(s[0], s[-1] + 1))
+				else:
+					L, X = siteTake(likeMatrix, layout, s), freqBlock(indf, s)
+				kernel(L, X, F[s], lrt[b:bEnd], expG[b:bEnd], logAlt[b:bEnd], logNull[b:bEnd])
+		runShards(sweepTile, m, nS, threads, splitInd=False)
+		return expG, logAlt, logNull
+
+	F = np.full(n, 0.25) # Initialization of inbreeding coefficients
+	lrt = np.zeros(n)
+	mode = np.ones(n, dtype=np.uint8) # 1: EM update, 2: LRT, 0: done
 
 	# EM algorithm
 	for iteration in xrange(1, EM + 1):
-		innerEM(likeMatrix, indf, F) # Update F
-
-		# Break EM update if converged
+		sites = np.flatnonzero(mode)
+		isLRT = mode[sites] == 2
+		expG, logAlt, logNull = sweep(sites, isLRT)
+		lrt[sites[isLRT]] = 2*(logAlt[isLRT] - logNull[isLRT])
+		mode[sites[isLRT]] = 0
+
+		# Update F of EM sites and schedule converged sites for LRT
+		emSites = sites[~isLRT]
+		F_prev = np.copy(F)
+		F[emSites] = 1 - (expG[~isLRT]/expH[emSites])
+		converged = np.abs(F[emSites] - F_prev[emSites]) < EM_tole
+		mode[emSites[converged]] = 2
 		updateDiff = rmse1d(F, F_prev)
-		print "Inbreeding coefficients estimated (" +str(iteration) + "). RMSD=" + str(updateDiff)
-		if updateDiff < EM_tole:
+		print "Inbreeding coefficients estimated (" + str(iteration) + "). RMSD=" + str(updateDiff) + ", active sites=" + str(np.sum(mode == 1))
+		if not np.any(mode == 1):
 			print "EM (Inbreeding - sites) converged at iteration: " + str(iteration)
 			break
+	if np.any(mode == 1):
+		print "EM (Inbreeding - sites) did not converge for " + str(np.sum(mode == 1)) + " sites"
 
-		F_prev = np.copy(F)
-
-	# LRT test statistic
-	logAlt = np.zeros(n)
-	logNull = np.zeros(n)
-	loglike(likeMatrix, indf, F, logAlt, logNull)
-
-	lrt = 2*(logAlt - logNull)
+	# LRT test statistic of remaining sites
+	sites = np.flatnonzero(mode)
+	if sites.shape[0] > 0:
+		expG, logAlt, logNull = sweep(sites, np.ones(sites.shape[0], dtype=np.bool_))
+		lrt[sites] = 2*(logAlt - logNull)
 
-	return F, lrt
\ No newline at end of file
+	return F, lrt
@@ -1,6 +1,7 @@
 """
 EM algorithm to estimate the per-site population allele frequencies for NGS data using genotype likelihoods.
 Maximum likelihood estimator.
+EM updates are accelerated by SQUAREM extrapolation and each site is iterated until its own convergence.
 """
 
 __author__ = "Jonas Meisner"
@@ -8,57 +9,139 @@ __author__ = "Jonas Meisner"
 # Import libraries
 import numpy as np
 from numba import jit
-import threading
 from helpFunctions import *
 
 ##### Functions #####
-# Calculate posterior genotype probabilities
-def updateF(likeMatrix, f, S, N):
-	m, n = likeMatrix.shape
-	m /= 3
-	newF = np.zeros(n)
+# Single EM update of active sites in tile of likelihoods (3*m, T)
+@jit("void(f4[:, :], i8[:], i8, f8[:], f8[:])", nopython=True, nogil=True, cache=True)
+def tileStep(tile, active, nA, fIn, fOut):
+	m = tile.shape[0]/3 # Number of individuals
+	for k in xrange(nA):
+		fOut[active[k]] = 0.0
+	for ind in xrange(m):
+		for k in xrange(nA):
+			j = active[k]
+			p0 = tile[3*ind, j]*(1 - fIn[j])*(1 - fIn[j])
+			p1 = tile[3*ind + 1, j]*2*fIn[j]*(1 - fIn[j])
+			p2 = tile[3*ind + 2, j]*fIn[j]*fIn[j]
+			fOut[active[k]] += (p1 + 2*p2)/(2*(p0 + p1 + p2))
+	for k in xrange(nA):
+		fOut[active[k]] /= m
 
-	# Multithreading	
-	threads = [threading.Thread(target=innerEM, args=(likeMatrix, f, chunk, N, newF)) for chunk in S]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
+# Remove converged sites from active set of tile, returns number of active sites
+@jit("i8(i8[:], i8, f8[:], f8[:], i8, f8[:], i8, f8, i8[:])", nopython=True, nogil=True, cache=True)
+def dropConverged(active, nA, f0, f2, S, f, it, EM_tole, iters):
+	c = 0
+	for k in xrange(nA):
+		j = active[k]
+		if abs(f2[j] - f0[j]) < EM_tole:
+			f[S + j] = f2[j]
+			iters[S + j] = it
+		else:
+			f0[j] = f2[j]
+			active[c] = j
+			c += 1
+	return c
 
-	return newF
+# SQUAREM accelerated EM of tile of sites, converged sites are removed from the active set
+# Iterations left after the SQUAREM cycles are plain EM steps
+@jit("void(f4[:, :], i8, i8, f8[:], i8, f8, i8[:])", nopython=True, nogil=True, cache=True)
+def tileEM(tile, nT, S, f, EM, EM_tole, iters):
+	f0 = np.empty(nT)
+	f1 = np.empty(nT)
+	f2 = np.empty(nT)
+	active = np.arange(nT)
+	nA = nT
+	for j in xrange(nT):
+		f0[j] = 0.25 # Uniform initialization
+	it = 0
+	while (nA > 0) and (it + 3 <= EM):
+		# Extrapolation from two EM steps (SQUAREM)
+		tileStep(tile, active, nA, f0, f1)
+		tileStep(tile, active, nA, f1, f2)
+		for k in xrange(nA):
+			j = active[k]
+			r = f1[j] - f0[j]
+			v = f2[j] - 2*f1[j] + f0[j]
+			alpha = -1.0
+			if v != 0:
+				alpha = min(-1.0, -abs(r)/abs(v))
+			f1[j] = f0[j] - 2*alpha*r + alpha*alpha*v
+			if (f1[j] < 0.0) or (f1[j] > 1.0):
+				f1[j] = f2[j] # Fall back to EM step
 
-# Multithreaded inner update
-@jit("void(f4[:, :], f8[:], i8, i8, f8[:])", nopython=True, nogil=True, cache=True)
-def innerEM(likeMatrix, f, S, N, newF):
+		# Stabilization step
+		tileStep(tile, active, nA, f1, f2)
+		it += 3
+
+		# Remove converged sites from active set
+		nA = dropConverged(active, nA, f0, f2, S, f, it, EM_tole, iters)
+
+	# Plain EM steps for remaining iterations
+	while (nA > 0) and (it < EM):
+		tileStep(tile, active, nA, f0, f2)
+		it += 1
+		nA = dropConverged(active, nA, f0, f2, S, f, it, EM_tole, iters)
+	for k in xrange(nA):
+		f[S + active[k]] = f0[active[k]]
+		iters[S + active[k]] = -it # Not converged
+
+# Multithreaded accelerated EM over tiles of sites
+@jit("void(f4[:, :], i8, i8, i8, f8[:], i8, f8, i8[:])", nopython=True, nogil=True, cache=True)
+def squaremEM(likeMatrix, S, N, T, f, EM, EM_tole, iters):
 	m, n = likeMatrix.shape # Dimension of likelihood matrix
-	m /= 3 # Number of individuals
+	tile = np.empty((m, T), dtype=np.float32)
+	for t in xrange(S, min(S+N, n), T):
+		nT = min(T, min(S+N, n) - t)
+		for i in xrange(m):
+			for j in xrange(nT):
+				tile[i, j] = likeMatrix[i, t + j]
+		tileEM(tile, nT, t, f, EM, EM_tole, iters)
 
-	for s in xrange(S, min(S+N, n)):
+# Multithreaded accelerated EM over tiles of sites (site-major likelihoods)
+@jit("void(f4[:, :], i8, i8, i8, f8[:], i8, f8, i8[:])", nopython=True, nogil=True, cache=True)
+def squaremEM_site(likeSites, S, N, T, f, EM, EM_tole, iters):
+	n, m = likeSites.shape # Dimension of likelihood matrix
+	tile = np.empty((m, T), dtype=np.float32)
+	for t in xrange(S, min(S+N, n), T):
+		nT = min(T, min(S+N, n) - t)
+		for j in xrange(nT):
+			for i in xrange(m):
+				tile[i, j] = likeSites[t + j, i]
+		tileEM(tile, nT, t, f, EM, EM_tole, iters)
+
+# Multithreaded accelerated EM over tiles of sites (quantized individual-major likelihoods)
+@jit(["void(u1[:, :, :], i8, i8, i8, f8[:], i8, f8, i8[:], f4[:])", "void(u2[:, :, :], i8, i8, i8, f8[:], i8, f8, i8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def squaremEM_quant(Q, S, N, T, f, EM, EM_tole, iters, table):
+	m, n, _ = Q.shape # Dimension of likelihood matrix
+	tile = np.empty((3*m, T), dtype=np.float32)
+	for t in xrange(S, min(S+N, n), T):
+		nT = min(T, min(S+N, n) - t)
 		for ind in xrange(m):
-			p0 = likeMatrix[3*ind, s]*(1 - f[s])*(1 - f[s])
-			p1 = likeMatrix[3*ind + 1, s]*2*f[s]*(1 - f[s])
-			p2 = likeMatrix[3*ind + 2, s]*f[s]*f[s]
-			newF[s] += (p1 + 2*p2)/(2*(p0 + p1 + p2))
-		newF[s] /= m
+			for j in xrange(nT):
+				for g in xrange(3):
+					tile[3*ind + g, j] = table[Q[ind, t + j, g]]
+		tileEM(tile, nT, t, f, EM, EM_tole, iters)
 
 # EM algorithm for estimation of population allele frequencies
-def alleleEM(likeMatrix, EM=200, EM_tole=5e-5, threads=1):
-	m, n = likeMatrix.shape
-	m /= 3
-	f = np.ones(n)*0.25 # Uniform initialization
-
-	# Prepare for multithreading
-	chunk_N = int(np.ceil(float(n)/threads))
-	chunks = [i * chunk_N for i in xrange(threads)]
+def alleleEM(likeMatrix, EM=200, EM_tole=5e-5, threads=1, layout="standard"):
+	m, n = likeDims(likeMatrix, layout)
+	f = sharedArray(n)
+	iters = sharedArray(n, np.int64)
+	T = max(1, min(64, (1<<16)//(3*m))) # Tile of sites fitting in cache
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		kernel = lambda Q, S, N, T, f, EM, EM_tole, iters: squaremEM_quant(Q, S, N, T, f, EM, EM_tole, iters, table)
+	elif layout == "site":
+		kernel = squaremEM_site
+	else:
+		kernel = squaremEM
 
-	for iteration in xrange(1, EM + 1): # EM iterations
-		f = updateF(likeMatrix, f, chunks, chunk_N) # Updated allele frequencies
+	# Multithreading (or worker processes) - tiles of sites only as EM runs over all individuals
+	runShards(lambda S, N, s0, s1: kernel(likeMatrix, s0, s1 - s0, T, f, EM, EM_tole, iters), m, n, threads, splitInd=False)
 
-		# Break EM update if converged
-		if iteration > 1:
-			diff = rmse1d(f, f_prev)
-			if diff < EM_tole:
-				print "EM (MAF) converged at iteration: " + str(iteration)
-				break
-		f_prev = np.copy(f)
-	return f
\ No newline at end of file
+	if np.any(iters > 0):
+		print "EM (MAF) converged at iteration: " + str(np.max(iters)) + " (mean: " + str(round(np.mean(np.abs(iters)), 2)) + ")"
+	if np.any(iters <= 0): # Not converged or not iterated
+		print "EM (MAF) did not converge for " + str(np.sum(iters <= 0)) + " sites"
+	return np.array(f)
@@ -7,9 +7,17 @@ __author__ = "Jonas Meisner"
 # Import libraries
 import numpy as np
 from numba import jit
-from math import sqrt
+from math import sqrt, log
 from scipy.stats import binom
 import threading
+import Queue
+import sys
+import os
+import mmap
+import traceback
+
+# Dynamic range of likelihood ratios for quantized codes
+quantRange = {8: 1e6, 16: 1e12}
 
 # Root mean squared error
 @jit("f8(f8[:], f8[:])", nopython=True, nogil=True, cache=True)
@@ -28,17 +36,9 @@ def rmse2d_inner_float32(A, B, S, N, V):
 		for j in xrange(n):
 			V[i] += (A[i, j] - B[i, j])*(A[i, j] - B[i, j])
 
-def rmse2d_multi_float32(A, B, chunks, chunk_N):
+def rmse2d_multi_float32(A, B, threads=1):
 	m, n = A.shape
-	sumA = np.zeros(m)
-
-	# Multithreading
-	threads = [threading.Thread(target=rmse2d_inner_float32, args=(A, B, chunk, chunk_N, sumA)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
-
+	sumA = reduceTiles(lambda S, N, s0, s1, V: rmse2d_inner_float32(A[:, s0:s1], B[:, s0:s1], S, N, V), m, n, threads, (m,))
 	return sqrt(np.sum(sumA)/(m*n))
 
 @jit("void(f8[:, :], f8[:, :], i8, i8, f8[:])", nopython=True, nogil=True, cache=True)
@@ -48,17 +48,9 @@ def rmse2d_inner(A, B, S, N, V):
 		for j in xrange(n):
 			V[i] += (A[i, j] - B[i, j])*(A[i, j] - B[i, j])
 
-def rmse2d_multi(A, B, chunks, chunk_N):
+def rmse2d_multi(A, B, threads=1):
 	m, n = A.shape
-	sumA = np.zeros(m)
-
-	# Multithreading
-	threads = [threading.Thread(target=rmse2d_inner, args=(A, B, chunk, chunk_N, sumA)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
-
+	sumA = reduceTiles(lambda S, N, s0, s1, V: rmse2d_inner(A[:, s0:s1], B[:, s0:s1], S, N, V), m, n, threads, (m,))
 	return sqrt(np.sum(sumA)/(m*n))
 
 # Root mean squared error
@@ -79,17 +71,9 @@ def frobenius2d_inner(A, B, S, N, V):
 		for j in xrange(n):
 			V[i] += (A[i, j] - B[i, j])*(A[i, j] - B[i, j])
 
-def frobenius2d_multi(A, B, chunks, chunk_N):
+def frobenius2d_multi(A, B, threads=1):
 	m, n = A.shape
-	sumA = np.zeros(m)
-
-	# Multithreading
-	threads = [threading.Thread(target=frobenius2d_inner, args=(A, B, chunk, chunk_N, sumA)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
-
+	sumA = reduceTiles(lambda S, N, s0, s1, V: frobenius2d_inner(A[:, s0:s1], B[:, s0:s1], S, N, V), m, n, threads, (m,))
 	return sqrt(np.sum(sumA))
 
 # Frobenius norm
@@ -110,19 +94,252 @@ def frobeniusSingle(A):
 			sumA += A[i, j]*A[i, j]
 	return sqrt(sumA)
 
-# Convert PLINK genotype matrix into genotype likelihoods
-@jit("void(f4[:, :], f4[:, :], i8, i8, f8)", nopython=True, nogil=True, cache=True)
-def convertPlink(likeMatrix, G, S, N, epsilon):
-	m, n = G.shape # Dimension of genotype matrix
+# Number of individuals and sites of likelihood matrix in given layout
+# standard: (3*m, n), site: (n, 3*m), ind: (m, n, 3), quant: (m, n, 3) codes, plink: (m, n) genotype codes
+def likeDims(likeMatrix, layout="standard"):
+	if (layout == "ind") or (layout == "quant") or (layout == "plink"):
+		return likeMatrix.shape[0], likeMatrix.shape[1]
+	elif layout == "site":
+		return likeMatrix.shape[1]//3, likeMatrix.shape[0]
+	return likeMatrix.shape[0]//3, likeMatrix.shape[1]
+
+# View of sites s0 to s1 of likelihood matrix in given layout
+def siteSlice(likeMatrix, layout, s0, s1):
+	if layout == "site":
+		return likeMatrix[s0:s1]
+	return likeMatrix[:, s0:s1]
+
+# Copy of given sites (index array) of likelihood matrix in given layout
+def siteTake(likeMatrix, layout, sites):
+	if layout == "site":
+		return likeMatrix[sites]
+	return likeMatrix[:, sites]
+
+# View of individuals S to S+N of likelihood matrix in given layout
+def indSlice(likeMatrix, layout, S, N):
+	if layout == "site":
+		return likeMatrix[:, 3*S:3*(S+N)]
+	elif (layout == "ind") or (layout == "quant") or (layout == "plink"):
+		return likeMatrix[S:S+N]
+	return likeMatrix[3*S:3*(S+N)]
+
+# Genotype likelihoods of a single individual as (3, n) array in given layout
+def indLikes(likeMatrix, ind, layout="standard", epsilon=0.0):
+	if layout == "plink":
+		return plinkTable(epsilon).astype(np.float32)[likeMatrix[ind]].T
+	elif layout == "quant":
+		return quantTable(likeMatrix.dtype)[likeMatrix[ind]].T
+	elif layout == "ind":
+		return likeMatrix[ind].T
+	elif layout == "site":
+		return likeMatrix[:, (3*ind):(3*ind+3)].T
+	return likeMatrix[(3*ind):(3*ind+3)]
+
+# Add intercept to reconstructed allele frequencies
+@jit("void(f4[:, :], f8[:], i8, i8)", nopython=True, nogil=True, cache=True)
+def addIntercept(indF, f, S, N):
+	m, n = indF.shape
 	for ind in xrange(S, min(S+N, m)):
 		for s in xrange(n):
-			if np.isnan(G[ind, s]):
-				likeMatrix[3*ind, s] = 0.333333
-				likeMatrix[3*ind + 1, s] = 0.333333
-				likeMatrix[3*ind + 2, s] = 0.333333
+			indF[ind, s] += 2*f[s]
+			indF[ind, s] /= 2
+			indF[ind, s] = max(indF[ind, s], 1e-4)
+			indF[ind, s] = min(indF[ind, s], 1-(1e-4))
+
+# Individual allele frequencies are either a dense (m, n) array (possibly memory-mapped)
+# or factors (f, W, H) of rank e rebuilt lazily as (W*H + 2*f)/2 clipped to [1e-4, 1-1e-4]
+def freqDims(indf):
+	if isinstance(indf, tuple):
+		return indf[1].shape[0], indf[2].shape[1]
+	return indf.shape
+
+# Individual allele frequencies of individuals S to S+N at given sites (slice or index array) as float32
+def freqBlock(indf, sites=slice(None), S=0, N=None):
+	if N is None:
+		N = freqDims(indf)[0] - S
+	if isinstance(indf, tuple):
+		f, W, H = indf
+		F = np.dot(W[S:S+N], H[:, sites]).astype(np.float32, copy=False)
+		addIntercept(F, f[sites], 0, F.shape[0])
+		return F
+	return indf[S:S+N, sites]
+
+# Iterate over blocks (b, bEnd, F) of individual allele frequencies of individuals S to S+N and sites s0 to s1
+def freqBlocks(indf, S, N, s0, s1, blockSites=4096):
+	for b in xrange(s0, s1, blockSites):
+		bEnd = min(b + blockSites, s1)
+		yield b, bEnd, freqBlock(indf, slice(b, bEnd), S, N)
+
+# Run kernel(L, F, b, bEnd) on tile of individuals x sites in blocks of likelihoods and individual allele frequencies
+# Rows of blocks start at individual S
+def freqTile(kernel, likeMatrix, layout, indf, S, N, s0, s1):
+	likeInds = indSlice(likeMatrix, layout, S, N)
+	for b, bEnd, F in freqBlocks(indf, S, N, s0, s1):
+		kernel(siteSlice(likeInds, layout, b, bEnd), F, b, bEnd)
+
+# Prefetch items of iterable in a background thread
+def prefetchIter(iterable, depth=2):
+	queue = Queue.Queue(maxsize=depth)
+
+	def reader():
+		for item in iterable:
+			queue.put(item)
+		queue.put(None)
+
+	thread = threading.Thread(target=reader)
+	thread.daemon = True
+	thread.start()
+	while True:
+		item = queue.get()
+		if item is None:
+			break
+		yield item
+	thread.join()
+
+# Prefetch blocks of sites from (memory-mapped) likelihood matrix in a background thread
+def prefetchBlocks(likeMatrix, blockSize, depth=2):
+	n = likeMatrix.shape[1]
+	return prefetchIter(((b, np.array(likeMatrix[:, b:min(b+blockSize, n)])) for b in xrange(0, n, blockSize)), depth)
+
+# Bits, number of codes and scale of quantized likelihoods
+def quantParams(dtype):
+	bits = 8*np.dtype(dtype).itemsize
+	levels = np.iinfo(dtype).max
+	return bits, levels, (levels - 1)/log(quantRange[bits])
+
+# Dequantization table of log-scaled likelihood codes (last code is zero likelihood)
+def quantTable(dtype):
+	bits, levels, scale = quantParams(dtype)
+	table = np.exp(-np.arange(levels + 1)/scale).astype(np.float32)
+	table[levels] = 0.0
+	return table
+
+# Genotype likelihoods of PLINK genotype codes (count of A1 alleles, 3 is missing) given error rate
+@jit("f8[:, :](f8)", nopython=True, nogil=True, cache=True)
+def plinkTable(epsilon):
+	table = np.empty((4, 3))
+	for c in xrange(3):
+		for g in xrange(3):
+			if c == g:
+				table[c, g] = 1.0 - epsilon
 			else:
-				for g in xrange(3):
-					if int(G[ind, s]) == g:
-						likeMatrix[3*ind + g, s] = 1.0 - epsilon
-					else:
-						likeMatrix[3*ind + g, s] = epsilon/2.0
\ No newline at end of file
+				table[c, g] = epsilon/2.0
+	for g in xrange(3):
+		table[3, g] = 1.0/3.0
+	return table
+
+
+##### Thread pool #####
+# Persistent worker threads shared by all parallel kernels, created once per run
+poolQueue = Queue.Queue()
+poolWorkers = []
+
+# Worker thread taking tiles from the shared queue (dynamic dispatch)
+def poolWorker(w):
+	while True:
+		func, tile, done = poolQueue.get()
+		try:
+			func(w, tile)
+			done.put(None)
+		except Exception:
+			done.put(sys.exc_info())
+
+# Start worker threads of pool if not already running
+def startPool(threads):
+	while len(poolWorkers) < threads:
+		worker = threading.Thread(target=poolWorker, args=(len(poolWorkers),))
+		worker.daemon = True
+		worker.start()
+		poolWorkers.append(worker)
+
+# Run func(w, tile) for all tiles on pool and wait for completion
+def poolMap(func, tiles, threads=1):
+	if (threads == 1) or (len(tiles) == 1):
+		for tile in tiles:
+			func(0, tile)
+		return
+	startPool(threads)
+	done = Queue.Queue()
+	for tile in tiles:
+		poolQueue.put((func, tile, done))
+	errors = [done.get() for tile in tiles]
+	for error in errors:
+		if error is not None:
+			raise error[0], error[1], error[2]
+
+# Split individuals x sites into tiles (S, N, s0, s1), several tiles per thread for load balancing
+def makeTiles(m, n, threads=1, splitInd=True, splitSites=True):
+	nTiles = 1 if threads == 1 else 4*threads
+	siteTiles = max(1, min(nTiles, n//256)) if splitSites else 1
+	indTiles = max(1, min(m, int(np.ceil(float(nTiles)/siteTiles)))) if splitInd else 1
+	ind_N = max(1, int(np.ceil(float(m)/indTiles)))
+	site_N = max(1, int(np.ceil(float(n)/siteTiles)))
+	return [(S, ind_N, s0, min(s0 + site_N, n)) for s0 in xrange(0, n, site_N) for S in xrange(0, m, ind_N)]
+
+# Run kernel(S, N, s0, s1) over tiles of individuals x sites
+def runTiles(kernel, m, n, threads=1, splitInd=True, splitSites=True):
+	poolMap(lambda w, tile: kernel(*tile), makeTiles(m, n, threads, splitInd, splitSites), threads)
+
+# Run kernel(S, N, s0, s1, out) over tiles accumulating into per-thread partial sums and reduce them
+def reduceTiles(kernel, m, n, threads=1, shape=(1,), splitInd=True, splitSites=True):
+	parts = np.zeros((max(threads, len(poolWorkers)),) + shape)
+	poolMap(lambda w, tile: kernel(*(tile + (parts[w],))), makeTiles(m, n, threads, splitInd, splitSites), threads)
+	return np.sum(parts, axis=0)
+
+
+##### Process pool #####
+# Worker processes forked for each parallel region and sharding sites, set once per run
+# Inputs (likelihoods, frequencies) are shared copy-on-write, outputs must be allocated by sharedArray
+poolProcs = [1]
+
+# Set number of worker processes
+def setProcesses(procs):
+	poolProcs[0] = max(1, procs)
+
+# Zero-initialized array in anonymous shared memory visible to worker processes (regular array for a single process)
+def sharedArray(shape, dtype=np.float64):
+	if poolProcs[0] == 1:
+		return np.zeros(shape, dtype=dtype)
+	size = int(np.prod(shape))
+	buf = mmap.mmap(-1, max(1, size*np.dtype(dtype).itemsize))
+	return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+# Run func(w, tile) for tiles distributed over forked worker processes and wait for completion
+def procMap(func, tiles, procs):
+	sys.stdout.flush()
+	pids = []
+	for w in xrange(min(procs, len(tiles))):
+		pid = os.fork()
+		if pid == 0: # Child never returns into the code of the parent (exits on any exception)
+			code = 1
+			try:
+				for tile in tiles[w::procs]:
+					func(w, tile)
+				code = 0
+			except BaseException:
+				traceback.print_exc()
+			finally:
+				os._exit(code)
+		pids.append(pid)
+	failed = [os.waitpid(pid, 0)[1] != 0 for pid in pids]
+	if any(failed):
+		raise RuntimeError("Worker process failed in sharded computation!")
+
+# Shards of sites (0, m, s0, s1) for worker processes
+def siteShards(m, n, procs):
+	return makeTiles(m, n, procs, splitInd=False)
+
+# Run kernel(S, N, s0, s1) over shards of sites in worker processes, or over tiles in threads for a single process
+def runShards(kernel, m, n, threads=1, splitInd=True):
+	if poolProcs[0] == 1:
+		runTiles(kernel, m, n, threads, splitInd)
+		return
+	procMap(lambda w, tile: kernel(*tile), siteShards(m, n, poolProcs[0]), poolProcs[0])
+
+# Run kernel(S, N, s0, s1, out) over shards of sites in worker processes accumulating into per-process partial sums and reduce them
+def reduceShards(kernel, m, n, threads=1, shape=(1,)):
+	if poolProcs[0] == 1:
+		return reduceTiles(kernel, m, n, threads, shape)
+	parts = sharedArray((poolProcs[0],) + shape)
+	procMap(lambda w, tile: kernel(*(tile + (parts[w],))), siteShards(m, n, poolProcs[0]), poolProcs[0])
+	return np.sum(parts, axis=0)
@@ -1,38 +1,136 @@
 """
 Kinship estimator using genotype likelihoods based on PC-Relate.
+Numerator and denominator are accumulated as Gram matrices over blocks of sites (BLAS syrk).
 """
 
 __author__ = "Jonas Meisner"
 
 # Import libraries
 import numpy as np
+import pandas as pd
+from numba import jit
+from helpFunctions import *
+from covariance import syrkUpdate
 
-# Kinship estimator
-def kinshipConomos(likeMatrix, f):
-	mTotal, n = likeMatrix.shape # Dimension of likelihood matrix
-	m = mTotal/3 # Number of individuals
-	num = np.zeros((m, n)) # Container for numerator in estimation
-	numDiag = np.zeros(m) # Container for diagonal of the numerator
-	dem = np.zeros((m, n)) # Container for denominator in estimation
-	gVector = np.array([0,1,2]) # Genotype vector
-
-	for ind in xrange(m):
-		# Genotype frequencies based on individual allele frequencies under HWE 
-		fMatrix = np.vstack(((1-f[ind])**2, 2*f[ind]*(1-f[ind]), f[ind]**2))
-			
-		wLike = likeMatrix[(3*ind):(3*ind+3)]*fMatrix # Weighted likelihoods
-		gProp = wLike/np.sum(wLike, axis=0) # Genotype probabilities of individual
-		gProp = np.nan_to_num(gProp) # Set NaNs to 0
-
-		# Setting up for matrix multiplication
-		num[ind] = np.sum((((gVector*np.ones((n, 3))).T - 2*f[ind])*gProp), axis=0)
-		dem[ind] = np.sqrt(f[ind]*(1-f[ind]))
-
-		numTemp = (((gVector*np.ones((n, 3))).T - 2*f[ind])*gProp)
-		numDiag[ind] = np.trace(np.dot(numTemp, numTemp.T))
-
-	phi = np.dot(num, num.T)
+##### Functions #####
+# Centered genotype terms of a site given genotype likelihoods and individual allele frequency
+# Sum and sum of squares of (g - 2f)*P(g), zero if genotype probabilities are undefined
+@jit("UniTuple(f8, 2)(f8, f8, f8, f8)", nopython=True, nogil=True, cache=True)
+def genoTerms(l0, l1, l2, f):
+	p0 = l0*(1 - f)*(1 - f)
+	p1 = l1*2*f*(1 - f)
+	p2 = l2*f*f
+	pSum = p0 + p1 + p2
+	if pSum == 0:
+		return 0.0, 0.0
+	d0 = -2*f*p0/pSum
+	d1 = (1 - 2*f)*p1/pSum
+	d2 = (2 - 2*f)*p2/pSum
+	return d0 + d1 + d2, d0*d0 + d1*d1 + d2*d2
+
+# Numerator and denominator terms of block of likelihoods (3*N, nB) and individual allele frequencies (N, nB)
+# Diagonal of numerator is summed in diag
+@jit("void(f4[:, :], f4[:, :], f8[:, :], f8[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def kinshipBlock(likeMatrix, indf, num, dem, diag):
+	N, n = indf.shape
+	for i in xrange(N):
+		for s in xrange(n):
+			t, d = genoTerms(likeMatrix[3*i, s], likeMatrix[3*i + 1, s], likeMatrix[3*i + 2, s], indf[i, s])
+			num[i, s] = t
+			dem[i, s] = np.sqrt(indf[i, s]*(1 - indf[i, s]))
+			diag[i] += d
+
+# Numerator and denominator terms of block (individual-major likelihoods)
+@jit("void(f4[:, :, :], f4[:, :], f8[:, :], f8[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def kinshipBlock_ind(likeInd, indf, num, dem, diag):
+	N, n = indf.shape
+	for i in xrange(N):
+		for s in xrange(n):
+			t, d = genoTerms(likeInd[i, s, 0], likeInd[i, s, 1], likeInd[i, s, 2], indf[i, s])
+			num[i, s] = t
+			dem[i, s] = np.sqrt(indf[i, s]*(1 - indf[i, s]))
+			diag[i] += d
+
+# Numerator and denominator terms of block (PLINK genotype codes)
+@jit("void(u1[:, :], f4[:, :], f8[:, :], f8[:, :], f8[:], f8[:, :])", nopython=True, nogil=True, cache=True)
+def kinshipBlock_plink(G, indf, num, dem, diag, table):
+	N, n = indf.shape
+	for i in xrange(N):
+		for s in xrange(n):
+			t, d = genoTerms(table[G[i, s], 0], table[G[i, s], 1], table[G[i, s], 2], indf[i, s])
+			num[i, s] = t
+			dem[i, s] = np.sqrt(indf[i, s]*(1 - indf[i, s]))
+			diag[i] += d
+
+# Numerator and denominator terms of block (quantized likelihoods)
+@jit(["void(u1[:, :, :], f4[:, :], f8[:, :], f8[:, :], f8[:], f4[:])", "void(u2[:, :, :], f4[:, :], f8[:, :], f8[:, :], f8[:], f4[:])"], nopython=True, nogil=True, cache=True)
+def kinshipBlock_quant(Q, indf, num, dem, diag, table):
+	N, n = indf.shape
+	for i in xrange(N):
+		for s in xrange(n):
+			t, d = genoTerms(table[Q[i, s, 0]], table[Q[i, s, 1]], table[Q[i, s, 2]], indf[i, s])
+			num[i, s] = t
+			dem[i, s] = np.sqrt(indf[i, s]*(1 - indf[i, s]))
+			diag[i] += d
+
+# Fill lower triangle of C from upper triangle in place in blocks of rows
+def fillLower(C, blockRows=1024):
+	m = C.shape[0]
+	for r in xrange(0, m, blockRows):
+		rEnd = min(r + blockRows, m)
+		D = C[r:rEnd, r:rEnd]
+		D[:] = np.triu(D) + np.triu(D, 1).T
+		C[rEnd:, r:rEnd] = C[r:rEnd, rEnd:].T
+	return C
+
+# Kinship estimator, individual allele frequencies are dense or factors
+# Terms of blocks of sites are computed in parallel tiles and accumulated into upper triangles of Gram matrices
+def kinshipConomos(likeMatrix, indf, layout="standard", epsilon=0.0, threads=1, blockMem=64):
+	m, n = likeDims(likeMatrix, layout) # Number of individuals and sites
+	if layout == "quant":
+		table = quantTable(likeMatrix.dtype)
+		kernel = lambda Q, X, A, B, diag: kinshipBlock_quant(Q, X, A, B, diag, table)
+	elif layout == "plink":
+		table = plinkTable(epsilon)
+		kernel = lambda G, X, A, B, diag: kinshipBlock_plink(G, X, A, B, diag, table)
+	elif layout == "ind":
+		kernel = kinshipBlock_ind
+	else:
+		kernel = kinshipBlock
+	blockSites = max(1, min(n, (blockMem<<20)//(16*m)))
+	numBuf = np.empty(m*blockSites) # Reusable buffers of blocks
+	demBuf = np.empty(m*blockSites)
+	phi = np.zeros((m, m), order="F") # Numerator
+	demC = np.zeros((m, m), order="F") # Denominator
+	numDiag = np.zeros(m) # Diagonal of the numerator
+
+	for b in xrange(0, n, blockSites):
+		bEnd = min(b + blockSites, n)
+		num = numBuf[:m*(bEnd - b)].reshape(m, bEnd - b)
+		dem = demBuf[:m*(bEnd - b)].reshape(m, bEnd - b)
+
+		# Multithreading
+		def tileTerms(S, N, t0, t1, diag):
+			freqTile(lambda L, X, c, cEnd: kernel(L, X, num[S:S+N, c-b:cEnd-b], dem[S:S+N, c-b:cEnd-b], diag[S:S+N]), likeMatrix, layout, indf, S, N, b + t0, b + t1)
+		numDiag += reduceTiles(tileTerms, m, bEnd - b, threads, (m,))
+		phi = syrkUpdate(phi, num)
+		demC = syrkUpdate(demC, dem)
+	del numBuf, demBuf
+
+	# Kinship matrix (in-place to limit memory)
+	phi = fillLower(phi)
 	np.fill_diagonal(phi, numDiag)
-	phi = phi/(4*np.dot(dem, dem.T))
+	demC = fillLower(demC)
+	demC *= 4
+	phi /= demC
+	return phi
 
-	return phi
\ No newline at end of file
+# Pairs of individuals (upper triangle) with kinship of at least threshold as (ind1, ind2, kinship), processed in blocks of rows
+def kinshipPairs(phi, threshold, blockRows=1024):
+	m = phi.shape[0]
+	pairs = []
+	for r in xrange(0, m, blockRows):
+		rEnd = min(r + blockRows, m)
+		rows, cols = np.nonzero(np.triu(phi[r:rEnd] >= threshold, r + 1))
+		pairs.append(pd.DataFrame({"ind1": rows + r, "ind2": cols, "kinship": phi[rows + r, cols]}, columns=["ind1", "ind2", "kinship"]))
+	return pd.concat(pairs, ignore_index=True)
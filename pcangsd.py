@@ -14,25 +14,40 @@ from emInbreedSites import *
 from kinship import *
 from selection import *
 from admixture import *
+from reader import *
+from cache import *
+from checkpoint import *
+from shard import *
+from window import *
 
 # Import libraries
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 import argparse
+import os
+import sys
+import gzip
 import numpy as np
 import pandas as pd
+import scipy.stats as stats
 
 ##### Argparse #####
 parser = argparse.ArgumentParser(prog="PCAngsd")
 parser.add_argument("--version", action="version", version="%(prog)s 0.9")
 parser.add_argument("-beagle", metavar="FILE", 
-	help="Input file of genotype likelihoods in Beagle format")
+	help="Input file of genotype likelihoods in Beagle format (plain, gzip, bgzip or zstd)")
 parser.add_argument("-indf", metavar="FILE",
-	help="Input file of individual allele frequencies")
+	help="Input file of individual allele frequencies (dense or factorized Binary)")
 parser.add_argument("-plink", metavar="PLINK-PREFIX",
 	help="Prefix for PLINK files (.bed, .bim, .fam)")
 parser.add_argument("-n", metavar="INT", type=int,
 	help="Number of individuals")
+parser.add_argument("-region", metavar="STRING-LIST", nargs="+",
+	help="Only load sites of Beagle file in regions (chr, chr:start- or chr:start-end) using an index file (.pidx)")
+parser.add_argument("-sites_file", metavar="FILE",
+	help="Only load sites of Beagle file with marker IDs listed in file using an index file (.pidx)")
+parser.add_argument("-keep_samples", metavar="FILE",
+	help="Only load individuals of Beagle file listed in file by sample name or 0-based index (output rows follow order of file)")
 parser.add_argument("-epsilon", metavar="FLOAT", type=float, default=0.0,
 	help="Assumption of error PLINK genotypes (0.0)")
 parser.add_argument("-minMaf", metavar="FLOAT", type=float, default=0.05,
@@ -47,10 +62,22 @@ parser.add_argument("-maf_tole", metavar="FLOAT", type=float, default=5e-5,
 	help="Tolerance for population allele frequencies estimation update - EM (5e-5)")
 parser.add_argument("-e", metavar="INT", type=int, default=0,
 	help="Manual selection of eigenvectors used for SVD")
+parser.add_argument("-pc_select", metavar="STRING", choices=["map", "pa"], default="map",
+	help="Selection of number of eigenvectors if not manually selected, MAP test or parallel analysis (map)")
+parser.add_argument("-max_pcs", metavar="INT", type=int, default=20,
+	help="Maximum number of eigenvectors considered in selection (20)")
+parser.add_argument("-svd", metavar="STRING", choices=["arpack", "randomized"], default="arpack",
+	help="SVD engine for estimation of individual allele frequencies, randomized is warm-started between iterations (arpack)")
+parser.add_argument("-factored", action="store_true",
+	help="Keep individual allele frequencies as low-rank factors during iterations to save memory")
+parser.add_argument("-cov_dtype", metavar="STRING", choices=["float64", "float32"], default="float64",
+	help="Precision of blockwise accumulation of covariance matrix (float64)")
+parser.add_argument("-accel", action="store_true",
+	help="Accelerate iterative estimation of individual allele frequencies by SQUAREM extrapolation")
 parser.add_argument("-geno", metavar="FLOAT", type=float,
-	help="Call genotypes from posterior probabilities using individual allele frequencies as prior")
+	help="Call genotypes from posterior probabilities using individual allele frequencies as prior (PLINK files)")
 parser.add_argument("-genoInbreed", metavar="FLOAT", type=float,
-	help="Call genotypes from posterior probabilities using individual allele frequencies and inbreeding coefficients as prior")
+	help="Call genotypes from posterior probabilities using individual allele frequencies and inbreeding coefficients as prior (PLINK files)")
 parser.add_argument("-inbreed", metavar="INT", type=int,
 	help="Compute the per-individual inbreeding coefficients by specified model")
 parser.add_argument("-inbreedSites", action="store_true",
@@ -61,8 +88,14 @@ parser.add_argument("-inbreed_tole", metavar="FLOAT", type=float, default=5e-5,
 	help="Tolerance for inbreeding coefficients estimation update - EM (5e-5)")
 parser.add_argument("-selection", metavar="INT", type=int,
 	help="Perform selection scan using the top principal components by specified model")
+parser.add_argument("-window", metavar="INT", type=int,
+	help="Window size (bp) for windowed statistics of selection scan and per-site inbreeding using marker IDs (chromosome_position)")
+parser.add_argument("-window_step", metavar="INT", type=int,
+	help="Step size (bp) between windows (window size)")
 parser.add_argument("-kinship", action="store_true",
 	help="Estimate the kinship matrix")
+parser.add_argument("-kinship_pairs", metavar="FLOAT", type=float,
+	help="Only save pairs of individuals with kinship of at least threshold (0-based indices) instead of full kinship matrix")
 parser.add_argument("-admix", action="store_true",
 	help="Estimate admixture proportions using NMF")
 parser.add_argument("-admix_alpha", metavar="FLOAT-LIST", type=float, nargs="+", default=[0],
@@ -80,15 +113,44 @@ parser.add_argument("-admix_batch", metavar="INT", type=int, default=5,
 parser.add_argument("-admix_save", action="store_true",
 	help="Save population-specific allele frequencies (Binary)")
 parser.add_argument("-freq_save", action="store_true",
-	help="Save estimated allele frequencies (Binary)")
+	help="Save estimated allele frequencies (Binary, factorized with -factored)")
 parser.add_argument("-sites_save", action="store_true",
 	help="Save marker IDs of filtered sites")
+parser.add_argument("-layout", metavar="STRING", choices=["standard", "interleaved"], default="standard",
+	help="Memory layout of Beagle genotype likelihoods, interleaved uses site-major for allele frequencies and individual-major afterwards (standard)")
+parser.add_argument("-quant", metavar="INT", type=int, choices=[8, 16],
+	help="Store genotype likelihoods as log-scaled 8-bit or 16-bit codes")
+parser.add_argument("-quant_check", action="store_true",
+	help="Report accuracy of quantized likelihoods against float32 for covariance matrix and individual allele frequencies")
+parser.add_argument("-cache", metavar="DIR",
+	help="Directory for binary cache of parsed and filtered genotype likelihoods")
+parser.add_argument("-ooc", metavar="DIR",
+	help="Out-of-core estimation with memory-mapped arrays stored in directory")
+parser.add_argument("-ooc_mem", metavar="INT", type=int, default=1024,
+	help="Memory budget in MB for blocks of sites in out-of-core estimation (1024)")
+parser.add_argument("-checkpoint", metavar="INT", type=int, default=0,
+	help="Save checkpoints of population allele frequencies, iterations and admixture at least every INT iterations (0)")
+parser.add_argument("-resume", action="store_true",
+	help="Resume from latest checkpoints of a previous run with same output prefix")
+parser.add_argument("-warm_start", metavar="FILE",
+	help="Warm start iterations from factors of a previous run matched by marker IDs (.pcangsd.ckpt.npz) or individual loadings (factorized .indf)")
+parser.add_argument("-shard", metavar="DIR",
+	help="Shard-and-merge mode, run next round (or final pass) of shard stored in directory, initialized from -beagle")
+parser.add_argument("-merge", metavar="DIR-LIST", nargs="+",
+	help="Shard-and-merge mode, merge statistics of shards into genome-wide model (<-o>.model.npz)")
+parser.add_argument("-model", metavar="FILE",
+	help="Genome-wide model of shard-and-merge mode used by -shard")
 parser.add_argument("-threads", metavar="INT", type=int, default=1,
 	help="Number of threads")
+parser.add_argument("-procs", metavar="INT", type=int, default=1,
+	help="Number of worker processes sharding sites in estimation of allele frequencies, PCAngsd iterations and per-site estimators (1)")
 parser.add_argument("-o", metavar="OUTPUT", help="Prefix output file name", default="pcangsd")
 args = parser.parse_args()
 
 print "Running PCAngsd with " + str(args.threads) + " thread(s)"
+if args.procs > 1:
+	print "Sharding sites over " + str(args.procs) + " worker processes"
+setProcesses(args.procs)
 
 # Setting up workflow parameters
 param_inbreed = False
@@ -96,6 +158,7 @@ param_selection = False
 param_kinship = False
 
 if args.selection != None:
+	assert (args.selection == 1) or (args.selection == 2), "Selection scan model must be 1 (FastPCA) or 2 (PCAdapt)!"
 	param_selection = True
 
 if args.inbreed != None:
@@ -103,117 +166,249 @@ if args.inbreed != None:
 	if args.inbreed == 3:
 		param_kinship = True
 
-if args.kinship:
+if args.kinship or (args.kinship_pairs != None):
 	param_kinship = True
 
+if args.window != None:
+	if args.window_step == None:
+		args.window_step = args.window
+	assert (args.window > 0) and (args.window_step > 0), "Window and step sizes must be positive! (-window, -window_step)"
+
 if args.genoInbreed != None:
 	assert param_inbreed, "Inbreeding coefficients must be estimated in order to use -genoInbreed! Use -inbreed parameter!"
 
+##### Shard-and-merge #####
+if args.merge != None:
+	print "\n" + "Merging statistics of shards"
+	C, final = mergeShards(args.merge, str(args.o) + ".model.npz", args.e, args.iter, args.tole, args.pc_select, args.max_pcs)
+	if final:
+		pd.DataFrame(C).to_csv(str(args.o) + ".cov", sep="\t", header=False, index=False)
+		print "Saved covariance matrix as " + str(args.o) + ".cov"
+	sys.exit(0)
+
+shardCached = None
+if args.shard != None:
+	assert (args.plink == None) and (args.indf == None) and (args.ooc == None) and (args.cache == None), "Shard-and-merge mode only supports Beagle files without -indf, -ooc or -cache!"
+	assert (args.layout == "standard") and (args.quant == None), "Shard-and-merge mode only supports standard layout!"
+	assert (not param_kinship) and (not param_inbreed) and (not args.admix), "Kinship, inbreeding coefficients and admixture are genome-wide analyses not supported in shard-and-merge mode!"
+	assert (args.iter > 0), "Shard-and-merge mode requires iterations! (-iter)"
+	shardCached = readShard(args.shard)
+	if shardCached != None:
+		args.n = likeDims(shardCached[0])[0]
+
 # Check parsing
-if args.plink == None:
+if (args.plink == None) and (shardCached == None):
 	assert (args.beagle != None), "Missing input file! (-beagle or -plink)"
 assert (args.n != None), "Specify number of individuals! (-n)"
+assert (args.max_pcs > 0), "Maximum number of eigenvectors must be positive! (-max_pcs)"
 if (args.indf != None):
 	assert (args.e != 0), "Specify number of eigenvectors used to estimate allele frequencies!"
+if args.cache != None:
+	assert (args.plink == None), "Cache is only supported for Beagle files!"
+if (args.region != None) or (args.sites_file != None) or (args.keep_samples != None):
+	assert (args.plink == None), "Selection of regions, sites and samples is only supported for Beagle files!"
+	assert (args.indf == None), "Selection of regions, sites and samples can not be used with -indf!"
+if args.quant != None:
+	assert (args.plink == None), "Quantized likelihoods are only supported for Beagle files!"
+if args.quant_check:
+	assert (args.quant != None) and (args.indf == None), "Use -quant_check together with -quant when estimating individual allele frequencies!"
+if args.ooc != None:
+	assert (args.plink == None), "Out-of-core estimation is only supported for Beagle files!"
+	assert (args.indf == None), "Out-of-core estimation can not be used with -indf!"
+	assert (args.layout == "standard") and (args.quant == None), "Out-of-core estimation only supports standard layout!"
+	assert (not args.factored), "Out-of-core estimation can not be used with -factored!"
+	assert (not args.accel), "Out-of-core estimation can not be used with -accel!"
+	assert (args.checkpoint == 0) and (not args.resume) and (args.warm_start == None), "Out-of-core estimation can not be used with checkpoints or warm start!"
+	if not os.path.isdir(args.ooc):
+		os.makedirs(args.ooc)
+
+# Likelihood layouts for parsing/allele frequencies and for remaining analyses
+if args.quant != None:
+	layout = stageLayout = "quant"
+elif (args.layout == "interleaved") and (args.plink == None):
+	layout, stageLayout = "site", "ind"
+elif args.plink != None:
+	layout = stageLayout = "plink"
+else:
+	layout = stageLayout = "standard"
+
+# Selection of sites and individuals in Beagle file
+nFile = args.n
+selectKey = ""
+sites = keep = None
+if args.region != None:
+	selectKey += "|" + ",".join(args.region)
+if args.sites_file != None:
+	sites = pd.read_csv(args.sites_file, header=None, usecols=[0], dtype=str)[0].values
+	selectKey += "|" + fileChecksum(args.sites_file)
+if args.keep_samples != None:
+	keep = readSamples(args.beagle, args.keep_samples, args.n)
+	args.n = keep.shape[0]
+	selectKey += "|" + ",".join(map(str, keep))
+	print "Number of individuals after selection: " + str(args.n) + " (output rows follow order of " + args.keep_samples + ")"
+
+# Keys of checkpoints from checksums of input files, selection and parameters of stages
+if (args.checkpoint > 0) or args.resume:
+	inputs = [str(args.plink) + ext for ext in [".bed", ".bim", ".fam"]] if args.plink != None else [args.beagle]
+	inputKey = checkpointKey(*([fileChecksum(path) for path in inputs if path != None] + [args.n, layout, args.quant, selectKey]))
+	indfKey = fileChecksum(args.indf) if args.indf != None else None
+else:
+	inputKey = indfKey = None
+mafKey = checkpointKey(inputKey, args.maf_iter, args.maf_tole)
+pcangsdKey = checkpointKey(mafKey, indfKey, args.minMaf, args.e, args.tole, args.epsilon, args.svd, args.factored, args.accel, args.cov_dtype, args.pc_select, args.max_pcs)
+
+# Load cached genotype likelihoods
+cached = None
+if args.cache != None:
+	cacheFile, checksum, cacheKey = cachePath(args.cache, args.beagle, args.n, args.minMaf, args.maf_iter, args.maf_tole, layout + str(args.quant or "") + selectKey)
+	cached = readCache(cacheFile, checksum, cacheKey)
+	if cached != None:
+		print "Loaded cached genotype likelihoods from " + cacheFile
+		likeMatrix, f, pos, layout = cached
+		print "Number of sites after filtering: " + str(f.shape[0])
+if shardCached != None:
+	cached = shardCached
+	print "Loaded genotype likelihoods of shard " + args.shard
+	likeMatrix, f, pos, layout = cached
+	print "Number of sites after filtering: " + str(f.shape[0])
+del shardCached
 
 # Parse Beagle file
-if args.plink == None:
+if cached != None:
+	pass
+elif args.plink == None:
 	print "Parsing Beagle file"
-	likeMatrix = pd.read_csv(str(args.beagle), sep="\t", engine="c", header=0, usecols=range(3, 3 + 3*args.n), dtype=np.float32, compression="gzip")
-	likeMatrix = likeMatrix.as_matrix().T
+	if args.ooc != None:
+		likeMatrix, pos = readBeagle(args.beagle, nFile, path=os.path.join(args.ooc, "likeMatrix.bin"), threads=args.threads, regions=args.region, sites=sites, keep=keep)
+	else:
+		likeMatrix, pos = readBeagle(args.beagle, nFile, layout=layout, bits=args.quant, threads=args.threads, regions=args.region, sites=sites, keep=keep)
+	if (args.region != None) or (sites is not None):
+		print "Number of sites after selection: " + str(pos.shape[0])
 else:
-	chunk_N = int(np.ceil(float(args.n)/args.threads))
-	chunks = [i * chunk_N for i in xrange(args.threads)]
 	print "Parsing PLINK files"
-	from pysnptools.snpreader import Bed # Import Microsoft Genomics PLINK reader
-	snpClass = Bed(args.plink, count_A1=True)
-	pos = np.copy(snpClass.sid)
-	snpFile = snpClass.read(dtype=np.float32) # Read PLINK files into memory
-	f = np.nanmean(snpFile.val, axis=0, dtype=np.float64)/2
-	likeMatrix = np.zeros((3*args.n, snpFile.val.shape[1]), dtype=np.float32)
-	print "Converting PLINK files into genotype likelihood matrix"
-
-	# Multithreading
-	threads = [threading.Thread(target=convertPlink, args=(likeMatrix, snpFile.val, chunk, chunk_N, args.epsilon)) for chunk in chunks]
-	for thread in threads:
-		thread.start()
-	for thread in threads:
-		thread.join()
-
-	del snpClass, snpFile
+	likeMatrix, f, pos = readPlink(args.plink, args.n, args.threads)
+	plinkSites = np.arange(pos.shape[0]) # Rows of input .bim kept after filtering
 
 ##### Estimate population allele frequencies #####
-if args.plink == None:
+if (args.plink == None) and (cached == None):
 	print "\n" + "Estimating population allele frequencies"
-	f = alleleEM(likeMatrix, args.maf_iter, args.maf_tole, args.threads)
+	mafFile = checkpointPath(args.o, "maf")
+	state = readCheckpoint(mafFile, args.n, likeDims(likeMatrix, layout)[1], mafKey) if args.resume else None
+	if state is not None:
+		f = state["f"]
+	else:
+		f = alleleEM(likeMatrix, args.maf_iter, args.maf_tole, args.threads, layout)
+		if args.checkpoint > 0:
+			writeCheckpoint(mafFile, m=args.n, n=f.shape[0], key=mafKey, f=f)
+	del state
 
-if args.minMaf > 0.0:
+if (args.minMaf > 0.0) and (cached == None):
 	mask = (f >= args.minMaf) & (f <= 1-args.minMaf)
 	print "Number of sites after filtering: " + str(np.sum(mask))
 
 	# Update arrays
 	f = np.compress(mask, f)
-	likeMatrix = np.compress(mask, likeMatrix, axis=1)
+	pos = pos[mask]
+	likeMatrix = filterSites(likeMatrix, mask, layout)
+	if args.plink != None:
+		plinkSites = plinkSites[mask]
+	del mask
+
+# Save cache of filtered genotype likelihoods
+if (args.cache != None) and (cached == None):
+	writeCache(cacheFile, likeMatrix, f, pos, checksum, cacheKey, layout)
+	print "Saved cache of genotype likelihoods as " + cacheFile
+if (args.shard != None) and (cached == None):
+	writeShard(args.shard, likeMatrix, f, pos, args.beagle)
+	print "Saved genotype likelihoods of shard in " + args.shard
+del cached
+
+# Convert likelihood layout for remaining analyses
+if layout != stageLayout:
+	likeMatrix = convertLayout(likeMatrix, layout, stageLayout)
+	layout = stageLayout
 
 
 ##### PCAngsd - Individual allele frequencies and covariance matrix #####
-if args.indf == None:
-	print "\n" + "Estimating covariance matrix"	
-	C, indf, nEV, expG = PCAngsd(likeMatrix, args.e, args.iter, f, args.tole, args.threads)
+if args.shard != None:
+	model = readModel(args.model) if args.model != None else None
+	if (model is None) or (not bool(model["final"])):
+		print "\n" + "Estimating statistics of shard"
+		shardRound(likeMatrix, f, args.shard, model, args.threads)
+		sys.exit(0)
+
+	print "\n" + "Estimating individual allele frequencies of shard using genome-wide model"
+	indf, expG = shardFinal(f, args.shard, model, args.threads)
+	C, nEV = model["C"], int(model["e"])
+	del model, expG
+	if not param_selection:
+		del C
+
+elif args.indf == None:
+	print "\n" + "Estimating covariance matrix"
+	if args.ooc != None:
+		C, indf, nEV, expG = PCAngsdOOC(likeMatrix, args.e, args.iter, f, args.tole, args.threads, args.ooc, args.ooc_mem, args.pc_select, args.max_pcs)
+	else:
+		pcangsdFile = checkpointPath(args.o, "pcangsd")
+		state = readCheckpoint(pcangsdFile, args.n, f.shape[0], pcangsdKey) if args.resume else None
+		warm = readWarmStart(args.warm_start, args.n, pos) if (args.warm_start != None) and (state is None) else None
+		C, indf, nEV, expG = PCAngsd(likeMatrix, args.e, args.iter, f, args.tole, args.threads, layout, args.epsilon, args.svd, args.factored, args.accel, np.dtype(args.cov_dtype), args.pc_select, args.max_pcs, state, warm, checkpointer(pcangsdFile, args.checkpoint, args.n, f.shape[0], pcangsdKey, sites=np.asarray(pos, dtype=str)))
+		del state, warm
+
+	# Accuracy of quantized likelihoods compared to float32
+	if args.quant_check:
+		print "\n" + "Estimating covariance matrix from float32 likelihoods for comparison"
+		like32, pos32 = readBeagle(args.beagle, nFile, threads=args.threads, regions=args.region, sites=sites, keep=keep)
+		like32 = filterSites(like32, np.in1d(pos32, pos))
+		C32, indf32, _, _ = PCAngsd(like32, nEV, args.iter, f, args.tole, args.threads)
+		print "Quantization (" + str(args.quant) + "-bit) covariance matrix: max abs diff=" + str(np.max(np.abs(C - C32))) + ", RMSD=" + str(np.sqrt(np.mean((C - C32)**2)))
+		print "Quantization (" + str(args.quant) + "-bit) individual allele frequencies: max abs diff=" + str(np.max(np.abs(freqBlock(indf) - indf32))) + ", RMSD=" + str(np.sqrt(np.mean((freqBlock(indf) - indf32)**2, dtype=np.float64)))
+		del like32, pos32, C32, indf32
 
 	# Create and save data frames
 	pd.DataFrame(C).to_csv(str(args.o) + ".cov", sep="\t", header=False, index=False)
 	print "Saved covariance matrix as " + str(args.o) + ".cov"
+	del expG
 	if not param_selection:
-		del C, expG
+		del C
 
 else:
 	print "\n" + "Parsing individual allele frequencies"
-	indf = np.fromfile(args.indf, dtype=np.float32, sep="").reshape(args.n, likeMatrix.shape[1])
+	indf = readIndf(args.indf, args.n, likeDims(likeMatrix, layout)[1])
 	nEV = args.e
 
 
 ##### Selection scan #####
 if param_selection:
 	if args.indf != None:
-		print "Estimating genotype dosages and covariance matrix"
-		chunk_N = int(np.ceil(float(args.n)/args.threads))
-		chunks = [i * chunk_N for i in xrange(args.threads)]
-		expG = np.zeros(indf.shape, dtype=np.float32)
-		diagC = np.zeros(args.n)
-
-		# Multithreading
-		threads = [threading.Thread(target=covPCAngsd, args=(likeMatrix, indf, f, chunk, chunk_N, expG, diagC)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
-
-		C = estimateCov(expG, diagC, f, chunks, chunk_N)
+		print "Estimating covariance matrix"
+		C = streamCov(likeMatrix, indf, f, layout, args.epsilon, args.threads, np.dtype(args.cov_dtype))
 
 	if args.selection == 1:
 		print "\n" + "Performing selection scan using FastPCA method"
-
-		# Perform selection scan and save data frame
-		chisqDF = pd.DataFrame(selectionScan(expG, f, C, nEV, model=1, threads=args.threads).T)
-		chisqDF.to_csv(str(args.o) + ".selection.gz", sep="\t", header=False, index=False, compression="gzip")
-		print "Saved selection statistics for the top PCs as " + str(args.o) + ".selection.gz"
-
-		# Release memory
-		del chisqDF
-
 	elif args.selection == 2:
 		print "\n" + "Performing selection scan using PCAdapt method"
 
-		# Perform selection scan and save data frame
-		mahalanobisDF = pd.DataFrame(selectionScan(expG, f, C, nEV, model=2, threads=args.threads))
-		mahalanobisDF.to_csv(str(args.o) + ".selection.gz", sep="\t", header=False, index=False, compression="gzip")
-		print "Saved selection statistics for the top PCs as " + str(args.o) + ".selection.gz"
-
-		# Release memory
-		del mahalanobisDF
+	# Perform selection scan and save statistics of blocks of sites incrementally
+	with gzip.open(str(args.o) + ".selection.gz", "wb") as fh:
+		blocks = writeBlocks(selectionScan(likeMatrix, indf, f, C, nEV, args.selection, layout, args.epsilon, args.threads), fh)
+		if args.window != None:
+			# Windowed statistics in the same pass (chi-square statistics with df = 1 or Mahalanobis distances with df = nEV)
+			chrom, bp = idChromPos(pos)
+			if args.selection == 1:
+				logp = lambda X: stats.chi2.logsf(X, 1)
+			else:
+				logp = lambda X: stats.chi2.logsf(X**2, max(1, nEV))
+			nWindows = saveWindows(windowScan(blocks, chrom, bp, args.window, args.window_step, logp), str(args.o) + ".selection.windows.gz")
+			del chrom, bp
+		else:
+			for block in blocks:
+				pass
+	print "Saved selection statistics for the top PCs as " + str(args.o) + ".selection.gz"
+	if args.window != None:
+		print "Saved windowed selection statistics (" + str(nWindows) + " windows) as " + str(args.o) + ".selection.windows.gz"
 
-	del C, expG
+	del C
 
 
 ##### Kinship estimation #####
@@ -221,9 +416,15 @@ if param_kinship:
 	print "\n" + "Estimating kinship matrix"
 
 	# Perform kinship estimation
-	phi = kinshipConomos(likeMatrix, indf)
-	pd.DataFrame(phi).to_csv(str(args.o) + ".kinship", sep="\t", header=False, index=False)
-	print "Saved kinship matrix as " + str(args.o) + ".kinship"
+	phi = kinshipConomos(likeMatrix, indf, layout, args.epsilon, args.threads)
+	if args.kinship_pairs != None:
+		pairsDF = kinshipPairs(phi, args.kinship_pairs)
+		pairsDF.to_csv(str(args.o) + ".kinship.pairs.gz", sep="\t", header=False, index=False, compression="gzip")
+		print "Saved " + str(pairsDF.shape[0]) + " pairs with kinship of at least " + str(args.kinship_pairs) + " as " + str(args.o) + ".kinship.pairs.gz"
+		del pairsDF
+	else:
+		pd.DataFrame(phi).to_csv(str(args.o) + ".kinship", sep="\t", header=False, index=False)
+		print "Saved kinship matrix as " + str(args.o) + ".kinship"
 
 
 ##### Individual inbreeding coefficients #####
@@ -233,16 +434,17 @@ if args.inbreed == 1:
 	# Estimating inbreeding coefficients
 	if args.iter == 0:
 		print "Using population allele frequencies (-iter 0), not taking structure into account"
-		F = inbreedEM(likeMatrix, f, 1, args.inbreed_iter, args.inbreed_tole)
+		F = inbreedEM(likeMatrix, f, 1, args.inbreed_iter, args.inbreed_tole, layout, args.epsilon, args.threads)
 		pd.DataFrame(F).to_csv(str(args.o) + ".inbreed", sep="\t", header=False, index=False)
 		print "Saved inbreeding coefficients as " + str(args.o) + ".inbreed"
 	else:
-		F = inbreedEM(likeMatrix, indf, 1, args.inbreed_iter, args.inbreed_tole)
+		F = inbreedEM(likeMatrix, indf, 1, args.inbreed_iter, args.inbreed_tole, layout, args.epsilon, args.threads)
 		pd.DataFrame(F).to_csv(str(args.o) + ".inbreed", sep="\t", header=False, index=False)
 		print "Saved inbreeding coefficients as " + str(args.o) + ".inbreed"
 
 	# Release memory
-	del F
+	if args.genoInbreed == None:
+		del F
 
 elif args.inbreed == 2:
 	print "\n" + "Estimating inbreeding coefficients using Simple estimator (EM)"
@@ -250,16 +452,17 @@ elif args.inbreed == 2:
 	# Estimating inbreeding coefficients
 	if args.iter == 0:
 		print "Using population allele frequencies (-iter 0), not taking structure into account"
-		F = inbreedEM(likeMatrix, f, 2, args.inbreed_iter, args.inbreed_tole)
+		F = inbreedEM(likeMatrix, f, 2, args.inbreed_iter, args.inbreed_tole, layout, args.epsilon, args.threads)
 		pd.DataFrame(F).to_csv(str(args.o) + ".inbreed", sep="\t", header=False, index=False)
 		print "Saved inbreeding coefficients as " + str(args.o) + ".inbreed"
 	else:
-		F = inbreedEM(likeMatrix, indf, 2, args.inbreed_iter, args.inbreed_tole)
+		F = inbreedEM(likeMatrix, indf, 2, args.inbreed_iter, args.inbreed_tole, layout, args.epsilon, args.threads)
 		pd.DataFrame(F).to_csv(str(args.o) + ".inbreed", sep="\t", header=False, index=False)
 		print "Saved inbreeding coefficients as " + str(args.o) + ".inbreed"
 
 	# Release memory
-	del F
+	if args.genoInbreed == None:
+		del F
 	
 elif args.inbreed == 3:
 	print "\n" + "Estimating inbreeding coefficients using kinship estimator (PC-Relate)"
@@ -280,7 +483,7 @@ if args.inbreedSites:
 	print "\n" + "Estimating per-site inbreeding coefficients using simple estimator (EM) and performing LRT"
 
 	# Estimating per-site inbreeding coefficients
-	Fsites, lrt = inbreedSitesEM(likeMatrix, indf, args.inbreed_iter, args.inbreed_tole)
+	Fsites, lrt = inbreedSitesEM(likeMatrix, indf, args.inbreed_iter, args.inbreed_tole, layout, args.epsilon, args.threads)
 
 	# Save data frames
 	Fsites_DF = pd.DataFrame(Fsites)
@@ -291,6 +494,13 @@ if args.inbreedSites:
 	lrt_DF.to_csv(str(args.o) + ".lrtSites.gz", sep="\t", header=False, index=False, compression="gzip")
 	print "Saved likelihood ratio tests as " + str(args.o) + ".lrtSites.gz"
 
+	# Windowed per-site inbreeding coefficients and likelihood ratio tests (df = 1)
+	if args.window != None:
+		chrom, bp = idChromPos(pos)
+		nWindows = saveWindows(windowScan(arrayBlocks(np.column_stack((Fsites, lrt))), chrom, bp, args.window, args.window_step, lambda X: stats.chi2.logsf(X[:, 1], 1)), str(args.o) + ".inbreedSites.windows.gz")
+		print "Saved windowed per-site inbreeding coefficients and likelihood ratio tests (" + str(nWindows) + " windows) as " + str(args.o) + ".inbreedSites.windows.gz"
+		del chrom, bp
+
 	# Release memory
 	del Fsites
 	del Fsites_DF
@@ -299,27 +509,42 @@ if args.inbreedSites:
 
 
 ##### Genotype calling #####
-if args.geno != None:
-	print "\n" + "Calling genotypes with a threshold of " + str(args.geno)
+if (args.geno != None) or (args.genoInbreed != None):
+	# Sites and samples of input PLINK files or of marker IDs and sample names of Beagle file
+	if args.plink != None:
+		bim = pd.read_csv(str(args.plink) + ".bim", sep="\s+", header=None, dtype=str).iloc[plinkSites]
+		fam = pd.read_csv(str(args.plink) + ".fam", sep="\s+", header=None, dtype=str)
+		del plinkSites
+	else:
+		if args.beagle != None:
+			names = np.array(sampleNames(args.beagle))
+			if keep is not None:
+				names = names[keep]
+			alleles = readAlleles(args.beagle, pos, args.threads, args.region, sites)
+		else:
+			names = np.arange(args.n).astype(str)
+			alleles = None
+		bim, fam = markerBim(pos, alleles), sampleFam(names)
+		del names, alleles
 
-	# Call genotypes and save data frame
-	genotypesDF = pd.DataFrame(callGeno(likeMatrix, indf, None, args.geno, args.threads).T)
-	genotypesDF.to_csv(str(args.o) + ".geno.gz", "\t", header=False, index=False, compression="gzip")
-	print "Saved called genotypes as " + str(args.o) + ".geno.gz"
+	if args.geno != None:
+		print "\n" + "Calling genotypes with a threshold of " + str(args.geno)
 
-	# Release memory
-	del genotypesDF
+		# Call genotypes and save PLINK files
+		nSites = writePlink(callGeno(likeMatrix, indf, None, args.geno, args.threads, layout, args.epsilon), str(args.o) + ".geno", bim, fam)
+		print "Saved called genotypes of " + str(nSites) + " sites as " + str(args.o) + ".geno.bed/.bim/.fam (PLINK)"
+	else:
+		print "\n" + "Calling genotypes with a threshold of " + str(args.genoInbreed)
 
-elif args.genoInbreed != None:
-	print "\n" + "Calling genotypes with a threshold of " + str(args.genoInbreed)
+		# Call genotypes and save PLINK files
+		nSites = writePlink(callGeno(likeMatrix, indf, F, args.genoInbreed, args.threads, layout, args.epsilon), str(args.o) + ".genoInbreed", bim, fam)
+		print "Saved called genotypes of " + str(nSites) + " sites as " + str(args.o) + ".genoInbreed.bed/.bim/.fam (PLINK)"
 
-	# Call genotypes and save data frame
-	genotypesDF = pd.DataFrame(callGeno(likeMatrix, indf, F, args.genoInbreed, args.threads).T)
-	genotypesDF.to_csv(str(args.o) + ".genoInbreed.gz", "\t", header=False, index=False, compression="gzip")
-	print "Saved called genotypes as " + str(args.o) + ".genoInbreed.gz"
+		# Release memory
+		del F
 
 	# Release memory
-	del genotypesDF
+	del bim, fam
 
 
 ##### Admixture proportions #####
@@ -339,7 +564,11 @@ if args.admix:
 		for a in args.admix_alpha:
 			for s in S_list:
 				print "\n" + "Estimating admixture using NMF with K=" + str(K) + ", alpha=" + str(a) + ", batch=" + str(args.admix_batch) + " and seed=" + str(s)
-				Q_admix, F_admix = admixNMF(indf, K, likeMatrix, a, args.admix_iter, args.admix_tole, s, args.admix_batch, args.threads)
+				admixFile = checkpointPath(args.o, "admix.K" + str(K) + ".a" + str(a) + ("" if args.admix_seed[0] == None else ".s" + str(s)))
+				admixKey = checkpointKey(pcangsdKey, K, a, s if args.admix_seed[0] != None else None, args.admix_tole, args.admix_batch)
+				state = readCheckpoint(admixFile, args.n, freqDims(indf)[1], admixKey) if args.resume else None
+				Q_admix, F_admix = admixNMF(indf, K, likeMatrix, a, args.admix_iter, args.admix_tole, s, args.admix_batch, args.threads, layout, args.epsilon, state, checkpointer(admixFile, args.checkpoint, args.n, freqDims(indf)[1], admixKey))
+				del state
 
 				# Save data frame
 				if args.admix_seed[0] == None:
@@ -365,23 +594,15 @@ if args.admix:
 ##### Optional saves #####
 # Save updated marker IDs
 if args.sites_save:
-	if args.plink == None:
-		pos = pd.read_csv(str(args.beagle), sep="\t", engine="c", header=0, usecols=[0], compression="gzip")
-		if args.minMaf > 0.0:
-			pos = pos.ix[mask]
-			del mask
-		pos.to_csv(str(args.o) + ".sites", header=False, index=False)
-	else:
-		if args.minMaf > 0.0:
-			pd.DataFrame(pos[mask]).to_csv(str(args.o) + ".sites", header=False, index=False)
-			del mask
-		else:
-			pd.DataFrame(pos).to_csv(str(args.o) + ".sites", header=False, index=False)
+	pd.DataFrame(pos).to_csv(str(args.o) + ".sites", header=False, index=False)
 
 	print "Saved site IDs as " + str(args.o) + ".sites"
 	del pos
 
 # Save frequencies arrays
 if args.freq_save:
-	indf.tofile(str(args.o) + ".indf", sep="")
-	print "Saved individual allele frequencies as " + str(args.o) + ".indf (Binary)"
\ No newline at end of file
+	writeIndf(str(args.o) + ".indf", indf)
+	if isinstance(indf, tuple):
+		print "Saved individual allele frequencies as " + str(args.o) + ".indf (Binary, factorized)"
+	else:
+		print "Saved individual allele frequencies as " + str(args.o) + ".indf (Binary)"
\ No newline at end of file
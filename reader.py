@@ -0,0 +1,679 @@
+"""
+Parsers for genotype likelihood files in the PCAngsd framework.
+Beagle files (plain, gzip, bgzip or zstd) are decompressed and parsed in parallel chunks of sites
+directly into a preallocated likelihood matrix.
+PLINK files are decoded directly into compact genotype codes.
+Beagle likelihoods can be quantized into log-scaled 8-bit or 16-bit codes at load time.
+"""
+
+__author__ = "Jonas Meisner"
+
+# Import libraries
+import numpy as np
+import pandas as pd
+import gzip
+import zlib
+import struct
+import itertools
+import os
+from multiprocessing.pool import ThreadPool
+from math import log
+from numba import jit
+from helpFunctions import *
+
+##### Functions #####
+# Detect compression of Beagle file from magic bytes (bgzf, gzip, zstd or plain)
+def beagleFormat(beagle):
+	with open(beagle, "rb") as fh:
+		magic = fh.read(18)
+	if magic[:2] == "\x1f\x8b":
+		if (len(magic) == 18) and (ord(magic[3]) & 4) and (magic[10:14] == "\x06\x00BC"):
+			return "bgzf"
+		return "gzip"
+	elif magic[:4] == "\x28\xb5\x2f\xfd":
+		return "zstd"
+	return "plain"
+
+# Open Beagle file as stream of decompressed bytes
+def openBeagle(beagle, fmt):
+	if (fmt == "gzip") or (fmt == "bgzf"):
+		return gzip.open(beagle, "rb")
+	elif fmt == "zstd":
+		try:
+			import zstandard
+		except ImportError:
+			raise ImportError("Reading zstd compressed Beagle files requires the zstandard package!")
+		return zstandard.ZstdDecompressor().stream_reader(open(beagle, "rb"))
+	return open(beagle, "rb")
+
+# Inflate raw deflate stream of a single BGZF block (without CRC32 and ISIZE)
+def inflateBlock(block):
+	return zlib.decompress(block[:-8], -15)
+
+# Decompressed chunks of BGZF file with independent blocks inflated in parallel
+# Blocks starting from compressed offset and before compressed offset end (if given) are inflated
+def bgzfChunks(beagle, threads=1, chunkSize=1<<25, offset=0, end=None, pool=None):
+	ownPool = pool is None
+	if ownPool:
+		pool = ThreadPool(threads)
+	try:
+		with open(beagle, "rb") as fh:
+			fh.seek(offset)
+			eof = False
+			while not eof:
+				blocks = []
+				size = 0
+				while size < chunkSize:
+					if (end is not None) and (fh.tell() >= end):
+						eof = True
+						break
+					header = fh.read(18)
+					if len(header) < 18:
+						eof = True
+						break
+					assert header[10:14] == "\x06\x00BC", "Malformed BGZF block in Beagle file!"
+					block = fh.read(struct.unpack("<H", header[16:18])[0] - 17) # BSIZE is total block size - 1
+					blocks.append(block)
+					size += struct.unpack("<I", block[-4:])[0] # ISIZE
+				if len(blocks) > 0:
+					yield "".join(pool.map(inflateBlock, blocks))
+	finally:
+		if ownPool:
+			pool.close()
+
+# Compressed offsets and uncompressed start offsets of all BGZF blocks
+def bgzfBlocks(beagle):
+	cOffsets, uOffsets = [], []
+	c, u = 0, 0
+	with open(beagle, "rb") as fh:
+		header = fh.read(18)
+		while len(header) == 18:
+			bsize = struct.unpack("<H", header[16:18])[0] + 1
+			fh.seek(c + bsize - 4)
+			cOffsets.append(c)
+			uOffsets.append(u)
+			u += struct.unpack("<I", fh.read(4))[0]
+			c += bsize
+			header = fh.read(18)
+	return np.array(cOffsets, dtype=np.int64), np.array(uOffsets, dtype=np.int64)
+
+# Rechunk stream of decompressed bytes into chunks ending at line boundaries
+def lineChunks(raw):
+	rest = ""
+	for buf in raw:
+		cut = buf.rfind("\n") + 1
+		if cut == 0:
+			rest += buf
+			continue
+		yield rest + buf[:cut]
+		rest = buf[cut:]
+	if len(rest) > 0:
+		yield rest + "\n" # Missing newline at end of file
+
+# Decompressed chunks of Beagle file ending at line boundaries
+def textChunks(beagle, threads=1, chunkSize=1<<25):
+	fmt = beagleFormat(beagle)
+	if fmt == "bgzf":
+		return lineChunks(bgzfChunks(beagle, threads, chunkSize))
+	fh = openBeagle(beagle, fmt)
+	return lineChunks(iter(lambda: fh.read(chunkSize), ""))
+
+# First nLines lines of stream of decompressed bytes in chunks ending at line boundaries
+def takeLines(raw, nLines):
+	for text in lineChunks(raw):
+		ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+		if ends.shape[0] >= nLines:
+			yield text[:ends[nLines - 1] + 1]
+			return
+		nLines -= ends.shape[0]
+		yield text
+
+# Bytes of plain file in [offset, end) in chunks
+def rangeChunks(fh, offset, end, chunkSize=1<<25):
+	fh.seek(offset)
+	while offset < end:
+		buf = fh.read(min(chunkSize, end - offset))
+		if len(buf) == 0:
+			break
+		offset += len(buf)
+		yield buf
+
+# Chunks of selected spans (offset, end, first site, number of sites) of Beagle file using seeks for plain and bgzip files
+# Only the extent of each span is read (plain) or inflated (bgzip, BGZF blocks overlapping the span)
+def spanChunks(beagle, spans, threads=1, chunkSize=1<<25):
+	fmt = beagleFormat(beagle)
+	if fmt == "plain":
+		with open(beagle, "rb") as fh:
+			for offset, end, _, count in spans:
+				for text in takeLines(rangeChunks(fh, offset, end, chunkSize), count):
+					yield text
+	elif fmt == "bgzf":
+		pool = ThreadPool(threads)
+		try:
+			for offset, end, _, count in spans:
+				# Virtual offsets, block of end is only needed if span ends inside it
+				raw = bgzfChunks(beagle, threads, chunkSize, offset >> 16, (end >> 16) + int((end & 0xffff) > 0), pool)
+				first = next(raw)[offset & 0xffff:]
+				for text in takeLines(itertools.chain([first], raw), count):
+					yield text
+				raw.close()
+		finally:
+			pool.close()
+	else: # Streams can not be seeked, selected lines are picked while decompressing
+		spanStart = np.array([span[2] for span in spans], dtype=np.int64)
+		spanEnd = spanStart + np.array([span[3] for span in spans], dtype=np.int64)
+		s = -1 # Header
+		for text in textChunks(beagle, threads, chunkSize):
+			ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+			starts = np.concatenate(([0], ends[:-1] + 1))
+			lines = np.arange(s, s + ends.shape[0])
+			k = np.searchsorted(spanStart, lines, side="right") - 1
+			sel = np.flatnonzero((k >= 0) & (lines < spanEnd[np.maximum(k, 0)]))
+			s += ends.shape[0]
+			if sel.shape[0] > 0:
+				yield "".join([text[starts[i]:ends[i]+1] for i in sel])
+
+# Count number of sites in Beagle file
+def countSites(beagle, threads=1):
+	n = 0
+	for buf in prefetchIter(textChunks(beagle, threads)):
+		n += buf.count("\n")
+	return n - 1 # Header
+
+# Chromosome and position of marker IDs (chr_pos), empty chromosome if not parsable
+def idChromPos(ids):
+	chrom = np.empty(len(ids), dtype=object)
+	p = np.full(len(ids), -1, dtype=np.int64)
+	for i, markerID in enumerate(ids):
+		c, _, q = markerID.rpartition("_")
+		if (c != "") and q.isdigit():
+			chrom[i], p[i] = c, int(q)
+		else:
+			chrom[i] = ""
+	return chrom, p
+
+# Build index of blocks of sites (chromosome, first and last position, first site, number of sites, offset, end offset)
+# Offsets are virtual offsets for bgzip files and uncompressed byte offsets otherwise, end offsets are exclusive
+def buildIndex(beagle, threads=1, blockSites=1024):
+	rows = []
+	offset = 0
+	s = -1 # Header
+	for text in textChunks(beagle, threads):
+		ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10)
+		starts = np.concatenate(([0], ends[:-1] + 1))
+		if s == -1:
+			starts, ends = starts[1:], ends[1:]
+			s = 0
+		chrom, p = idChromPos([text[i:text.find("\t", i, j)] for i, j in zip(starts, ends)])
+		for k in xrange(ends.shape[0]):
+			if (len(rows) == 0) or (rows[-1][0] != chrom[k]) or (rows[-1][4] == blockSites):
+				rows.append([chrom[k], p[k], p[k], s, 0, offset + starts[k], 0])
+			rows[-1][2] = max(rows[-1][2], p[k])
+			rows[-1][4] += 1
+			rows[-1][6] = offset + ends[k] + 1
+			s += 1
+		offset += len(text)
+	index = pd.DataFrame(rows, columns=["chrom", "first", "last", "site", "count", "offset", "end"])
+	if beagleFormat(beagle) == "bgzf":
+		cOffsets, uOffsets = bgzfBlocks(beagle)
+		for col in ["offset", "end"]:
+			b = np.searchsorted(uOffsets, index[col].values, side="right") - 1
+			index[col] = (cOffsets[b] << 16) | (index[col].values - uOffsets[b])
+	return index
+
+# Load index of Beagle file (.pidx), (re)build and save it if missing or stale
+def loadIndex(beagle, threads=1):
+	path = str(beagle) + ".pidx"
+	stat = os.stat(beagle)
+	tag = "#pcangsd-index2\t" + str(stat.st_size) + "\t" + str(int(stat.st_mtime)) + "\n"
+	if os.path.isfile(path):
+		with open(path, "r") as fh:
+			if fh.readline() == tag:
+				return pd.read_csv(fh, sep="\t", dtype={"chrom": str}, keep_default_na=False)
+		print "Index of Beagle file is stale, rebuilding: " + path
+	print "Building index of Beagle file"
+	index = buildIndex(beagle, threads)
+	try:
+		with open(path, "w") as fh:
+			fh.write(tag)
+			index.to_csv(fh, sep="\t", index=False)
+		print "Saved index of Beagle file as " + path
+	except IOError:
+		print "Could not save index of Beagle file: " + path
+	return index
+
+# Parse region (chr, chr:start- or chr:start-end) into chromosome and 1-based inclusive interval
+def parseRegion(region):
+	chrom, _, interval = region.rpartition(":")
+	if chrom == "":
+		return region, 0, np.iinfo(np.int64).max
+	start, _, end = interval.replace(",", "").partition("-")
+	return chrom, int(start), int(end) if end != "" else np.iinfo(np.int64).max
+
+# Select blocks of index overlapping regions and/or containing sites, merged into contiguous spans
+def selectBlocks(index, regions=None, sites=None):
+	sel = np.ones(index.shape[0], dtype=bool)
+	chrom, first, last = index["chrom"].values, index["first"].values, index["last"].values
+	if regions is not None:
+		regionSel = np.zeros(index.shape[0], dtype=bool)
+		for c, start, end in map(parseRegion, regions):
+			regionSel |= (chrom == c) & (last >= start) & (first <= end)
+		sel &= regionSel
+	if sites is not None:
+		sitesChrom, sitesPos = idChromPos(sites)
+		if np.all(sitesChrom != ""): # Fall back to all blocks for unparsable marker IDs
+			sitesSel = np.zeros(index.shape[0], dtype=bool)
+			for c in np.unique(sitesChrom):
+				b = np.flatnonzero(chrom == c)
+				p = sitesPos[sitesChrom == c]
+				k = np.searchsorted(first[b], p, side="right") - 1
+				p, k = p[k >= 0], k[k >= 0]
+				sitesSel[b[k[p <= last[b][k]]]] = True
+			sel &= sitesSel
+	spans = []
+	for offset, end, s, count in index[["offset", "end", "site", "count"]].values[sel]:
+		if (len(spans) > 0) and (spans[-1][2] + spans[-1][3] == s):
+			spans[-1][1] = end
+			spans[-1][3] += count
+		else:
+			spans.append([offset, end, s, count])
+	return spans
+
+# Mask of parsed sites inside regions and/or in set of sites
+def siteMask(pos, regions=None, sites=None):
+	mask = np.ones(pos.shape[0], dtype=bool)
+	if regions is not None:
+		chrom, p = idChromPos(pos)
+		regionMask = np.zeros(pos.shape[0], dtype=bool)
+		for c, start, end in map(parseRegion, regions):
+			regionMask |= (chrom == c) & (p >= start) & (p <= end)
+		mask &= regionMask
+	if sites is not None:
+		mask &= np.in1d(pos, sites)
+	return mask
+
+# Sample names of Beagle header
+def sampleNames(beagle):
+	header = next(textChunks(beagle, chunkSize=1<<20))
+	return header[:header.find("\n")].rstrip("\r").split("\t")[3::3]
+
+# Alleles (allele1, allele2) of sites with marker IDs pos from Beagle file, sites are matched in order of file
+# Only indexed blocks are read for selections of regions or sites, ANGSD allele codes 0-3 are written as A, C, G and T
+def readAlleles(beagle, pos, threads=1, regions=None, sites=None):
+	codes = {"0": "A", "1": "C", "2": "G", "3": "T"}
+	n = pos.shape[0]
+	alleles = np.empty((n, 2), dtype=object)
+	header = (regions is None) and (sites is None)
+	if header:
+		chunks = textChunks(beagle, threads)
+	else:
+		chunks = spanChunks(beagle, selectBlocks(loadIndex(beagle, threads), regions, sites), threads)
+	j = 0
+	for text in chunks:
+		lines = text.split("\n")[:-1]
+		if header: # Skip header line
+			lines = lines[1:]
+			header = False
+		for line in lines:
+			if j == n:
+				break
+			cols = line.split("\t", 3)
+			if cols[0] == pos[j]:
+				alleles[j, 0] = codes.get(cols[1], cols[1])
+				alleles[j, 1] = codes.get(cols[2], cols[2])
+				j += 1
+		if j == n:
+			break
+	assert j == n, "Marker IDs not found in Beagle file!"
+	return alleles
+
+# Indices of individuals to keep from file of sample names (Beagle header) or 0-based indices
+# Individuals are kept in the order of the file, duplicates are rejected
+def readSamples(beagle, keepFile, m):
+	names = sampleNames(beagle)
+	keep = []
+	for sample in open(keepFile, "r").read().split():
+		if sample in names:
+			keep.append(names.index(sample))
+		else:
+			assert sample.isdigit() and (int(sample) < m), "Sample not found in Beagle file: " + sample
+			keep.append(int(sample))
+	keep = np.array(keep, dtype=np.int64)
+	assert np.unique(keep).shape[0] == keep.shape[0], "Duplicate samples in file of samples to keep!"
+	return keep
+
+# Parse lines of Beagle text into site-major block of likelihoods and spans of marker IDs
+# Individuals are mapped to columns of block by colMap (-1 skips individual)
+@jit("void(u1[:], i8[:], i8[:], i8, i8, i8[:], f4[:, :], i8[:, :])", nopython=True, nogil=True, cache=True)
+def parseLines(buf, starts, ends, S, E, colMap, block, idSpan):
+	nCols = 3*colMap.shape[0]
+	for k in xrange(S, E):
+		p = starts[k]
+		e = ends[k]
+		if (e > p) and (buf[e - 1] == 13):
+			e -= 1 # Windows line ending
+
+		# Marker ID and allele columns
+		idSpan[k, 0] = p
+		while (p < e) and (buf[p] != 9):
+			p += 1
+		idSpan[k, 1] = p
+		for c in xrange(2):
+			p += 1
+			while (p < e) and (buf[p] != 9):
+				p += 1
+
+		# Genotype likelihoods
+		for j in xrange(nCols):
+			p += 1
+			if p >= e:
+				idSpan[k, 0] = -1 # Too few columns
+				break
+			t = colMap[j//3]
+			if t < 0: # Skip individual
+				while (p < e) and (buf[p] != 9):
+					p += 1
+				continue
+			sign = 1.0
+			if buf[p] == 45:
+				sign = -1.0
+				p += 1
+			elif buf[p] == 43:
+				p += 1
+			mant = 0
+			frac = 0
+			digits = 0 # Significant digits in mantissa (at most 18 to fit in int64)
+			skip = 0 # Skipped integer digits
+			nDigits = 0 # All digits of field
+			while (p < e) and (buf[p] >= 48) and (buf[p] <= 57):
+				if digits < 18:
+					mant = mant*10 + (buf[p] - 48)
+					if mant > 0:
+						digits += 1
+				else:
+					skip += 1
+				nDigits += 1
+				p += 1
+			if (p < e) and (buf[p] == 46):
+				p += 1
+				while (p < e) and (buf[p] >= 48) and (buf[p] <= 57):
+					if digits < 18:
+						mant = mant*10 + (buf[p] - 48)
+						frac += 1
+						if mant > 0:
+							digits += 1
+					nDigits += 1
+					p += 1
+			if nDigits == 0: # Not a number (e.g. nan or NA)
+				idSpan[k, 0] = -2
+				break
+			expo = 0
+			if (p < e) and ((buf[p] == 101) or (buf[p] == 69)):
+				p += 1
+				expSign = 1
+				if (p < e) and (buf[p] == 45):
+					expSign = -1
+					p += 1
+				elif (p < e) and (buf[p] == 43):
+					p += 1
+				while (p < e) and (buf[p] >= 48) and (buf[p] <= 57):
+					expo = expo*10 + (buf[p] - 48)
+					p += 1
+				expo *= expSign
+			if (p < e) and (buf[p] != 9): # Trailing characters of field
+				idSpan[k, 0] = -2
+				break
+			expo += skip
+			expo -= frac
+			if expo < 0:
+				block[k - S, 3*t + j % 3] = sign*mant/(10.0**(-expo))
+			else:
+				block[k - S, 3*t + j % 3] = sign*mant*(10.0**expo)
+			while (p < e) and (buf[p] != 9):
+				p += 1
+
+# Quantize site-major block of normalized likelihoods into individual-major log-scaled codes
+@jit(["void(f4[:, :], u1[:, :, :], i8, f8, i8)", "void(f4[:, :], u2[:, :, :], i8, f8, i8)"], nopython=True, nogil=True, cache=True)
+def quantizeBlock(L, Q, S, scale, levels):
+	b, m = L.shape
+	m /= 3
+	for ind in xrange(m):
+		for s in xrange(b):
+			for g in xrange(3):
+				l = min(1.0, L[s, 3*ind + g])
+				if l <= 0:
+					Q[ind, S + s, g] = levels
+				else:
+					Q[ind, S + s, g] = min(levels - 1, int(-log(l)*scale + 0.5))
+
+# Place site-major block of likelihoods into likelihood matrix of given layout
+def placeBlock(likeMatrix, block, S, layout, scale=0.0, levels=0):
+	b = block.shape[0]
+	if layout == "quant":
+		quantizeBlock(block, likeMatrix, S, scale, levels)
+	elif layout == "site":
+		likeMatrix[S:S+b] = block
+	else:
+		likeMatrix[:, S:S+b] = block.T
+
+# Parse range of lines in chunk and place them into disjoint sites of likelihood matrix
+def parseRange(buf, starts, ends, S, E, colMap, m, likeMatrix, s, idSpan, layout, scale, levels):
+	block = np.empty((E - S, 3*m), dtype=np.float32)
+	parseLines(buf, starts, ends, S, E, colMap, block, idSpan)
+	placeBlock(likeMatrix, block, s + S, layout, scale, levels)
+
+# Parse Beagle file (plain, gzip, bgzip or zstd) in chunks of sites into preallocated likelihood matrix (optionally memory-mapped on disk)
+# Layout is either standard (3*m, n), site-major (n, 3*m) or quantized individual-major (m, n, 3) codes of given bits
+# Decompression runs in a background thread while lines of the previous chunk are parsed in parallel
+# Regions and sites are loaded from the indexed blocks containing them and only kept individuals are decoded
+def readBeagle(beagle, m, path=None, layout="standard", bits=8, threads=1, regions=None, sites=None, keep=None):
+	colMap = np.arange(m, dtype=np.int64)
+	if keep is not None:
+		colMap[:] = -1
+		colMap[keep] = np.arange(keep.shape[0])
+		m = keep.shape[0]
+	if (regions is not None) or (sites is not None):
+		spans = selectBlocks(loadIndex(beagle, threads), regions, sites)
+		n = int(sum([span[3] for span in spans]))
+		chunks = spanChunks(beagle, spans, threads)
+	else:
+		n = countSites(beagle, threads)
+		chunks = textChunks(beagle, threads)
+	scale, levels = 0.0, 0
+	if layout == "quant":
+		dtype = np.uint8 if bits == 8 else np.uint16
+		_, levels, scale = quantParams(dtype)
+		shape = (m, n, 3)
+	else:
+		dtype = np.float32
+		shape = (n, 3*m) if layout == "site" else (3*m, n)
+	if path == None:
+		likeMatrix = np.empty(shape, dtype=dtype)
+	else:
+		likeMatrix = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+	pos = np.empty(n, dtype=object)
+
+	s = 0
+	header = (regions is None) and (sites is None)
+	for text in prefetchIter(chunks):
+		buf = np.frombuffer(bytearray(text), dtype=np.uint8)
+		ends = np.flatnonzero(buf == 10)
+		starts = np.concatenate(([0], ends[:-1] + 1))
+		if header: # Skip header line
+			starts, ends = starts[1:], ends[1:]
+			header = False
+		b = ends.shape[0]
+		if b == 0:
+			continue
+		assert s + b <= n, "Number of parsed sites does not match Beagle file!"
+		idSpan = np.empty((b, 2), dtype=np.int64)
+
+		# Multithreading - tiles of lines
+		runTiles(lambda S, N, s0, s1: parseRange(buf, starts, ends, s0, s1, colMap, m, likeMatrix, s, idSpan, layout, scale, levels), m, b, threads, splitInd=False)
+
+		bad = np.flatnonzero(idSpan[:, 0] == -2)
+		assert bad.shape[0] == 0, "Genotype likelihood is not a number in Beagle file at line: " + text[starts[bad[0]]:ends[bad[0]]][:80]
+		assert np.all(idSpan[:, 0] >= 0), "Too few genotype likelihood columns in Beagle file, check -n!"
+		pos[s:s+b] = [text[i:j] for i, j in idSpan]
+		s += b
+	assert s == n, "Number of parsed sites does not match Beagle file!"
+
+	# Remove sites of selected blocks outside regions or set of sites
+	if (regions is not None) or (sites is not None):
+		mask = siteMask(pos, regions, sites)
+		if not np.all(mask):
+			pos = pos[mask]
+			likeMatrix = filterSites(likeMatrix, mask, layout)
+	return likeMatrix, pos
+
+# Decode SNP-major PLINK bytes into genotype codes (count of A1 alleles, 3 is missing) and allele frequencies
+@jit("void(u1[:, :], i8, i8, u1[:, :], f8[:])", nopython=True, nogil=True, cache=True)
+def decodeBed(B, S, N, G, f):
+	m, n = G.shape
+	codeMap = np.array([2, 3, 1, 0], dtype=np.uint8) # PLINK 2-bit codes to A1 counts
+	for s in xrange(S, min(S+N, n)):
+		count = 0
+		nonMissing = 0
+		for ind in xrange(m):
+			g = codeMap[(B[s, ind//4] >> (2*(ind % 4))) & 3]
+			G[ind, s] = g
+			if g != 3:
+				count += g
+				nonMissing += 1
+		if nonMissing > 0:
+			f[s] = count/(2.0*nonMissing)
+		else:
+			f[s] = 0.0
+
+# Read PLINK files (.bed, .bim, .fam) into genotype codes without expanding into likelihoods
+def readPlink(plink, m, threads=1):
+	fam = pd.read_csv(str(plink) + ".fam", sep="\s+", header=None, usecols=[0])
+	assert fam.shape[0] == m, "Number of individuals does not match .fam file!"
+	pos = pd.read_csv(str(plink) + ".bim", sep="\s+", header=None, usecols=[1], dtype=str)[1].values
+	n = pos.shape[0]
+	with open(str(plink) + ".bed", "rb") as fh:
+		magic = np.fromfile(fh, dtype=np.uint8, count=3)
+	assert (magic[0] == 0x6c) and (magic[1] == 0x1b) and (magic[2] == 0x01), "Only SNP-major PLINK .bed files are supported!"
+	B = np.memmap(str(plink) + ".bed", dtype=np.uint8, mode="c", offset=3, shape=(n, (m + 3)//4))
+	G = np.empty((m, n), dtype=np.uint8)
+	f = np.empty(n)
+
+	# Multithreading - tiles of sites
+	runTiles(lambda S, N, s0, s1: decodeBed(B, s0, s1 - s0, G, f), m, n, threads, splitInd=False)
+
+	return G, f, pos
+
+# Compact kept sites into the front of the flattened likelihood matrix
+@jit(["void(f4[:], b1[:], i8, i8)", "void(u1[:], b1[:], i8, i8)", "void(u2[:], b1[:], i8, i8)"], nopython=True, nogil=True, cache=True)
+def compactSites(L, mask, m, n):
+	c = 0
+	for i in xrange(m):
+		for s in xrange(n):
+			if mask[s]:
+				L[c] = L[i*n + s]
+				c += 1
+
+# Compact kept rows (sites) of site-major likelihood matrix in-place
+@jit("void(f4[:, :], b1[:])", nopython=True, nogil=True, cache=True)
+def compactRows(L, mask):
+	n, m = L.shape
+	c = 0
+	for s in xrange(n):
+		if mask[s]:
+			if c != s:
+				for j in xrange(m):
+					L[c, j] = L[s, j]
+			c += 1
+
+# Filter sites of likelihood matrix in-place without a full copy
+def filterSites(likeMatrix, mask, layout="standard"):
+	assert layout != "ind", "Filtering of individual-major likelihood matrix is not supported!"
+	nKeep = int(np.sum(mask))
+	if layout == "quant":
+		m, n, _ = likeMatrix.shape
+		compactSites(likeMatrix.reshape(-1), np.repeat(mask, 3), m, 3*n)
+		if isinstance(likeMatrix, np.memmap):
+			likeMatrix.flush()
+			return likeMatrix.reshape(-1)[:m*nKeep*3].reshape(m, nKeep, 3)
+		likeMatrix.resize((m, nKeep, 3), refcheck=False) # Release memory of filtered sites
+		return likeMatrix
+	if layout == "site":
+		n, m = likeMatrix.shape
+		compactRows(likeMatrix, mask)
+		if isinstance(likeMatrix, np.memmap):
+			likeMatrix.flush()
+			return likeMatrix[:nKeep]
+		likeMatrix.resize((nKeep, m), refcheck=False) # Release memory of filtered sites
+		return likeMatrix
+
+	m, n = likeMatrix.shape
+	compactSites(likeMatrix.reshape(-1), mask, m, n)
+	if isinstance(likeMatrix, np.memmap):
+		likeMatrix.flush()
+		return likeMatrix.reshape(-1)[:m*nKeep].reshape(m, nKeep)
+	likeMatrix.resize((m, nKeep), refcheck=False) # Release memory of filtered sites
+	return likeMatrix
+
+# View of likelihood matrix indexed as (individual, genotype, site)
+def layoutView(likeMatrix, layout):
+	if layout == "ind":
+		return likeMatrix.transpose(0, 2, 1)
+	elif layout == "site":
+		n = likeMatrix.shape[0]
+		return likeMatrix.reshape(n, -1, 3).transpose(1, 2, 0)
+	return likeMatrix.reshape(-1, 3, likeMatrix.shape[1])
+
+# Convert likelihood matrix between layouts (standard, site or ind)
+def convertLayout(likeMatrix, layout, newLayout):
+	if layout == newLayout:
+		return likeMatrix
+	view = layoutView(likeMatrix, layout)
+	m, _, n = view.shape
+	if newLayout == "ind":
+		newMatrix = np.empty((m, n, 3), dtype=likeMatrix.dtype)
+	elif newLayout == "site":
+		newMatrix = np.empty((n, 3*m), dtype=likeMatrix.dtype)
+	else:
+		newMatrix = np.empty((3*m, n), dtype=likeMatrix.dtype)
+	layoutView(newMatrix, newLayout)[...] = view
+	return newMatrix
+
+
+##### Individual allele frequencies #####
+# Factorized file of individual allele frequencies (header, f, W and H as float64)
+# Dense files are raw float32 matrices (m, n) without header
+indfMagic = "PCANGSDF"
+indfType = np.dtype([("magic", "S8"), ("m", "<i8"), ("n", "<i8"), ("e", "<i8"), ("lower", "<f8"), ("upper", "<f8")])
+
+# Save individual allele frequencies, factors are saved in factorized format
+def writeIndf(path, indf):
+	if not isinstance(indf, tuple):
+		indf.tofile(path, sep="")
+		return
+	f, W, H = indf
+	header = np.zeros(1, dtype=indfType)
+	header["magic"] = indfMagic
+	header["m"], header["e"] = W.shape
+	header["n"] = H.shape[1]
+	header["lower"], header["upper"] = 1e-4, 1-(1e-4)
+	with open(path, "wb") as fh:
+		header.tofile(fh)
+		for A in (f, W, H):
+			np.ascontiguousarray(A, dtype=np.float64).tofile(fh)
+
+# Load individual allele frequencies as factors (factorized format) or memory-mapped dense matrix
+def readIndf(path, m, n):
+	with open(path, "rb") as fh:
+		header = np.fromfile(fh, dtype=indfType, count=1)
+		if (header.shape[0] == 1) and (header["magic"][0] == indfMagic):
+			header = header[0]
+			assert (header["m"] == m) and (header["n"] == n), "Dimensions of factorized individual allele frequencies do not match input! (" + str(header["m"]) + "x" + str(header["n"]) + ")"
+			assert (header["lower"] == 1e-4) and (header["upper"] == 1-(1e-4)), "Unsupported clipping bounds of factorized individual allele frequencies!"
+			e = int(header["e"])
+			f = np.fromfile(fh, dtype=np.float64, count=n)
+			W = np.fromfile(fh, dtype=np.float64, count=m*e).reshape(m, e)
+			H = np.fromfile(fh, dtype=np.float64, count=e*n).reshape(e, n)
+			assert H.shape == (e, n), "Factorized individual allele frequencies are truncated!"
+			return f, W, H
+	assert os.path.getsize(path) == 4*m*n, "Size of individual allele frequencies does not match input!"
+	return np.memmap(path, dtype=np.float32, mode="c", shape=(m, n))
@@ -2,7 +2,8 @@
 Selection scan using principal components based on Galinsky et al. (2016) and Luu et al. (2017)
 
 Outputs the chisquare distributed selection statistics for each of the top
-principal components.
+principal components. Genotype dosages are recomputed in blocks of sites from the genotype
+likelihoods and individual allele frequencies, and statistics are returned block by block.
 """
 
 __author__ = "Jonas Meisner"
@@ -10,65 +11,56 @@ __author__ = "Jonas Meisner"
 # Import libraries
 import numpy as np
 import scipy.stats as stats
-from numba import jit
-import threading
+from helpFunctions import *
+from covariance import dosageBlocks, normalizeGeno, topEigen
 
-# Normalize the posterior expectations of the genotypes
-@jit("void(f4[:, :], f8[:], i8, i8, f8[:, :])", nopython=True, nogil=True, cache=True)
-def normalizeGeno(expG, f, S, N, X):
-	m, n = expG.shape
-	for ind in xrange(S, min(S+N, m)):
-		for s in xrange(n):
-			X[ind, s] = (expG[ind, s] - 2*f[s])/np.sqrt(2*f[s]*(1 - f[s]))
-
-# Selection scan
-def selectionScan(expG, f, C, nEV, model=1, threads=1):
-	# Perform eigendecomposition on covariance matrix
-	m, n = expG.shape
-	eigVals, eigVecs = np.linalg.eigh(C) # Eigendecomposition (Symmetric)
-	sort = np.argsort(eigVals)[::-1] # Sorting vector
-	l = eigVals[sort[:nEV]] # Sorted eigenvalues
-	V = eigVecs[:, sort[:nEV]] # Sorted eigenvectors
-
-	chunk_N = int(np.ceil(float(m)/threads))
-	chunks = [i * chunk_N for i in xrange(threads)]
+##### Functions #####
+# Selection scan, yields blocks of sites (b, bEnd, statistics) with statistics of sites in rows
+# FastPCA (model=1): chi-square statistics of the top nEV principal components
+# PCAdapt (model=2): Mahalanobis distances of z-scores of the top nEV principal components
+# Only the top eigenpairs of the covariance matrix are computed
+def selectionScan(likeMatrix, indf, f, C, nEV, model=1, layout="standard", epsilon=0.0, threads=1):
+	l, V = topEigen(C, nEV)
+	usable = l > 1e-12*max(l[0], 0.0) # Components with non-positive (or numerically zero) eigenvalues are dropped
+	if np.sum(usable) < nEV:
+		print "Warning: Only " + str(np.sum(usable)) + " of " + str(nEV) + " principal components have positive eigenvalues and are used in selection scan"
+	l, V = l[usable], V[:, usable]
+	nEV = V.shape[1]
+	assert nEV > 0, "No principal components with positive eigenvalues for selection scan!"
 
 	if model==1: # FastPCA
-		X = np.zeros((m, n))
+		XBuf = None
+		for b, bEnd, expG, _ in dosageBlocks(likeMatrix, indf, f, layout, epsilon, threads):
+			if XBuf is None:
+				XBuf = np.empty(expG.size) # Reusable buffer of blocks (first block is the largest)
+			X = XBuf[:expG.size].reshape(expG.shape)
 
-		# Multithreading
-		threads = [threading.Thread(target=normalizeGeno, args=(expG, f, chunk, chunk_N, X)) for chunk in chunks]
-		for thread in threads:
-			thread.start()
-		for thread in threads:
-			thread.join()
-		
-		# Test statistic container
-		test = np.zeros((nEV, n))
+			# Multithreading
+			runTiles(lambda S, N, s0, s1: normalizeGeno(expG[:, s0:s1], f[b+s0:b+s1], S, N, X[:, s0:s1]), X.shape[0], X.shape[1], threads)
 
-		# Compute p-values for each PC in each site
-		for eigVec in xrange(nEV):
 			# Weighted SNPs are chi-square distributed with df = 1
-			test[eigVec] = (1.0/l[eigVec])*(np.dot(X.T, V[:, eigVec])**2)
-
+			yield b, bEnd, (np.dot(X.T, V)**2)/l
 
 	elif model==2: # PCAdapt
-		test = np.zeros(n)
+		n = f.shape[0]
+		Z = np.zeros((nEV, n))
 
-		# Linear regressions
+		# Linear regressions in blocks of sites
 		hatX = np.dot(np.linalg.inv(np.dot(V.T, V)), V.T)
-		B = np.dot(hatX, expG)
-		res = expG - np.dot(V, np.dot(hatX, expG))
+		for b, bEnd, expG, _ in dosageBlocks(likeMatrix, indf, f, layout, epsilon, threads):
+			B = np.dot(hatX, expG)
+			res = expG - np.dot(V, B)
 
-		# Z-scores estimation
-		resStd = np.std(res, axis=0, ddof=1) # Standard deviations of residuals
-		Z = B/resStd
+			# Z-scores estimation
+			resStd = np.std(res, axis=0, ddof=1) # Standard deviations of residuals
+			Z[:, b:bEnd] = B/resStd
 		Z = np.nan_to_num(Z) # Set NaNs to 0
 		Zmeans = np.mean(Z, axis=1) # K mean Z-scores
-		Zinvcov = np.linalg.inv(np.cov(Z)) # Inverse covariance matrix of Z-scores
-
-		# Calculate Mahalanobis distances
-		for s in xrange(n):
-			test[s] = np.sqrt(np.dot(np.dot((Z[:, s] - Zmeans), Zinvcov), (Z[:, s] - Zmeans)))
+		Zinvcov = np.linalg.inv(np.atleast_2d(np.cov(Z))) # Inverse covariance matrix of Z-scores
 
-	return test
\ No newline at end of file
+		# Mahalanobis distances in blocks of sites
+		blockSites = 1<<16
+		for b in xrange(0, n, blockSites):
+			bEnd = min(b + blockSites, n)
+			D = Z[:, b:bEnd] - Zmeans.reshape(-1, 1)
+			yield b, bEnd, np.sqrt(np.sum(D*np.dot(Zinvcov, D), axis=0)).reshape(-1, 1)
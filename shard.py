@@ -0,0 +1,162 @@
+"""
+Shard-and-merge mode of the PCAngsd framework for running chromosomes on separate nodes.
+Each shard keeps its filtered genotype likelihoods and centered genotype dosages on local disk and
+writes sufficient statistics (Gram matrix and covariance contributions) for every round, which are merged
+into the genome-wide low-rank model of the next round. Once converged, a final pass on each shard estimates
+individual allele frequencies and per-site outputs with the genome-wide model.
+
+Workflow (shards can run as independent processes or on separate nodes):
+	pcangsd.py -beagle chr1.beagle.gz -n N -shard chr1/    (round 0 on each shard)
+	pcangsd.py -merge chr1/ chr2/ ... -o genome             (writes genome.model.npz)
+	pcangsd.py -shard chr1/ -model genome.model.npz         (next round on each shard, repeat with merge)
+	pcangsd.py -shard chr1/ -model genome.model.npz -o chr1 (final pass once model has converged)
+"""
+
+__author__ = "Jonas Meisner"
+
+# Import libraries
+import numpy as np
+import os
+from math import sqrt
+from helpFunctions import *
+from covariance import *
+from cache import readHeader, readCache, writeCache, fileChecksum
+from checkpoint import writeCheckpoint
+
+##### Functions #####
+# Cached filtered genotype likelihoods of shard, None if shard is not initialized
+def readShard(shardDir):
+	path = os.path.join(shardDir, "like.cache")
+	if not os.path.isfile(path):
+		return None
+	header = readHeader(path)
+	assert header is not None, "Shard is corrupt! (" + shardDir + ")"
+	return readCache(path, header["checksum"], header["key"])
+
+# Save filtered genotype likelihoods of shard
+def writeShard(shardDir, likeMatrix, f, pos, beagle):
+	if not os.path.isdir(shardDir):
+		os.makedirs(shardDir)
+	writeCache(os.path.join(shardDir, "like.cache"), likeMatrix, f, pos, fileChecksum(beagle), "shard")
+
+# Disk-backed centered genotype dosages of shard of given round (three rotating files)
+# Round r only overwrites dosages of round r-3, so dosages of rounds r-1 and r-2 survive an interrupted round
+def shardDosages(shardDir, r, m, n, mode="r"):
+	return np.memmap(os.path.join(shardDir, "expG." + str(r % 3) + ".bin"), dtype=np.float32, mode=mode, shape=(m, n))
+
+# Statistics file of shard of given round
+def statsPath(shardDir, r):
+	return os.path.join(shardDir, "stats." + str(r) + ".npz")
+
+# Round of shard with genotype dosages and statistics (round 0 uses population allele frequencies)
+# Individual allele frequencies of round r are reconstructed from dosages of round r-1 by projection of model
+def shardRound(likeMatrix, f, shardDir, model=None, threads=1):
+	m, n = likeDims(likeMatrix)
+	r = 0 if model is None else int(model["round"])
+	assert (r == 0) or os.path.isfile(statsPath(shardDir, r - 1)), "Shard has not finished round " + str(r - 1) + "! (" + shardDir + ")"
+	assert not os.path.isfile(statsPath(shardDir, r)), "Shard has already finished round " + str(r) + "! (" + shardDir + ")"
+	updateFumagalli, covFumagalli, updatePCAngsd, covPCAngsd = layoutKernels()
+	expG = np.zeros((m, n), dtype=np.float32)
+	sumDiff = 0.0
+
+	if r == 0:
+		# Multithreading
+		diagC = reduceTiles(lambda S, N, s0, s1, diagC: covFumagalli(likeMatrix[:, s0:s1], f[s0:s1], S, N, expG[:, s0:s1], diagC), m, n, threads, (m,))
+	else:
+		curG = np.array(shardDosages(shardDir, r - 1, m, n))
+		predF = reconstructF(gramProjection(model["V"]), curG, f, threads)
+		if r > 1:
+			prevF = reconstructF(gramProjection(model["prevV"]), np.array(shardDosages(shardDir, r - 2, m, n)), f, threads)
+			sumDiff = np.sum((predF - prevF)**2, dtype=np.float64)
+			del prevF
+		del curG
+
+		# Multithreading
+		diagC = reduceTiles(lambda S, N, s0, s1, diagC: covPCAngsd(likeMatrix[:, s0:s1], predF[:, s0:s1], f[s0:s1], S, N, expG[:, s0:s1], diagC), m, n, threads, (m,))
+
+	# Contributions to covariance matrix and Gram matrix of centered genotype dosages
+	Cpart = symmetrize(accumulateCov(np.zeros((m, m), order="F"), expG, f, 0, n, threads))
+	expG -= (2*f).astype(np.float32)
+	G = np.dot(expG, expG.T)
+	shardDosages(shardDir, r, m, n, "w+")[:] = expG
+	writeCheckpoint(statsPath(shardDir, r), m=m, n=n, round=r, G=G, C=Cpart, diagC=diagC, sumDiff=sumDiff)
+	print "Saved statistics of round " + str(r) + " as " + statsPath(shardDir, r)
+
+# Final pass of shard with converged model, returns individual allele frequencies and genotype dosages
+def shardFinal(f, shardDir, model, threads=1):
+	r = int(model["round"])
+	m, n = model["V"].shape[0], f.shape[0]
+	indf = reconstructF(gramProjection(model["V"]), np.array(shardDosages(shardDir, r - 1, m, n)), f, threads)
+	expG = np.array(shardDosages(shardDir, r, m, n)) + (2*f).astype(np.float32)
+	return indf, expG
+
+# Genome-wide model of shard-and-merge mode, None if missing
+def readModel(modelPath):
+	if not os.path.isfile(modelPath):
+		return None
+	with np.load(modelPath) as data:
+		return dict((key, data[key]) for key in data.files)
+
+# Merge statistics of shards into genome-wide low-rank model of next round (or final model if converged)
+def mergeShards(shardDirs, modelPath, EVs=0, M=100, M_tole=5e-5, pcSelect="map", maxPCs=20):
+	model = readModel(modelPath)
+	if model is not None:
+		assert not bool(model["final"]), "Model has already converged! (" + modelPath + ")"
+	r = 0 if model is None else int(model["round"])
+
+	# Sum statistics of shards
+	n, G, C, diagC, sumDiff = 0, 0.0, 0.0, 0.0, 0.0
+	for shardDir in shardDirs:
+		assert os.path.isfile(statsPath(shardDir, r)), "Shard has not finished round " + str(r) + "! (" + shardDir + ")"
+		with np.load(statsPath(shardDir, r)) as stats:
+			n += int(stats["n"])
+			G = G + stats["G"]
+			C = C + stats["C"]
+			diagC = diagC + stats["diagC"]
+			sumDiff += float(stats["sumDiff"])
+	m = G.shape[0]
+	print "Merged statistics of round " + str(r) + " of " + str(len(shardDirs)) + " shards (" + str(n) + " sites)"
+
+	# Genome-wide covariance matrix of current round
+	C /= n
+	np.fill_diagonal(C, diagC/n)
+	final = False
+	oldDiff = np.nan
+	if r == 0:
+		if EVs == 0:
+			# Velicer's Minimum Average Partial (MAP) Test or parallel analysis
+			e = selectPCs(C, n, pcSelect, maxPCs)
+		else:
+			e = EVs
+			print "Using " + str(e) + " principal components (manually selected)"
+	else:
+		e = int(model["e"])
+		oldDiff = float(model["oldDiff"])
+
+		# Break iterative update if converged
+		if r == 1:
+			print "Individual allele frequencies estimated (1)"
+		else:
+			diff = sqrt(sumDiff/(m*n))
+			print "Individual allele frequencies estimated (" + str(r) + "). RMSD=" + str(diff)
+			if diff < M_tole:
+				print "Estimation of individual allele frequencies has converged."
+				final = True
+			# Second convergence criterion
+			elif r == 2:
+				oldDiff = diff
+			elif abs(diff - oldDiff) <= 5e-6:
+				print "Estimation of individual allele frequencies has converged. Change in RMSD between iterations: " + str(abs(diff - oldDiff))
+				final = True
+			else:
+				oldDiff = diff
+		final = final or (r == M + 1)
+
+	# Model of next round, final model keeps projection of current round
+	if final:
+		writeCheckpoint(modelPath, m=m, n=n, round=r, e=e, V=model["V"], oldDiff=oldDiff, final=True, C=C)
+		print "Saved final model as " + modelPath + ", run final pass on all shards"
+	else:
+		writeCheckpoint(modelPath, m=m, n=n, round=r + 1, e=e, V=gramVectors(G, e), prevV=(None if model is None else model["V"]), oldDiff=oldDiff, final=False)
+		print "Saved model of round " + str(r + 1) + " as " + modelPath + ", run next round on all shards"
+	return C, final
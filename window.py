@@ -0,0 +1,113 @@
+"""
+Windowed genome-scan statistics of per-site statistics (selection scan and per-site inbreeding coefficients).
+Sites are assigned to windows of fixed size and step along each chromosome by their marker IDs (chromosome_position).
+Windows are accumulated in a single streaming pass over blocks of sites, only open windows are kept in memory.
+Sites with marker IDs that can not be parsed are not part of any window.
+"""
+
+__author__ = "Jonas Meisner"
+
+# Import libraries
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+import gzip
+
+##### Functions #####
+# Blocks of sites (b, bEnd, X) of per-site statistics in rows of X
+def arrayBlocks(X, blockSites=1<<16):
+	for b in xrange(0, X.shape[0], blockSites):
+		bEnd = min(b + blockSites, X.shape[0])
+		yield b, bEnd, X[b:bEnd]
+
+# Write per-site statistics of blocks of sites (b, bEnd, X) to open file and pass blocks on
+def writeBlocks(blocks, fh):
+	for b, bEnd, X in blocks:
+		pd.DataFrame(X).to_csv(fh, sep="\t", header=False, index=False)
+		yield b, bEnd, X
+
+# Windows of per-site statistics from blocks of sites (b, bEnd, X), yields data frames of closed windows
+# Chromosomes and positions of sites are given by idChromPos of marker IDs (negative positions are skipped)
+# Windows [k*step, k*step + size) of each chromosome with sites: chromosome, start, end, number of sites,
+# means and maxima of columns of X and combined p-values (Fisher's method) of columns of log p-values logp(X)
+# Sites are sorted by position within chromosomes, windows are closed when passed by the sites
+def windowScan(blocks, chrom, bp, size, step, logp=None):
+	r = (size + step - 1)//step # Maximum number of windows of a site
+	chromIndex, chromNames = {}, [] # Chromosomes in order of appearance
+	openWin = {} # (chromosome, k) -> [sites, sums, maxima, sums of log p-values]
+
+	# Data frame of windows
+	def closeWindows(keys):
+		keys = sorted(keys)
+		k = np.array([key[1] for key in keys], dtype=np.int64)
+		acc = [openWin.pop(key) for key in keys]
+		sites = np.array([a[0] for a in acc], dtype=np.int64)
+		cols = [pd.Series([chromNames[key[0]] for key in keys]), pd.Series(k*step), pd.Series(k*step + size), pd.Series(sites)]
+		means = np.array([a[1] for a in acc])/sites.reshape(-1, 1)
+		maxima = np.array([a[2] for a in acc])
+		cols += [pd.Series(means[:, j]) for j in xrange(means.shape[1])]
+		cols += [pd.Series(maxima[:, j]) for j in xrange(maxima.shape[1])]
+		if logp is not None:
+			combP = stats.chi2.sf(-2*np.array([a[3] for a in acc]), 2*sites.reshape(-1, 1))
+			cols += [pd.Series(combP[:, j]) for j in xrange(combP.shape[1])]
+		return pd.concat(cols, axis=1)
+
+	for b, bEnd, X in blocks:
+		X = np.asarray(X, dtype=np.float64).reshape(bEnd - b, -1)
+		P = logp(X).reshape(bEnd - b, -1) if logp is not None else np.zeros((bEnd - b, 0))
+		p, names = bp[b:bEnd], chrom[b:bEnd]
+		keep = p >= 0 # Sites with parsed marker IDs
+		if not np.all(keep):
+			X, P, p, names = X[keep], P[keep], p[keep], names[keep]
+		for name in pd.unique(names):
+			if name not in chromIndex:
+				chromIndex[name] = len(chromNames)
+				chromNames.append(name)
+		c = np.array([chromIndex[name] for name in names], dtype=np.int64)
+
+		# Sites of each window (at most r windows per site)
+		keyC, keyK, rows = [], [], []
+		for j in xrange(r):
+			k = p//step - j
+			valid = (k >= 0) & (p < k*step + size)
+			keyC.append(c[valid])
+			keyK.append(k[valid])
+			rows.append(np.flatnonzero(valid))
+		keyC, keyK, rows = np.concatenate(keyC), np.concatenate(keyK), np.concatenate(rows)
+		sort = np.lexsort((keyK, keyC))
+		keyC, keyK, rows = keyC[sort], keyK[sort], rows[sort]
+
+		# Accumulate windows of block into open windows
+		if rows.shape[0] > 0:
+			starts = np.flatnonzero(np.r_[True, (keyC[1:] != keyC[:-1]) | (keyK[1:] != keyK[:-1])])
+			sites = np.diff(np.r_[starts, rows.shape[0]])
+			sums = np.add.reduceat(X[rows], starts, axis=0)
+			maxima = np.maximum.reduceat(X[rows], starts, axis=0)
+			logSums = np.add.reduceat(P[rows], starts, axis=0)
+			for w in xrange(starts.shape[0]):
+				key = (keyC[starts[w]], keyK[starts[w]])
+				if key in openWin:
+					acc = openWin[key]
+					acc[0] += sites[w]
+					acc[1] += sums[w]
+					acc[2] = np.maximum(acc[2], maxima[w])
+					acc[3] += logSums[w]
+				else:
+					openWin[key] = [sites[w], sums[w], maxima[w], logSums[w]]
+
+		# Close windows of previous chromosomes and windows passed by last site
+		if p.shape[0] > 0:
+			closed = [key for key in openWin if (key[0] != c[-1]) or (key[1]*step + size <= p[-1])]
+			if len(closed) > 0:
+				yield closeWindows(closed)
+	if len(openWin) > 0:
+		yield closeWindows(openWin.keys())
+
+# Save windows as gzipped text, returns number of windows
+def saveWindows(windows, path):
+	count = 0
+	with gzip.open(path, "wb") as fh:
+		for windowsDF in windows:
+			windowsDF.to_csv(fh, sep="\t", header=False, index=False)
+			count += windowsDF.shape[0]
+	return count